@@ -2,19 +2,49 @@
 Servicio de IA para chat con el vehículo usando OpenAI
 """
 import os
-from openai import OpenAI
+import asyncio
+import threading
 from typing import Optional
 from datetime import datetime, timezone, timedelta
-from dotenv import load_dotenv
 
-load_dotenv()
+from context_aggregators import (
+    ObdStats, LatestFix, SpeedSummary, EventCounts, TripTotals, VehicleContext
+)
 
 # Zona horaria por defecto (Chile/Argentina = UTC-3)
 # Puedes cambiar esto según tu ubicación
 LOCAL_TIMEZONE_OFFSET = -3  # horas respecto a UTC
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# El cliente de OpenAI se crea en la primera consulta: importar openai alarga
+# el arranque de los workers que nunca atienden el chat (el .env lo carga main.py)
+_client = None
+_client_lock = threading.Lock()
 
+
+def get_client():
+    """Cliente de OpenAI compartido, creado al primer uso"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
+
+
+async def create_completion(**kwargs):
+    """
+    chat.completions.create en un hilo: el cliente de OpenAI es bloqueante y cada
+    ronda tardaría lo mismo en el loop, frenando el resto de peticiones y WebSockets
+    """
+    return await asyncio.to_thread(lambda: get_client().chat.completions.create(**kwargs))
+
+
+# Los prompts de sistema no llevan datos variables: junto con el resumen y el
+# historial forman un prefijo idéntico entre turnos (reutilizable por la caché
+# de prompts del proveedor). Los datos del vehículo van al final, antes de la
+# pregunta.
 SYSTEM_PROMPT = """Eres AutoAssist, un asistente experto en vehículos y análisis de datos GPS.
 Tu rol es ayudar al usuario a entender los datos de su vehículo rastreado por GPS.
 
@@ -33,10 +63,66 @@ REGLAS DE FORMATO:
 - Usa km y km/h para distancias y velocidades
 - Fechas en formato legible: "18 de diciembre a las 14:30"
 
-DATOS DEL VEHÍCULO:
+Antes de cada pregunta recibirás los datos actualizados del vehículo.
+Analiza los datos y responde las preguntas del usuario."""
+
+
+TOOLS_SYSTEM_PROMPT = """Eres AutoAssist, un asistente experto en vehículos y análisis de datos GPS.
+Tu rol es ayudar al usuario a entender los datos de su vehículo rastreado por GPS.
+
+Tienes herramientas para consultar los datos del vehículo bajo demanda:
+- get_latest_position: estado actual (ignición, voltaje, odómetro, OBD)
+- get_statistics: estadísticas de conducción y motor de las últimas N horas
+- list_trips: viajes y paradas de las últimas N horas
+- search_events: eventos y alarmas de las últimas N horas (filtrables por tipo)
+Usa solo las herramientas necesarias para responder la pregunta. No inventes datos.
+
+REGLAS DE FORMATO:
+- Responde SIEMPRE en español
+- Sé conciso y directo
+- Usa **texto** solo para datos importantes
+- Si detectas algo preocupante (alarmas, excesos de velocidad), menciónalo
+- Usa km y km/h para distancias y velocidades
+- Fechas en formato legible: "18 de diciembre a las 14:30"
+
+Antes de cada pregunta recibirás la ficha actualizada del vehículo."""
+
+VEHICLE_DATA_PROMPT = """DATOS DEL VEHÍCULO (actualizados para la siguiente pregunta):
+{vehicle_context}"""
+
+TOOLS_DATA_PROMPT = """DATOS BÁSICOS DEL VEHÍCULO:
 {vehicle_context}
 
-Analiza los datos y responde las preguntas del usuario."""
+El usuario consulta sobre las últimas {hours} horas salvo que pida otro período."""
+
+SUMMARY_PROMPT = """RESUMEN DE LA CONVERSACIÓN ANTERIOR:
+{summary}"""
+
+SUMMARIZE_PROMPT = """Resume la siguiente conversación entre un usuario y AutoAssist sobre su vehículo.
+Conserva las preguntas hechas, las cifras y fechas importantes y las conclusiones,
+para poder continuar la conversación sin el texto original. Máximo 200 palabras, en español."""
+
+FLEET_SYSTEM_PROMPT = """Eres AutoAssist, un asistente experto en flotas de vehículos y análisis de datos GPS.
+Tu rol es ayudar al usuario a comparar y entender los vehículos de su flota.
+
+Recibirás una tabla con una línea por vehículo, ordenada según lo que pregunta
+el usuario, y el detalle de los vehículos más relevantes. Los vehículos sin
+detalle solo tienen los datos de la tabla: no inventes datos que no estén.
+
+REGLAS DE FORMATO:
+- Responde SIEMPRE en español
+- Sé conciso y directo; nombra los vehículos por su nombre
+- Usa **texto** solo para datos importantes
+- Si detectas algo preocupante (alarmas, excesos de velocidad), menciónalo
+- Usa km y km/h para distancias y velocidades
+- Fechas en formato legible: "18 de diciembre a las 14:30"
+
+Antes de cada pregunta recibirás los datos actualizados de la flota."""
+
+FLEET_DATA_PROMPT = """DATOS DE LA FLOTA (actualizados para la siguiente pregunta):
+{fleet_context}"""
+
+MAX_TOOL_ROUNDS = 5
 
 
 def knots_to_kmh(knots: float) -> float:
@@ -102,83 +188,33 @@ def calculate_obd_statistics(positions: list) -> dict:
     Calcula estadísticas completas de los datos OBD del historial de posiciones.
     Retorna min, max, promedio y último valor para cada campo OBD numérico.
     """
-    # Campos OBD numéricos para calcular estadísticas
-    numeric_fields = {
-        'io31': 'Carga del motor (%)',
-        'io32': 'Temperatura refrigerante (°C)',
-        'io35': 'Temperatura aire admisión (°C)',
-        'io36': 'RPM del motor',
-        'io37': 'Velocidad OBD (km/h)',
-        'io39': 'Posición acelerador (%)',
-        'io43': 'Nivel combustible (%)',
-        'io48': 'Carga calculada (%)',
-    }
-    
-    # Campos que solo necesitan el último valor
-    single_fields = ['io30', 'io33', 'io38', 'io60', 'io250', 'io252', 'io389', 'vin']
-    
-    stats = {}
-    last_values = {}
-    last_times = {}
-    
-    # Recolectar todos los valores para cada campo
-    field_values = {field: [] for field in numeric_fields}
-    
+    stats = ObdStats()
     for p in positions:
-        attrs = p.get('attributes', {})
-        fix_time = p.get('fixTime', '')
-        
-        # Recolectar valores numéricos para estadísticas
-        for field in numeric_fields:
-            if field in attrs and attrs[field] is not None:
-                value = attrs[field]
-                if isinstance(value, (int, float)) and value > 0:  # Solo valores positivos válidos
-                    field_values[field].append(value)
-        
-        # Guardar últimos valores de campos simples
-        for field in single_fields:
-            if field in attrs and attrs[field] is not None:
-                if field not in last_values or fix_time > last_times.get(field, ''):
-                    last_values[field] = attrs[field]
-                    last_times[field] = fix_time
-    
-    # Calcular estadísticas para campos numéricos
-    for field, description in numeric_fields.items():
-        values = field_values[field]
-        if values:
-            stats[field] = {
-                'description': description,
-                'min': round(min(values), 1),
-                'max': round(max(values), 1),
-                'avg': round(sum(values) / len(values), 1),
-                'last': round(values[-1], 1) if values else None,
-                'count': len(values)
-            }
-    
-    # Agregar campos simples
-    for field in single_fields:
-        if field in last_values:
-            stats[field] = {'last': last_values[field]}
-    
-    return stats
+        stats.add(p)
+    return stats.result()
 
 
 def format_current_position(positions: list) -> str:
     """Formatea la posición actual con todos los atributos importantes"""
     if not positions:
+        return format_current_fix(None, {})
+    
+    if isinstance(positions, list):
+        # La posición más reciente y las estadísticas OBD de todo el historial
+        latest = LatestFix()
+        obd = ObdStats()
+        for p in positions:
+            latest.add(p)
+            obd.add(p)
+        return format_current_fix(latest.position, obd.result())
+    return format_current_fix(positions, {})
+
+
+def format_current_fix(p: Optional[dict], obd_stats: dict) -> str:
+    """Posición actual `p` con las estadísticas OBD del período"""
+    if not p:
         return "\n=== POSICIÓN ACTUAL ===\nNo hay datos de posición."
     
-    # Tomar la posición más reciente (última del array, ordenado por tiempo)
-    if isinstance(positions, list) and len(positions) > 0:
-        # Ordenar por fixTime y tomar la más reciente
-        sorted_positions = sorted(positions, key=lambda x: x.get('fixTime', ''), reverse=True)
-        p = sorted_positions[0]
-        # Calcular estadísticas OBD de todo el historial
-        obd_stats = calculate_obd_statistics(positions)
-    else:
-        p = positions
-        obd_stats = {}
-    
     lines = ["\n=== POSICIÓN ACTUAL ==="]
     lines.append(f"Fecha/Hora: {format_datetime(p.get('fixTime'))}")
     lines.append(f"Coordenadas: {p.get('latitude', 'N/A')}, {p.get('longitude', 'N/A')}")
@@ -314,22 +350,28 @@ def format_current_position(positions: list) -> str:
 
 def format_positions_summary(positions: list) -> str:
     """Formatea un resumen del historial de posiciones"""
-    if not positions:
+    summary = SpeedSummary()
+    for p in positions or []:
+        summary.add(p)
+    return format_speed_summary(summary)
+
+
+def format_speed_summary(summary: SpeedSummary) -> str:
+    """Resumen del historial a partir de sus agregados de velocidad"""
+    if not summary.count:
         return "\n=== HISTORIAL DE POSICIONES ===\nNo hay historial disponible."
     
-    lines = [f"\n=== HISTORIAL DE POSICIONES ({len(positions)} registros) ==="]
+    lines = [f"\n=== HISTORIAL DE POSICIONES ({summary.count} registros) ==="]
     
-    # Calcular estadísticas de velocidad
-    speeds_kmh = [knots_to_kmh(p.get('speed', 0)) for p in positions if p.get('speed', 0) > 0]
-    if speeds_kmh:
-        lines.append(f"Velocidad máxima registrada: {max(speeds_kmh)} km/h")
-        lines.append(f"Velocidad promedio (en movimiento): {round(sum(speeds_kmh)/len(speeds_kmh), 1)} km/h")
+    # Estadísticas de velocidad
+    if summary.moving_count:
+        lines.append(f"Velocidad máxima registrada: {knots_to_kmh(summary.max_speed)} km/h")
+        lines.append(f"Velocidad promedio (en movimiento): {knots_to_kmh(summary.average_moving_speed)} km/h")
     
-    # Mostrar últimas 5 posiciones con movimiento
-    moving_positions = [p for p in positions if p.get('speed', 0) > 0][-10:]
-    if moving_positions:
+    # Mostrar últimas posiciones con movimiento
+    if summary.recent_moving:
         lines.append("\nÚltimas posiciones con movimiento:")
-        for p in moving_positions[-5:]:
+        for p in summary.recent_moving:
             time = format_datetime(p.get('fixTime'))
             speed = knots_to_kmh(p.get('speed', 0))
             lines.append(f"  - {time}: {speed} km/h")
@@ -339,7 +381,15 @@ def format_positions_summary(positions: list) -> str:
 
 def format_events_for_context(events: list) -> str:
     """Formatea los eventos para incluir en el contexto"""
-    if not events:
+    counts = EventCounts()
+    for e in events or []:
+        counts.add(e)
+    return format_event_counts(counts)
+
+
+def format_event_counts(counts: EventCounts) -> str:
+    """Eventos a partir de sus agregados (conteo por tipo y últimas alarmas)"""
+    if not counts.count:
         return "\n=== EVENTOS ===\nNo hay eventos recientes."
     
     event_labels = {
@@ -357,69 +407,56 @@ def format_events_for_context(events: list) -> str:
         'maintenance': 'Mantenimiento requerido'
     }
     
-    lines = [f"\n=== EVENTOS ({len(events)} registros) ==="]
-    
-    # Agrupar eventos por tipo
-    event_counts = {}
-    alarms = []
-    important_events = []
-    
-    for e in events:
-        event_type = e.get('type', 'unknown')
-        event_counts[event_type] = event_counts.get(event_type, 0) + 1
-        
-        # Guardar alarmas y eventos importantes
-        if event_type == 'alarm':
-            alarm_type = e.get('attributes', {}).get('alarm', 'desconocida')
-            alarms.append({
-                'time': format_datetime(e.get('eventTime')),
-                'type': alarm_type
-            })
-        elif event_type in ['deviceOverspeed', 'ignitionOn', 'ignitionOff', 'deviceMoving']:
-            important_events.append({
-                'time': format_datetime(e.get('eventTime')),
-                'type': event_labels.get(event_type, event_type)
-            })
+    lines = [f"\n=== EVENTOS ({counts.count} registros) ==="]
     
     # Resumen de eventos
     lines.append("Resumen:")
-    for event_type, count in sorted(event_counts.items(), key=lambda x: x[1], reverse=True):
+    for event_type, count in sorted(counts.by_type.items(), key=lambda x: x[1], reverse=True):
         label = event_labels.get(event_type, event_type)
         lines.append(f"  - {label}: {count}")
     
     # Mostrar alarmas (importantes)
-    if alarms:
-        lines.append("\n⚠️ ALARMAS DETECTADAS:")
-        for alarm in alarms:
+    if counts.alarms:
+        shown = len(counts.alarms)
+        suffix = f" (las últimas {shown} de {counts.alarm_count})" if counts.alarm_count > shown else ""
+        lines.append(f"\n⚠️ ALARMAS DETECTADAS{suffix}:")
+        for event_time, alarm_type in counts.alarms:
             alarm_desc = {
                 'hardBraking': 'Frenado brusco',
                 'hardAcceleration': 'Aceleración brusca',
                 'hardCornering': 'Giro brusco',
                 'overspeed': 'Exceso de velocidad'
-            }.get(alarm['type'], alarm['type'])
-            lines.append(f"  - {alarm['time']}: {alarm_desc}")
+            }.get(alarm_type, alarm_type)
+            lines.append(f"  - {format_datetime(event_time)}: {alarm_desc}")
     
     # Mostrar eventos importantes recientes
-    if important_events:
+    if counts.important:
         lines.append("\nEventos importantes recientes:")
-        for evt in important_events[-5:]:
-            lines.append(f"  - {evt['time']}: {evt['type']}")
+        for event_time, event_type in counts.important:
+            lines.append(f"  - {format_datetime(event_time)}: {event_labels.get(event_type, event_type)}")
     
     return "\n".join(lines)
 
 
 def format_trips_for_context(trips: list) -> str:
     """Formatea los viajes para incluir en el contexto"""
-    if not trips:
+    totals = TripTotals()
+    for t in trips or []:
+        totals.add(t)
+    return format_trip_totals(totals)
+
+
+def format_trip_totals(totals: TripTotals) -> str:
+    """Viajes a partir de sus agregados (totales y los últimos viajes)"""
+    if not totals.count:
         return "\n=== VIAJES ===\nNo hay viajes registrados."
     
-    lines = [f"\n=== VIAJES ({len(trips)} registrados) ==="]
-    
-    total_distance = 0
-    total_duration = 0
-    max_speed_all = 0
+    lines = [f"\n=== VIAJES ({totals.count} registrados) ==="]
+    first_listed = totals.count - len(totals.recent) + 1
+    if first_listed > 1:
+        lines.append(f"Se detallan los últimos {len(totals.recent)}.")
     
-    for i, trip in enumerate(trips, 1):
+    for i, trip in enumerate(totals.recent, first_listed):
         start_time = format_datetime(trip.get('startTime'))
         end_time = format_datetime(trip.get('endTime'))
         distance_km = round(trip.get('distance', 0) / 1000, 2)
@@ -427,11 +464,6 @@ def format_trips_for_context(trips: list) -> str:
         avg_speed = knots_to_kmh(trip.get('averageSpeed', 0))
         max_speed = knots_to_kmh(trip.get('maxSpeed', 0))
         
-        total_distance += trip.get('distance', 0)
-        total_duration += trip.get('duration', 0)
-        if max_speed > max_speed_all:
-            max_speed_all = max_speed
-        
         lines.append(f"\nViaje {i}:")
         lines.append(f"  - Inicio: {start_time}")
         lines.append(f"  - Fin: {end_time}")
@@ -446,46 +478,222 @@ def format_trips_for_context(trips: list) -> str:
             lines.append(f"  - Hasta: {trip.get('endLat'):.4f}, {trip.get('endLon'):.4f}")
     
     # Totales
-    if len(trips) > 1:
+    if totals.count > 1:
         lines.append(f"\nTOTALES:")
-        lines.append(f"  - Distancia total: {round(total_distance/1000, 2)} km")
-        lines.append(f"  - Tiempo total: {format_duration(total_duration)}")
-        lines.append(f"  - Velocidad máxima alcanzada: {max_speed_all} km/h")
+        lines.append(f"  - Distancia total: {round(totals.distance/1000, 2)} km")
+        lines.append(f"  - Tiempo total: {format_duration(totals.duration)}")
+        lines.append(f"  - Velocidad máxima alcanzada: {knots_to_kmh(totals.max_speed)} km/h")
+    
+    return "\n".join(lines)
+
+
+def format_places_for_context(places: list) -> str:
+    """Formatea las zonas donde el vehículo pasó más tiempo detenido"""
+    if not places:
+        return ""
+    
+    lines = ["\n=== ZONAS MÁS FRECUENTES (detenido) ==="]
+    for place in places:
+        lines.append(
+            f"  - {place['latitude']:.4f}, {place['longitude']:.4f}: "
+            f"{place['count']} registros (entre {format_datetime(place.get('first_time'))} "
+            f"y {format_datetime(place.get('last_time'))})"
+        )
+    return "\n".join(lines)
+
+
+def format_behaviour_for_context(behaviour: dict) -> str:
+    """Formatea la conducción brusca detectada a partir de las posiciones"""
+    if not behaviour:
+        return ""
+    summary = behaviour['summary']
+    labels = {
+        'hardAcceleration': 'Aceleraciones bruscas',
+        'hardBraking': 'Frenadas bruscas',
+        'hardCornering': 'Giros bruscos',
+    }
+    
+    lines = ["\n=== CONDUCCIÓN (detectada a partir de velocidad y rumbo) ==="]
+    for kind, label in labels.items():
+        lines.append(f"  - {label}: {summary[kind]}")
+    if summary.get('harsh_per_100km') is not None:
+        lines.append(f"  - Eventos bruscos cada 100 km: {summary['harsh_per_100km']}")
+    lines.append(
+        f"  - Excesos de velocidad: {summary['overspeed']} "
+        f"({format_duration(summary['overspeed_time'] * 1000)} en total)"
+    )
+    lines.append(
+        f"  - Ralentí prolongado (más de 5 min): {summary['long_idle']} "
+        f"({format_duration(summary['long_idle_time'] * 1000)} en total)"
+    )
+    
+    events = behaviour.get('events', [])
+    if events:
+        event_labels = {
+            'hardAcceleration': 'Aceleración brusca',
+            'hardBraking': 'Frenado brusco',
+            'hardCornering': 'Giro brusco',
+        }
+        lines.append("\nÚltimos eventos bruscos:")
+        for e in events[-5:]:
+            lines.append(
+                f"  - {format_datetime(e['startTime'])}: {event_labels.get(e['type'], e['type'])} "
+                f"({e['peak']} m/s² a {knots_to_kmh(e['speed'])} km/h)"
+            )
+    overspeed = behaviour.get('overspeed', [])
+    if overspeed:
+        worst = max(overspeed, key=lambda s: s['maxSpeed'])
+        lines.append(
+            f"\nMayor exceso: {knots_to_kmh(worst['maxSpeed'])} km/h "
+            f"(límite {knots_to_kmh(worst['speedLimit'])} km/h) el {format_datetime(worst['startTime'])}, "
+            f"durante {format_duration(worst['duration'])}"
+        )
+    
+    return "\n".join(lines)
+
+
+def format_daily_rollups_for_context(daily: dict) -> str:
+    """Formatea los totales de los días anteriores (resúmenes diarios materializados)"""
+    if not daily or not (daily.get('days') or daily.get('missing_days')):
+        return ""
+    
+    lines = [f"\n=== RESUMEN DE LOS {daily['days']} DÍAS ANTERIORES (sin contar hoy) ==="]
+    missing = daily.get('missing_days')
+    if missing:
+        lines.append(
+            f"  - ⚠️ Sin datos de {len(missing)} día(s) que no se pudieron descargar "
+            f"({', '.join(missing)}): los totales no los incluyen"
+        )
+    lines.append(f"  - Distancia total: {round(daily['distance'] / 1000, 2)} km")
+    lines.append(f"  - Tiempo de conducción: {format_duration(daily['driving_time'] * 1000)}")
+    lines.append(f"  - Tiempo en ralentí (motor encendido detenido): {format_duration(daily['idle_time'] * 1000)}")
+    lines.append(f"  - Viajes: {daily['trips_count']}")
+    lines.append(f"  - Velocidad máxima: {knots_to_kmh(daily['max_speed'])} km/h")
+    
+    if daily['alarm_count']:
+        alarms = ", ".join(f"{name}: {count}" for name, count in daily['alarms'].items())
+        lines.append(f"  - ⚠️ Alarmas: {daily['alarm_count']} ({alarms})")
+    
+    behaviour = daily.get('behaviour')
+    if behaviour:
+        harsh = behaviour['hardAcceleration'] + behaviour['hardBraking'] + behaviour['hardCornering']
+        lines.append(
+            f"  - Conducción brusca detectada: {harsh} eventos "
+            f"(aceleraciones {behaviour['hardAcceleration']}, frenadas {behaviour['hardBraking']}, "
+            f"giros {behaviour['hardCornering']}), {behaviour['overspeed']} excesos de velocidad, "
+            f"{behaviour['long_idle']} ralentís prolongados"
+        )
+    
+    obd_labels = {
+        'io36': 'RPM',
+        'io32': 'Temperatura refrigerante (°C)',
+        'io31': 'Carga del motor (%)',
+        'io43': 'Nivel combustible (%)',
+    }
+    for field, label in obd_labels.items():
+        s = daily['obd'].get(field)
+        if s:
+            lines.append(f"  - {label}: mín {s['min']}, máx {s['max']}, promedio {s['avg']}")
     
     return "\n".join(lines)
 
 
 def build_vehicle_context(
     device: dict,
-    positions: list,
-    events: list,
-    trips: list
+    context: VehicleContext,
+    places: list = None,
+    daily: dict = None
 ) -> str:
     """Construye el contexto completo del vehículo para el prompt"""
     sections = [
         format_device_for_context(device),
-        format_current_position(positions),
-        format_positions_summary(positions),
-        format_events_for_context(events),
-        format_trips_for_context(trips)
+        format_current_fix(context.latest.position, context.obd.result()),
+        format_speed_summary(context.speeds),
+        format_event_counts(context.events),
+        format_trip_totals(context.trips)
     ]
     
+    if places:
+        sections.append(format_places_for_context(places))
+    if context.behaviour:
+        sections.append(format_behaviour_for_context(context.behaviour))
+    if daily:
+        sections.append(format_daily_rollups_for_context(daily))
+    
+    return "\n".join(sections)
+
+
+def format_fleet_row(summary: dict) -> str:
+    """Una línea de la tabla de la flota con las métricas de un vehículo"""
+    name = f"{summary['name']} (id {summary['deviceId']})"
+    if summary.get('error'):
+        return f"- {name}: sin datos ({summary['error']})"
+    m = summary['metrics']
+    parts = [
+        "en línea" if m['status'] == 'online' else "desconectado",
+        f"{round(m['distance'] / 1000, 1)} km",
+        f"{m['trips']} viajes",
+        f"{format_duration(m['drivingTime'])} conduciendo",
+        f"vel. máx {knots_to_kmh(m['maxSpeed'])} km/h",
+        f"{m['alarms']} alarmas",
+        f"{m['overspeed']} excesos",
+        f"{m['harsh']} eventos bruscos",
+    ]
+    if m.get('fuel') is not None:
+        parts.append(f"combustible {m['fuel']}%")
+    parts.append(f"última conexión {format_datetime(m['lastUpdate'])}")
+    return f"- {name}: " + ", ".join(parts)
+
+
+def format_fleet_vehicle(device: dict, context: VehicleContext) -> str:
+    """Detalle de un vehículo dentro del contexto de la flota"""
+    sections = [
+        f"\n##### {device.get('name', 'N/A')} (id {device.get('id')}) #####",
+        format_speed_summary(context.speeds),
+        format_event_counts(context.events),
+        format_trip_totals(context.trips),
+    ]
+    if context.behaviour:
+        sections.append(format_behaviour_for_context(context.behaviour))
     return "\n".join(sections)
 
 
+def build_messages(
+    system_prompt: str,
+    data_prompt: str,
+    user_message: str,
+    conversation_history: list = None,
+    conversation_summary: str = None
+) -> list:
+    """
+    Mensajes en orden de estabilidad: prompt de sistema, resumen e historial
+    (iguales al turno anterior salvo lo agregado al final) y luego los datos
+    del vehículo y la pregunta, que cambian en cada turno.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if conversation_summary:
+        messages.append({"role": "system", "content": SUMMARY_PROMPT.format(summary=conversation_summary)})
+    if conversation_history:
+        messages.extend(conversation_history)
+    messages.append({"role": "system", "content": data_prompt})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
 async def chat_with_vehicle(
     user_message: str,
     device: dict,
-    positions: list,
-    events: list,
-    trips: list,
-    conversation_history: list = None
+    context: VehicleContext,
+    places: list = None,
+    daily: dict = None,
+    conversation_history: list = None,
+    conversation_summary: str = None
 ) -> str:
     """
-    Envía un mensaje al chat de IA con el contexto del vehículo.
+    Envía un mensaje al chat de IA con el contexto del vehículo (agregados de
+    posiciones, eventos y viajes; ver context_aggregators.py).
     """
-    vehicle_context = build_vehicle_context(device, positions, events, trips)
-    system_prompt = SYSTEM_PROMPT.format(vehicle_context=vehicle_context)
+    vehicle_context = build_vehicle_context(device, context, places, daily)
     
     # Debug: imprimir contexto
     print("=" * 50)
@@ -494,23 +702,141 @@ async def chat_with_vehicle(
     print(vehicle_context)
     print("=" * 50)
     
-    messages = [{"role": "system", "content": system_prompt}]
+    messages = build_messages(
+        SYSTEM_PROMPT,
+        VEHICLE_DATA_PROMPT.format(vehicle_context=vehicle_context),
+        user_message,
+        conversation_history,
+        conversation_summary
+    )
     
-    # Agregar historial de conversación si existe
-    if conversation_history:
-        messages.extend(conversation_history)
+    try:
+        response = await create_completion(
+            model="gpt-4o",
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1000
+        )
+        
+        return response.choices[0].message.content
+    except Exception as e:
+        raise Exception(f"Error al comunicarse con OpenAI: {str(e)}")
+
+
+async def chat_with_vehicle_tools(
+    user_message: str,
+    device: dict,
+    toolbox,
+    hours: int = 24,
+    conversation_history: list = None,
+    conversation_summary: str = None
+) -> str:
+    """
+    Chat con el vehículo en modo herramientas: el prompt solo lleva la ficha del
+    dispositivo y el modelo pide los datos que necesita a través de `toolbox`
+    (objeto con `definitions` y `execute(name, arguments)`).
+    """
+    data_prompt = TOOLS_DATA_PROMPT.format(
+        vehicle_context=format_device_for_context(device),
+        hours=hours
+    )
+    messages = build_messages(
+        TOOLS_SYSTEM_PROMPT, data_prompt, user_message, conversation_history, conversation_summary
+    )
     
-    # Agregar mensaje actual del usuario
-    messages.append({"role": "user", "content": user_message})
+    try:
+        for _ in range(MAX_TOOL_ROUNDS):
+            response = await create_completion(
+                model="gpt-4o",
+                messages=messages,
+                tools=toolbox.definitions,
+                temperature=0.7,
+                max_tokens=1000
+            )
+            message = response.choices[0].message
+            
+            if not message.tool_calls:
+                return message.content
+            
+            messages.append({
+                "role": "assistant",
+                "content": message.content,
+                "tool_calls": [
+                    {
+                        "id": call.id,
+                        "type": "function",
+                        "function": {"name": call.function.name, "arguments": call.function.arguments}
+                    }
+                    for call in message.tool_calls
+                ]
+            })
+            for call in message.tool_calls:
+                print(f"Tool call: {call.function.name}({call.function.arguments})")
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": call.id,
+                    # Las herramientas piden datos a Traccar (bloqueante): fuera del loop
+                    "content": await asyncio.to_thread(toolbox.execute, call.function.name, call.function.arguments)
+                })
+        
+        # Demasiadas rondas: pedir una respuesta final sin herramientas
+        response = await create_completion(
+            model="gpt-4o",
+            messages=messages,
+            temperature=0.7,
+            max_tokens=1000
+        )
+        return response.choices[0].message.content
+    except Exception as e:
+        raise Exception(f"Error al comunicarse con OpenAI: {str(e)}")
+
+
+async def chat_with_fleet(
+    user_message: str,
+    fleet_context: str,
+    conversation_history: list = None,
+    conversation_summary: str = None
+) -> str:
+    """Chat sobre toda la flota (contexto armado por fleet_context.build_fleet_context)"""
+    messages = build_messages(
+        FLEET_SYSTEM_PROMPT,
+        FLEET_DATA_PROMPT.format(fleet_context=fleet_context),
+        user_message,
+        conversation_history,
+        conversation_summary
+    )
     
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
             model="gpt-4o",
             messages=messages,
             temperature=0.7,
             max_tokens=1000
         )
-        
+        return response.choices[0].message.content
+    except Exception as e:
+        raise Exception(f"Error al comunicarse con OpenAI: {str(e)}")
+
+
+async def summarize_conversation(previous_summary: str, messages: list) -> str:
+    """Condensa mensajes antiguos (y el resumen anterior, si hay) en un resumen nuevo"""
+    transcript = []
+    if previous_summary:
+        transcript.append(f"Resumen previo: {previous_summary}")
+    for m in messages:
+        speaker = "Usuario" if m['role'] == 'user' else "AutoAssist"
+        transcript.append(f"{speaker}: {m['content']}")
+    
+    try:
+        response = await create_completion(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SUMMARIZE_PROMPT},
+                {"role": "user", "content": "\n".join(transcript)}
+            ],
+            temperature=0,
+            max_tokens=400
+        )
         return response.choices[0].message.content
     except Exception as e:
         raise Exception(f"Error al comunicarse con OpenAI: {str(e)}")
@@ -0,0 +1,354 @@
+"""
+Detección de conducción brusca a partir del historial de posiciones, para los
+equipos que no envían alarmas propias: aceleraciones, frenadas y giros bruscos,
+tramos de exceso de velocidad y ralentí prolongado.
+
+El historial se pasa primero a columnas (tiempo, velocidad, rumbo, motor) y
+las detecciones se hacen sobre las diferencias entre muestras consecutivas, en
+una sola pasada. Con numpy las diferencias, los umbrales y los tramos son
+vectorizados; sin numpy se usa el mismo cálculo en Python.
+Los resultados usan las unidades de Traccar: velocidades en nudos, distancias
+en metros y duraciones en milisegundos.
+"""
+import math
+from typing import Optional
+
+from trip_detector import parse_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+KNOT_MS = 0.514444                 # 1 nudo en m/s
+KNOTS_PER_KMH = 1 / 1.852
+
+HARSH_ACCELERATION = 3.0           # m/s² (~0.3 g)
+HARSH_BRAKING = 3.5                # m/s² de desaceleración
+HARSH_CORNERING = 3.0              # m/s² de aceleración lateral
+MIN_CORNERING_SPEED = 5.0          # m/s; por debajo son maniobras de estacionamiento
+MAX_SAMPLE_GAP = 5.0               # s; con muestras más separadas no se estima aceleración
+
+DEFAULT_SPEED_LIMIT_KMH = 100
+OVERSPEED_MIN_SECONDS = 10         # Tramos más cortos se consideran picos del GPS
+OVERSPEED_MAX_GAP = 60.0           # s sin datos que cortan un tramo
+
+IDLE_SPEED_KNOTS = 1.0             # Mismo umbral de movimiento que TripDetector
+LONG_IDLE_SECONDS = 300
+MAX_IDLE_GAP = 300.0
+
+HARSH_TYPES = ("hardAcceleration", "hardBraking", "hardCornering")
+NUMPY_MIN_SAMPLES = 64             # Con historiales más cortos Python puro es más rápido
+
+
+def _columns(positions: list) -> tuple:
+    """Convierte las posiciones en columnas ordenadas por tiempo"""
+    # Listas paralelas en lugar de tuplas (tiempo, posición): con historiales de
+    # cientos de miles de posiciones, las tuplas disparan el recolector de basura
+    times = []
+    rows = []
+    for p in positions:
+        t = parse_time(p.get('fixTime'))
+        if t is not None:
+            times.append(t.timestamp())
+            rows.append(p)
+    if any(b < a for a, b in zip(times, times[1:])):
+        order = sorted(range(len(times)), key=times.__getitem__)
+        times = [times[i] for i in order]
+        rows = [rows[i] for i in order]
+
+    attrs = [p.get('attributes') or {} for p in rows]
+    speeds = [(p.get('speed') or 0) * KNOT_MS for p in rows]
+    # La velocidad OBD (io37, km/h) es más precisa que la del GPS para aceleraciones
+    obd_speeds = [a.get('io37') for a in attrs]
+    courses = [p.get('course') for p in rows]
+    engine = [
+        a['ignition'] if 'ignition' in a else ((a.get('io36') or 0) > 0 if 'io36' in a else None)
+        for a in attrs
+    ]
+    return times, rows, speeds, obd_speeds, courses, engine
+
+
+def _course_delta(a, b) -> float:
+    """Diferencia de rumbo en radianes, en (-pi, pi]"""
+    delta = (b - a + 180) % 360 - 180
+    return math.radians(delta)
+
+
+def _event(kind: str, rows: list, times: list, start: int, end: int, peak: float, device_id) -> dict:
+    first = rows[start]
+    return {
+        'type': kind,
+        'deviceId': device_id if device_id is not None else first.get('deviceId'),
+        'startTime': first.get('fixTime'),
+        'endTime': rows[end].get('fixTime'),
+        'duration': int((times[end] - times[start]) * 1000),
+        'peak': round(peak, 2),
+        'speed': first.get('speed') or 0,
+        'latitude': first.get('latitude'),
+        'longitude': first.get('longitude'),
+        'positionId': first.get('id'),
+    }
+
+
+def _runs(indices: list) -> list:
+    """Agrupa índices consecutivos en tramos [inicio, fin]"""
+    runs = []
+    for j in indices:
+        if runs and runs[-1][1] == j - 1:
+            runs[-1][1] = j
+        else:
+            runs.append([j, j])
+    return runs
+
+
+def _harsh_series(times, speeds, obd_speeds, courses) -> tuple:
+    """Aceleración longitudinal y lateral (m/s²) de cada par de muestras consecutivas"""
+    dts = [b - a for a, b in zip(times, times[1:])]
+    valid = [0 < dt <= MAX_SAMPLE_GAP for dt in dts]
+    gps_dv = [b - a for a, b in zip(speeds, speeds[1:])]
+    obd_dv = [
+        (b - a) / 3.6 if a is not None and b is not None else None
+        for a, b in zip(obd_speeds, obd_speeds[1:])
+    ]
+    accels = [
+        ((o if o is not None else g) / dt) if ok else 0.0
+        for g, o, dt, ok in zip(gps_dv, obd_dv, dts, valid)
+    ]
+    laterals = [
+        abs((v0 + v1) / 2 * _course_delta(c0, c1) / dt)
+        if ok and c0 != c1 and c0 is not None and c1 is not None and v0 + v1 >= 2 * MIN_CORNERING_SPEED
+        else 0.0
+        for v0, v1, c0, c1, dt, ok in zip(speeds, speeds[1:], courses, courses[1:], dts, valid)
+    ]
+    return accels, laterals
+
+
+def _as_array(values: list):
+    """Columna numpy con NaN donde falta el dato"""
+    return np.array([np.nan if x is None else x for x in values], dtype=float)
+
+
+def _harsh_series_numpy(t, v, obd_speeds, courses) -> tuple:
+    """Mismo cálculo que _harsh_series sobre arrays (t y v ya son numpy)"""
+    dts = np.diff(t)
+    valid = (dts > 0) & (dts <= MAX_SAMPLE_GAP)
+    safe_dts = np.where(valid, dts, 1.0)
+    obd_dv = np.diff(_as_array(obd_speeds)) / 3.6
+    dv = np.where(np.isnan(obd_dv), np.diff(v), obd_dv)
+    accels = np.where(valid, dv / safe_dts, 0.0)
+
+    c = _as_array(courses)
+    c0, c1 = c[:-1], c[1:]
+    v_sum = v[:-1] + v[1:]
+    turning = valid & (c0 != c1) & ~np.isnan(c0) & ~np.isnan(c1) & (v_sum >= 2 * MIN_CORNERING_SPEED)
+    delta = np.radians(np.mod(c1 - c0 + 180, 360) - 180)
+    with np.errstate(invalid="ignore"):
+        laterals = np.where(turning, np.abs(v_sum / 2 * delta / safe_dts), 0.0)
+    return accels, laterals
+
+
+def _runs_numpy(hits) -> list:
+    """_runs sobre un array de índices ordenados"""
+    if not len(hits):
+        return []
+    breaks = np.flatnonzero(np.diff(hits) != 1)
+    starts = np.r_[hits[0], hits[breaks + 1]]
+    ends = np.r_[hits[breaks], hits[-1]]
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _harsh_events(times, rows, speeds, obd_speeds, courses, device_id, arrays=None) -> list:
+    """
+    Aceleraciones, frenadas y giros bruscos. Se calculan las series de
+    aceleración longitudinal y lateral entre muestras consecutivas, se marcan
+    las que superan el umbral y las marcas seguidas forman un solo evento.
+    `arrays` = (tiempos, velocidades) en numpy para el cálculo vectorizado.
+    """
+    if len(times) < 2:
+        return []
+    if arrays is not None:
+        accels, laterals = _harsh_series_numpy(*arrays, obd_speeds, courses)
+    else:
+        accels, laterals = _harsh_series(times, speeds, obd_speeds, courses)
+
+    series = (
+        ("hardAcceleration", accels, 1, HARSH_ACCELERATION),
+        ("hardBraking", accels, -1, HARSH_BRAKING),
+        ("hardCornering", laterals, 1, HARSH_CORNERING),
+    )
+    events = []
+    for kind, values, sign, threshold in series:
+        if arrays is not None:
+            signed = values * sign
+            runs = _runs_numpy(np.flatnonzero(signed >= threshold))
+            peaks = [float(signed[start:end + 1].max()) for start, end in runs]
+        else:
+            runs = _runs([j for j, x in enumerate(values) if x * sign >= threshold])
+            peaks = [max(values[j] * sign for j in range(start, end + 1)) for start, end in runs]
+        for (start, end), peak in zip(runs, peaks):
+            # El par j abarca las muestras j y j + 1
+            events.append(_event(kind, rows, times, start, end + 1, peak, device_id))
+    events.sort(key=lambda e: e['startTime'] or '')
+    return events
+
+
+def _segments(times: list, flags: list, max_gap: float) -> list:
+    """Tramos [inicio, fin] de muestras seguidas con flag activo"""
+    segments = []
+    start = None
+    for i, flag in enumerate(flags):
+        if flag and start is not None and times[i] - times[i - 1] > max_gap:
+            segments.append((start, i - 1))
+            start = None
+        if flag:
+            if start is None:
+                start = i
+        elif start is not None:
+            segments.append((start, i - 1))
+            start = None
+    if start is not None:
+        segments.append((start, len(flags) - 1))
+    return segments
+
+
+def _segments_numpy(t, flags, max_gap: float) -> list:
+    """_segments sobre arrays: cortes donde cambia el flag o hay un hueco mayor a max_gap"""
+    gap = np.r_[False, np.diff(t) > max_gap]
+    previous = np.r_[False, flags[:-1]]
+    following = np.r_[flags[1:], False]
+    gap_next = np.r_[gap[1:], False]
+    starts = np.flatnonzero(flags & (~previous | gap))
+    ends = np.flatnonzero(flags & (~following | gap_next))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _flag_segments(times, flags, max_gap: float, arrays) -> list:
+    if arrays is not None:
+        return _segments_numpy(arrays[0], np.asarray(flags, dtype=bool), max_gap)
+    return _segments(times, flags, max_gap)
+
+
+def _overspeed(times, rows, speeds, limit_knots: float, device_id, arrays=None) -> list:
+    limit_ms = limit_knots * KNOT_MS
+    flags = arrays[1] > limit_ms if arrays is not None else [v > limit_ms for v in speeds]
+    result = []
+    for start, end in _flag_segments(times, flags, OVERSPEED_MAX_GAP, arrays):
+        duration = times[end] - times[start]
+        if duration < OVERSPEED_MIN_SECONDS:
+            continue
+        distance = sum(
+            speeds[i] * (times[i] - times[i - 1])
+            for i in range(start + 1, end + 1)
+        )
+        first = rows[start]
+        result.append({
+            'deviceId': device_id if device_id is not None else first.get('deviceId'),
+            'startTime': first.get('fixTime'),
+            'endTime': rows[end].get('fixTime'),
+            'duration': int(duration * 1000),
+            'distance': round(distance, 1),
+            'maxSpeed': round(max(speeds[start:end + 1]) / KNOT_MS, 1),
+            'speedLimit': round(limit_knots, 1),
+            'latitude': first.get('latitude'),
+            'longitude': first.get('longitude'),
+        })
+    return result
+
+
+def _long_idling(times, rows, speeds, engine, device_id, arrays=None) -> list:
+    idle_ms = IDLE_SPEED_KNOTS * KNOT_MS
+    flags = [bool(on) and v < idle_ms for on, v in zip(engine, speeds)]
+    result = []
+    for start, end in _flag_segments(times, flags, MAX_IDLE_GAP, arrays):
+        duration = times[end] - times[start]
+        if duration < LONG_IDLE_SECONDS:
+            continue
+        first = rows[start]
+        result.append({
+            'deviceId': device_id if device_id is not None else first.get('deviceId'),
+            'startTime': first.get('fixTime'),
+            'endTime': rows[end].get('fixTime'),
+            'duration': int(duration * 1000),
+            'latitude': first.get('latitude'),
+            'longitude': first.get('longitude'),
+        })
+    return result
+
+
+def speed_limit_for_device(device: Optional[dict], speed_limit_kmh: Optional[float] = None) -> float:
+    """Límite en nudos: el pedido, el configurado en Traccar (speedLimit) o el por defecto"""
+    if speed_limit_kmh:
+        return speed_limit_kmh * KNOTS_PER_KMH
+    device_limit = ((device or {}).get('attributes') or {}).get('speedLimit')
+    if device_limit:
+        return float(device_limit)
+    return DEFAULT_SPEED_LIMIT_KMH * KNOTS_PER_KMH
+
+
+def detect_behaviour(positions: list, device_id: Optional[int] = None,
+                     speed_limit: Optional[float] = None) -> dict:
+    """
+    Analiza un historial de posiciones. `speed_limit` en nudos (ver
+    speed_limit_for_device). Retorna eventos bruscos, tramos de exceso de
+    velocidad, ralentís prolongados y un resumen.
+    """
+    if speed_limit is None:
+        speed_limit = DEFAULT_SPEED_LIMIT_KMH * KNOTS_PER_KMH
+    times, rows, speeds, obd_speeds, courses, engine = _columns(positions)
+    arrays = None
+    if np is not None and len(times) >= NUMPY_MIN_SAMPLES:
+        arrays = (np.asarray(times, dtype=float), np.asarray(speeds, dtype=float))
+
+    events = _harsh_events(times, rows, speeds, obd_speeds, courses, device_id, arrays)
+    overspeed = _overspeed(times, rows, speeds, speed_limit, device_id, arrays)
+    idling = _long_idling(times, rows, speeds, engine, device_id, arrays)
+
+    if arrays is not None:
+        t, v = arrays
+        dts = np.diff(t)
+        moving = (dts > 0) & (dts <= OVERSPEED_MAX_GAP)
+        distance = float(np.sum(((v[:-1] + v[1:]) / 2 * dts)[moving]))
+    else:
+        distance = sum([
+            (v0 + v1) / 2 * (t1 - t0)
+            for v0, v1, t0, t1 in zip(speeds, speeds[1:], times, times[1:])
+            if 0 < t1 - t0 <= OVERSPEED_MAX_GAP
+        ])
+    return {
+        'events': events,
+        'overspeed': overspeed,
+        'idling': idling,
+        'summary': summarize_behaviour(events, overspeed, idling, distance),
+    }
+
+
+def summarize_behaviour(events: list, overspeed: list, idling: list, distance: float) -> dict:
+    counts = {kind: 0 for kind in HARSH_TYPES}
+    for e in events:
+        counts[e['type']] += 1
+    harsh_total = sum(counts.values())
+    return {
+        **counts,
+        'overspeed': len(overspeed),
+        'overspeed_time': int(sum(s['duration'] for s in overspeed) / 1000),
+        'long_idle': len(idling),
+        'long_idle_time': int(sum(s['duration'] for s in idling) / 1000),
+        'distance': round(distance, 1),
+        # Eventos bruscos cada 100 km, para comparar vehículos y períodos
+        'harsh_per_100km': round(harsh_total / (distance / 100000), 2) if distance >= 1000 else None,
+    }
+
+
+def merge_behaviour_summaries(summaries: list) -> dict:
+    """Suma resúmenes de varios períodos (p. ej. los de los resúmenes diarios)"""
+    totals = {key: 0 for key in (*HARSH_TYPES, 'overspeed', 'overspeed_time', 'long_idle', 'long_idle_time')}
+    distance = 0.0
+    for s in summaries:
+        for key in totals:
+            totals[key] += s.get(key, 0)
+        distance += s.get('distance', 0)
+    harsh_total = sum(totals[kind] for kind in HARSH_TYPES)
+    totals['distance'] = round(distance, 1)
+    totals['harsh_per_100km'] = round(harsh_total / (distance / 100000), 2) if distance >= 1000 else None
+    return totals
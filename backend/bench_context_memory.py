@@ -0,0 +1,139 @@
+"""
+Benchmark de memoria del contexto del chat en streaming: genera historiales
+sintéticos (una posición cada 10 s con datos OBD, más eventos) y los pasa como
+bytes JSON por iter_json_array y los agregadores de context_aggregators.
+
+    python bench_context_memory.py --days 30 --max-peak-mb 40
+
+Mide el pico de memoria (tracemalloc) con un día y con la ventana pedida.
+Termina con código 1 si el pico supera --max-peak-mb o si crece con la ventana
+más de --max-growth veces, para usarlo en CI.
+"""
+import argparse
+import json
+import math
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from context_aggregators import VehicleContext
+from traccar_service import iter_json_array, STREAM_CHUNK_BYTES
+
+SAMPLE_SECONDS = 10
+EVENTS_PER_HOUR = 6
+
+
+def synthetic_positions(days: int, sample_seconds: int = SAMPLE_SECONDS):
+    """Posiciones de un vehículo que alterna 40 min de viaje y 20 min detenido"""
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    lat, lon = -33.45, -70.66
+    for i in range(days * 86400 // sample_seconds):
+        t = start + timedelta(seconds=i * sample_seconds)
+        moving = (i * sample_seconds // 60) % 60 < 40
+        speed = 25 + 10 * math.sin(i / 30) if moving else 0.0
+        if moving:
+            lat += 0.0001 * math.cos(i / 500)
+            lon += 0.0001 * math.sin(i / 500)
+        yield {
+            'id': i + 1,
+            'deviceId': 1,
+            'fixTime': t.strftime('%Y-%m-%dT%H:%M:%S.000+00:00'),
+            'serverTime': t.strftime('%Y-%m-%dT%H:%M:%S.000+00:00'),
+            'latitude': round(lat, 6),
+            'longitude': round(lon, 6),
+            'speed': round(speed, 2),
+            'course': (i * 3) % 360,
+            'valid': True,
+            'attributes': {
+                'ignition': moving,
+                'motion': moving,
+                'io36': 2100 if moving else 800,
+                'io32': 88,
+                'io43': 60 - i % 40,
+                'io389': 120000 + i // 100,
+            },
+        }
+
+
+def synthetic_events(days: int):
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    types = ('ignitionOn', 'deviceMoving', 'deviceStopped', 'ignitionOff', 'alarm', 'deviceOverspeed')
+    for i in range(days * 24 * EVENTS_PER_HOUR):
+        t = start + timedelta(minutes=i * 60 // EVENTS_PER_HOUR)
+        event_type = types[i % len(types)]
+        yield {
+            'id': i + 1,
+            'deviceId': 1,
+            'type': event_type,
+            'eventTime': t.strftime('%Y-%m-%dT%H:%M:%S.000+00:00'),
+            'attributes': {'alarm': 'hardBraking'} if event_type == 'alarm' else {},
+        }
+
+
+def as_json_chunks(items):
+    """Serializa un iterable como arreglo JSON en chunks de bytes, como llegaría de Traccar"""
+    buffer = [b'[']
+    size = 1
+    first = True
+    for item in items:
+        data = (b'' if first else b',') + json.dumps(item).encode('utf-8')
+        first = False
+        buffer.append(data)
+        size += len(data)
+        if size >= STREAM_CHUNK_BYTES:
+            joined = b''.join(buffer)
+            yield joined[:STREAM_CHUNK_BYTES]
+            buffer = [joined[STREAM_CHUNK_BYTES:]]
+            size = len(buffer[0])
+    buffer.append(b']')
+    yield b''.join(buffer)
+
+
+def run(days: int) -> tuple:
+    """(pico en MB, segundos, contexto) de una ventana de `days` días"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    context = VehicleContext(device_id=1, speed_limit=54.0, detect=True)
+    for p in iter_json_array(as_json_chunks(synthetic_positions(days))):
+        context.add_position(p)
+    for e in iter_json_array(as_json_chunks(synthetic_events(days))):
+        context.add_event(e)
+    context.finish()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, elapsed, context
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mide la memoria del contexto del chat en streaming")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--max-peak-mb", type=float, default=40.0)
+    parser.add_argument("--max-growth", type=float, default=2.0,
+                        help="Pico de la ventana completa / pico de un día")
+    args = parser.parse_args()
+
+    failures = []
+    peaks = {}
+    for days in (1, args.days):
+        peak, elapsed, context = run(days)
+        peaks[days] = peak
+        print(f"{days:>3} días: {context.speeds.count} posiciones, {context.events.count} eventos, "
+              f"{context.trips.count} viajes, pico {peak:.1f} MB, {elapsed:.1f} s")
+        if context.speeds.count != days * 86400 // SAMPLE_SECONDS:
+            failures.append(f"{days} días: se agregaron {context.speeds.count} posiciones")
+
+    if peaks[args.days] > args.max_peak_mb:
+        failures.append(f"pico {peaks[args.days]:.1f} MB > {args.max_peak_mb:.1f} MB")
+    growth = peaks[args.days] / peaks[1]
+    if growth > args.max_growth:
+        failures.append(f"el pico crece {growth:.1f}x con la ventana (máximo {args.max_growth:.1f}x)")
+
+    for failure in failures:
+        print(f"FALLO: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Benchmark del contexto del chat de flota: recorre en streaming el historial
+sintético de N vehículos (como bytes JSON, igual que llegaría de Traccar) con
+collect_fleet y mide el tiempo y el pico de memoria (tracemalloc).
+
+    python bench_fleet_context.py --vehicles 100 --hours 24 --max-peak-mb 80
+
+Termina con código 1 si el pico supera --max-peak-mb, para usarlo en CI.
+"""
+import argparse
+import asyncio
+import sys
+import time
+import tracemalloc
+
+import fleet_context
+from bench_context_memory import SAMPLE_SECONDS, as_json_chunks, synthetic_events, synthetic_positions
+from traccar_service import iter_json_array
+
+
+def synthetic_stream(hours: int):
+    """`stream(device_id, context)` para collect_fleet sobre `hours` horas sintéticas por vehículo"""
+    days = max(1, -(-hours // 24))
+    limit = hours * 3600 // SAMPLE_SECONDS
+
+    def stream(device_id: int, context):
+        positions = (p for _, p in zip(range(limit), synthetic_positions(days)))
+        for p in iter_json_array(as_json_chunks({**p, 'deviceId': device_id} for p in positions)):
+            context.add_position(p)
+        events = (e for e in synthetic_events(days) if e['id'] <= hours * 6)
+        for e in iter_json_array(as_json_chunks({**e, 'deviceId': device_id} for e in events)):
+            context.add_event(e)
+
+    return stream
+
+
+def run(vehicles: int, hours: int) -> tuple:
+    """(pico en MB, segundos, resúmenes) de una flota de `vehicles` vehículos"""
+    devices = [{'id': i, 'name': f'Vehículo {i}', 'status': 'online'} for i in range(1, vehicles + 1)]
+    tracemalloc.start()
+    started = time.perf_counter()
+    summaries = asyncio.run(fleet_context.collect_fleet(devices, synthetic_stream(hours), lambda d: 54.0))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, elapsed, summaries
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mide el armado del contexto de flota")
+    parser.add_argument("--vehicles", type=int, default=100)
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--max-peak-mb", type=float, default=80.0)
+    args = parser.parse_args()
+
+    peak, elapsed, summaries = run(args.vehicles, args.hours)
+    text, info = fleet_context.build_fleet_context(summaries, "¿Qué vehículo tuvo más alarmas?", args.hours)
+    positions = sum(s['metrics']['positions'] for s in summaries if not s.get('error'))
+    print(f"{args.vehicles} vehículos, {positions} posiciones: {elapsed:.1f} s, pico {peak:.1f} MB "
+          f"({info['listed']} en la tabla, {info['detailed']} con detalle, ~{info['estimated_tokens']} tokens)")
+
+    failures = [f"vehículo {s['deviceId']}: {s['error']}" for s in summaries if s.get('error')]
+    if peak > args.max_peak_mb:
+        failures.append(f"pico {peak:.1f} MB > {args.max_peak_mb:.1f} MB")
+    for failure in failures:
+        print(f"FALLO: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
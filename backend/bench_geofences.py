@@ -0,0 +1,74 @@
+"""
+Benchmark del motor de geocercas: evalúa un historial sintético contra muchas
+geocercas (círculos, polígonos y corredores) con numpy y con el cálculo punto
+a punto, y comprueba que ambos den el mismo reporte.
+
+    python bench_geofences.py --positions 100000 --geofences 200
+"""
+import argparse
+import random
+import sys
+import time
+
+import geofences
+from bench_context_memory import synthetic_positions
+
+
+def synthetic_geofences(positions: list, count: int, seed: int = 1) -> list:
+    """Geocercas de Traccar repartidas sobre el recorrido"""
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        p = rng.choice(positions)
+        lat, lon = p['latitude'], p['longitude']
+        if i % 3 == 0:
+            area = f"CIRCLE ({lat} {lon}, {rng.uniform(50, 800):.1f})"
+        elif i % 3 == 1:
+            d = rng.uniform(0.001, 0.01)
+            area = (f"POLYGON(({lat - d} {lon - d}, {lat + d} {lon}, {lat} {lon + d}, "
+                    f"{lat - d / 2} {lon + d / 3}, {lat - d} {lon - d}))")
+        else:
+            area = f"LINESTRING ({lat - 0.01} {lon}, {lat} {lon + 0.005}, {lat + 0.01} {lon})"
+        result.append({'id': i + 1, 'name': f'Geocerca {i + 1}', 'area': area, 'attributes': {}})
+    return result
+
+
+def timed_report(positions: list, fences: list) -> tuple:
+    started = time.perf_counter()
+    report = geofences.geofence_report(positions, fences, device_id=1)
+    return (time.perf_counter() - started) * 1000, report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mide el reporte de geocercas")
+    parser.add_argument("--positions", type=int, default=100000)
+    parser.add_argument("--geofences", type=int, default=200)
+    args = parser.parse_args()
+
+    days = max(1, -(-args.positions * 10 // 86400))
+    positions = [p for _, p in zip(range(args.positions), synthetic_positions(days))]
+    fences = synthetic_geofences(positions, args.geofences)
+    print(f"{len(positions)} posiciones, {len(fences)} geocercas\n")
+
+    numpy_module = geofences.np
+    results = {}
+    if numpy_module is not None:
+        results["numpy"] = timed_report(positions, fences)
+    geofences.np = None
+    try:
+        results["punto a punto"] = timed_report(positions, fences)
+    finally:
+        geofences.np = numpy_module
+
+    for name, (ms, report) in results.items():
+        print(f"  {name:<14} {ms:8.0f} ms  {len(report['visits'])} visitas, {len(report['events'])} eventos")
+
+    reports = [report for _, report in results.values()]
+    if any(report != reports[0] for report in reports[1:]):
+        print("FALLO: los reportes no coinciden")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Benchmark de las respuestas de posiciones: tiempo de serialización (json y
+orjson) y bytes enviados con cada formato (objetos / compacto) y cada
+compresión disponible (sin comprimir, gzip, br, zstd).
+
+    python bench_responses.py --positions 100000
+"""
+import argparse
+import json
+import time
+
+from bench_context_memory import synthetic_positions
+from response_encoding import available_encodings, dumps, encode_positions, orjson
+
+
+def timed(fn, repeat: int = 3):
+    """(mejor tiempo en ms, resultado)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide serialización y compresión de posiciones")
+    parser.add_argument("--positions", type=int, default=100000)
+    args = parser.parse_args()
+
+    days = max(1, -(-args.positions * 10 // 86400))
+    positions = [p for _, p in zip(range(args.positions), synthetic_positions(days))]
+    print(f"{len(positions)} posiciones\n")
+
+    print("Serialización:")
+    ms, _ = timed(lambda: json.dumps({"route": positions}).encode("utf-8"))
+    print(f"  json estándar        {ms:8.0f} ms")
+    if orjson is not None:
+        ms, _ = timed(lambda: dumps({"route": positions}))
+        print(f"  orjson               {ms:8.0f} ms")
+    ms, _ = timed(lambda: dumps({"route": encode_positions(positions, "compact")}))
+    print(f"  compacto (+ orjson)  {ms:8.0f} ms" if orjson else f"  compacto             {ms:8.0f} ms")
+
+    print("\nBytes enviados:")
+    print(f"  {'formato':<10} {'codificación':<13} {'bytes':>12} {'ms':>8}")
+    for encoding in ("objects", "compact"):
+        body = dumps({"route": encode_positions(positions, encoding)})
+        print(f"  {encoding:<10} {'identity':<13} {len(body):>12,} {0:>8}")
+        for encoder_class in available_encodings():
+            ms, compressed = timed(lambda: encoder_class().compress(body, final=True), repeat=1)
+            print(f"  {encoding:<10} {encoder_class.name:<13} {len(compressed):>12,} {ms:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
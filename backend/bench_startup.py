@@ -0,0 +1,107 @@
+"""
+Benchmark de arranque del backend: tiempo de `import main` en un intérprete
+nuevo y tiempo hasta la primera respuesta de /api/health con uvicorn.
+
+    python bench_startup.py --runs 5 --max-import-ms 800 --max-health-ms 2500
+
+Termina con código 1 si se supera algún límite o si al importar main se cargó
+openai (el chat debe cargarse en la primera consulta), para usarlo en CI.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({"import_ms": elapsed * 1000, "openai_loaded": "openai" in sys.modules}))
+"""
+
+
+def measure_import() -> dict:
+    """Importa main en un proceso nuevo (sin módulos ni caché de disco compartidos)"""
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_health(timeout: float = 30.0) -> float:
+    """Milisegundos desde lanzar uvicorn hasta el primer 200 de /api/health"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/api/health"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn terminó con código {process.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - start) * 1000
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError(f"/api/health no respondió en {timeout:.0f} s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mide el arranque del backend")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, help="Límite para la mediana de import main")
+    parser.add_argument("--max-health-ms", type=float, help="Límite para la mediana hasta /api/health")
+    parser.add_argument("--skip-health", action="store_true", help="Solo medir el import")
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    import_ms = statistics.median(r["import_ms"] for r in imports)
+    openai_loaded = any(r["openai_loaded"] for r in imports)
+    print(f"import main:  mediana {import_ms:.0f} ms "
+          f"(min {min(r['import_ms'] for r in imports):.0f}, max {max(r['import_ms'] for r in imports):.0f})")
+
+    failures = []
+    if openai_loaded:
+        failures.append("import main cargó openai")
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        failures.append(f"import main {import_ms:.0f} ms > {args.max_import_ms:.0f} ms")
+
+    if not args.skip_health:
+        health = [measure_health() for _ in range(args.runs)]
+        health_ms = statistics.median(health)
+        print(f"/api/health:  mediana {health_ms:.0f} ms (min {min(health):.0f}, max {max(health):.0f})")
+        if args.max_health_ms and health_ms > args.max_health_ms:
+            failures.append(f"/api/health {health_ms:.0f} ms > {args.max_health_ms:.0f} ms")
+
+    for failure in failures:
+        print(f"FALLO: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Benchmark de /api/telemetry: reduce historiales sintéticos (una posición cada
+10 s con datos OBD) a series para gráficos y compara el tamaño con el de las
+posiciones crudas, con numpy y con el cálculo en Python.
+
+    python bench_telemetry.py --days 1 30 --points 500
+"""
+import argparse
+import sys
+import time
+
+import telemetry
+from bench_context_memory import synthetic_positions
+from response_encoding import dumps
+from trip_detector import parse_time
+
+FIELDS = ["io36", "io32", "io43", "speed"]
+
+
+def same(a, b) -> bool:
+    """Igualdad con tolerancia de un centésimo (numpy suma los promedios en otro orden)"""
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) or isinstance(b, float):
+        return abs(a - b) <= 0.0100001
+    return a == b
+
+
+def run(positions: list, points: int, method: str) -> tuple:
+    """(ms, bytes de la respuesta, resultado)"""
+    from_ms = parse_time(positions[0]['fixTime']).timestamp() * 1000
+    to_ms = parse_time(positions[-1]['fixTime']).timestamp() * 1000
+    started = time.perf_counter()
+    result = telemetry.build_telemetry(positions, FIELDS, from_ms, to_ms, points, method)
+    elapsed = (time.perf_counter() - started) * 1000
+    return elapsed, len(dumps(result)), result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Mide las series de telemetría reducidas")
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 30])
+    parser.add_argument("--points", type=int, default=500)
+    args = parser.parse_args()
+
+    failures = []
+    numpy_module = telemetry.np
+    for days in args.days:
+        positions = list(synthetic_positions(days))
+        print(f"{days} días: {len(positions)} posiciones, {len(dumps(positions)):,} bytes crudos")
+        for method in telemetry.METHODS:
+            results = []
+            for label, module in (("numpy", numpy_module), ("python", None)):
+                if label == "numpy" and numpy_module is None:
+                    continue
+                telemetry.np = module
+                try:
+                    ms, size, result = run(positions, args.points, method)
+                finally:
+                    telemetry.np = numpy_module
+                results.append(result)
+                print(f"  {method:<7} {label:<7} {ms:8.0f} ms {size:>10,} bytes")
+            if any(not same(r, results[0]) for r in results[1:]):
+                failures.append(f"{days} días, {method}: numpy y python no coinciden")
+
+    for failure in failures:
+        print(f"FALLO: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+Backends de caché para sesiones de Traccar, listas de dispositivos, posiciones
+y respuestas del chat.
+
+- MemoryCache: dentro del proceso (por defecto, un solo worker).
+- SQLiteCache: archivo compartido entre varios workers de uvicorn en la misma
+  máquina, de modo que todos reutilizan los logins y datos ya descargados.
+
+Se elige con CACHE_BACKEND=memory|sqlite (y CACHE_PATH para el archivo). Las
+cookies de sesión de Traccar quedan siempre en memoria del proceso
+(get_session_cache): en el archivo compartido permitirían usar la sesión de
+otro usuario a quien pueda leerlo.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Optional
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(os.path.dirname(__file__), "traccar_cache.db"))
+MAX_MEMORY_ENTRIES = 5000
+
+
+class CacheBackend:
+    """Interfaz común: valores con expiración (ttl en segundos)"""
+
+    shared = False
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: float):
+        raise NotImplementedError
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        """Guarda solo si la clave no existe (o expiró). Retorna True si la guardó."""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """Caché en memoria del proceso. Guarda los objetos tal cual."""
+
+    def __init__(self, max_entries: int = MAX_MEMORY_ENTRIES):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def _alive(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._alive(key, time.time())
+            return entry[1] if entry else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        with self._lock:
+            if len(self._data) >= self.max_entries and key not in self._data:
+                self._evict(now)
+            self._data[key] = (now + ttl, value)
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._alive(key, now):
+                return False
+            self._data[key] = (now + ttl, value)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _evict(self, now: float):
+        """Elimina las entradas vencidas o, si no hay, la que vence antes"""
+        expired = [k for k, (exp, _) in self._data.items() if exp < now]
+        for k in expired:
+            del self._data[k]
+        if not expired and self._data:
+            del self._data[min(self._data, key=lambda k: self._data[k][0])]
+
+
+class SQLiteCache(CacheBackend):
+    """Caché compartida entre procesos sobre un archivo SQLite. Los valores se guardan como JSON."""
+
+    shared = True
+
+    def __init__(self, path: str = CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        self._last_purge = 0.0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, separators=(',', ':')), now + ttl)
+            )
+            self._purge(now)
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ? AND expires_at < ?", (key, now))
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, separators=(',', ':')), now + ttl)
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _purge(self, now: float):
+        """Limpia entradas vencidas como mucho una vez por minuto"""
+        if now - self._last_purge > 60:
+            self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            self._last_purge = now
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_cache_backend() -> CacheBackend:
+    """Backend de caché configurado (compartido por todo el proceso)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = SQLiteCache() if CACHE_BACKEND == "sqlite" else MemoryCache()
+    return _backend
+
+
+_session_cache = MemoryCache()
+
+
+def get_session_cache() -> CacheBackend:
+    """Caché de sesiones de Traccar: siempre en memoria, sin importar CACHE_BACKEND"""
+    return _session_cache
@@ -0,0 +1,172 @@
+"""
+Programador de precarga de caché para cuentas activas.
+Registra qué cuentas tienen sesión reciente y qué dispositivos consultaron, y en
+segundo plano mantiene calientes sus últimas 24 h de posiciones, eventos y viajes.
+Respeta un presupuesto de concurrencia por servidor Traccar y se retrae cuando
+el servidor responde lento o con errores.
+"""
+import time
+import asyncio
+import threading
+from typing import Optional
+from datetime import datetime
+
+from history_cache import get_history_cache, WARM_WINDOW
+from position_store import get_position_store
+from cache_backend import get_cache_backend
+
+WARM_INTERVAL_SECONDS = 120          # Cada cuánto se renuevan las cachés
+ACTIVE_SESSION_SECONDS = 30 * 60     # Una cuenta se considera activa durante este tiempo
+RECENT_DEVICE_SECONDS = 60 * 60      # Dispositivos vistos recientemente
+MAX_DEVICES_PER_ACCOUNT = 5
+HOST_CONCURRENCY = 2                 # Precargas simultáneas por servidor Traccar
+SLOW_RESPONSE_SECONDS = 5.0          # Por encima se considera que el servidor va lento
+MAX_BACKOFF_SECONDS = 30 * 60
+
+
+class ActivityTracker:
+    """Cuentas con sesión activa y los dispositivos que han consultado"""
+
+    def __init__(self):
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def touch(self, token: str, service_factory):
+        """Registra actividad de una cuenta (token = credenciales codificadas)"""
+        with self._lock:
+            account = self._accounts.get(token)
+            if account is None:
+                account = {"factory": service_factory, "service": None, "devices": {}}
+                self._accounts[token] = account
+            account["last_seen"] = time.time()
+
+    def view(self, token: str, device_id: Optional[int]):
+        """Registra que la cuenta consultó un dispositivo"""
+        if device_id is None:
+            return
+        with self._lock:
+            account = self._accounts.get(token)
+            if account is not None:
+                account["devices"][device_id] = time.time()
+
+    def active_accounts(self) -> list:
+        """(token, cuenta) activos, descartando las sesiones vencidas"""
+        now = time.time()
+        with self._lock:
+            for token in [t for t, a in self._accounts.items()
+                          if now - a["last_seen"] > ACTIVE_SESSION_SECONDS]:
+                del self._accounts[token]
+            return list(self._accounts.items())
+
+    @staticmethod
+    def recent_devices(account: dict) -> list:
+        now = time.time()
+        recent = [(seen, d) for d, seen in account["devices"].items()
+                  if now - seen <= RECENT_DEVICE_SECONDS]
+        return [d for _, d in sorted(recent, reverse=True)[:MAX_DEVICES_PER_ACCOUNT]]
+
+
+class HostBudget:
+    """Concurrencia y retroceso (backoff) por servidor Traccar"""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(HOST_CONCURRENCY)
+        self.backoff = 0.0
+        self.resume_at = 0.0
+        self.last_latency = 0.0
+
+    def available(self) -> bool:
+        return time.time() >= self.resume_at
+
+    def record(self, latency: float, failed: bool):
+        self.last_latency = latency
+        if failed or latency > SLOW_RESPONSE_SECONDS:
+            self.backoff = min(max(self.backoff * 2, WARM_INTERVAL_SECONDS), MAX_BACKOFF_SECONDS)
+            self.resume_at = time.time() + self.backoff
+        else:
+            self.backoff = 0.0
+            self.resume_at = 0.0
+
+
+class CacheWarmer:
+    """Tarea de fondo que precarga la caché de las cuentas activas"""
+
+    def __init__(self, tracker: ActivityTracker):
+        self.tracker = tracker
+        self.hosts = {}
+        self.metrics = {
+            "runs": 0, "devices_warmed": 0, "errors": 0,
+            "skipped_backoff": 0, "skipped_other_worker": 0
+        }
+
+    def _budget(self, host: str) -> HostBudget:
+        if host not in self.hosts:
+            self.hosts[host] = HostBudget()
+        return self.hosts[host]
+
+    def _warm_device(self, service, device_id: int):
+        """Renueva las últimas 24 h de un dispositivo (se ejecuta en un hilo)"""
+        cache = get_history_cache()
+        to_time = datetime.utcnow()
+        from_time = to_time - WARM_WINDOW
+        positions = cache.get_positions(service, device_id, from_time, to_time, warm=True)
+        get_position_store().save_positions(service.base_url, positions)
+        cache.get_events(service, device_id, from_time, to_time, warm=True)
+        cache.get_trips(service, device_id, from_time, to_time, warm=True)
+
+    async def _warm(self, account: dict, device_id: int):
+        if account["service"] is None:
+            account["service"] = account["factory"]()
+        service = account["service"]
+        budget = self._budget(service.base_url)
+        if not budget.available():
+            self.metrics["skipped_backoff"] += 1
+            return
+        # Con caché compartida, solo un worker precarga cada dispositivo por intervalo
+        lease = f"warm:{service.account_key}:{device_id}"
+        if not get_cache_backend().add(lease, 1, WARM_INTERVAL_SECONDS - 5):
+            self.metrics["skipped_other_worker"] += 1
+            return
+
+        async with budget.semaphore:
+            started = time.perf_counter()
+            failed = False
+            try:
+                await asyncio.to_thread(self._warm_device, service, device_id)
+                self.metrics["devices_warmed"] += 1
+            except Exception as e:
+                failed = True
+                self.metrics["errors"] += 1
+                print(f"Cache warm error ({service.base_url}, device {device_id}): {e}")
+            budget.record(time.perf_counter() - started, failed)
+
+    async def run_once(self):
+        tasks = []
+        for _, account in self.tracker.active_accounts():
+            for device_id in self.tracker.recent_devices(account):
+                tasks.append(self._warm(account, device_id))
+        if tasks:
+            await asyncio.gather(*tasks)
+        self.metrics["runs"] += 1
+
+    async def run(self, interval: int = WARM_INTERVAL_SECONDS):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Cache warmer error: {e}")
+            await asyncio.sleep(interval)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.metrics,
+            "active_accounts": len(self.tracker.active_accounts()),
+            "hosts": {
+                host: {"backoff_seconds": b.backoff, "last_latency": round(b.last_latency, 2)}
+                for host, b in self.hosts.items()
+            }
+        }
+
+
+activity_tracker = ActivityTracker()
+cache_warmer = CacheWarmer(activity_tracker)
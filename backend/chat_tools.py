@@ -0,0 +1,237 @@
+"""
+Herramientas (function calling) para el chat de IA.
+En lugar de enviar todo el historial en el prompt, el modelo pide solo los
+datos que necesita. Hasta RAW_MAX_HOURS se responde con las posiciones de la
+caché de historiales; las ventanas más largas salen de los resúmenes diarios
+(más el día en curso en detalle) y del registro local de eventos, sin bajar
+el historial completo. Los resultados se guardan en el backend de caché.
+"""
+import json
+from datetime import datetime, timedelta
+
+from ai_service import (
+    format_current_position,
+    format_positions_summary,
+    format_events_for_context,
+    format_trips_for_context,
+    format_behaviour_for_context,
+    format_daily_rollups_for_context,
+)
+from behaviour import detect_behaviour
+from trip_detector import detect_trips, detect_stops
+from position_store import get_store_writer
+from history_cache import get_history_cache, WARM_WINDOW
+from cache_backend import get_cache_backend
+from daily_rollups import get_rollup_store, merge_rollups
+from event_log import get_event_log, MAX_PAGE_SIZE
+
+MAX_TOOL_HOURS = 720           # 30 días como máximo por consulta
+RAW_MAX_HOURS = int(WARM_WINDOW.total_seconds() // 3600)   # Ventana con posiciones en detalle
+CACHE_TTL_SECONDS = 120        # Reutilizar resultados entre turnos cercanos
+
+# Definición de herramientas en formato OpenAI
+TOOL_DEFINITIONS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_latest_position",
+            "description": "Última posición conocida del vehículo con su estado actual (ignición, voltaje, odómetro, OBD, GPS).",
+            "parameters": {"type": "object", "properties": {}, "required": []}
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_statistics",
+            "description": "Estadísticas de conducción y del motor (velocidades, RPM, temperatura, combustible...) de las últimas N horas. Más de 24 h: totales de los días anteriores y el detalle de hoy.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "hours": {"type": "integer", "description": "Horas hacia atrás desde ahora (1-720)"}
+                },
+                "required": ["hours"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "list_trips",
+            "description": "Viajes (inicio, fin, distancia, duración, velocidades) y paradas de las últimas N horas. Más de 24 h: totales de los días anteriores y los viajes de hoy.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "hours": {"type": "integer", "description": "Horas hacia atrás desde ahora (1-720)"}
+                },
+                "required": ["hours"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_events",
+            "description": "Eventos y alarmas de las últimas N horas, opcionalmente filtrados por tipo (alarm, deviceOverspeed, ignitionOn, ignitionOff, geofenceEnter...).",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "hours": {"type": "integer", "description": "Horas hacia atrás desde ahora (1-720)"},
+                    "event_type": {"type": "string", "description": "Tipo de evento de Traccar (opcional)"}
+                },
+                "required": ["hours"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_driving_behaviour",
+            "description": "Conducción detectada de las últimas N horas: aceleraciones, frenadas y giros bruscos, excesos de velocidad y ralentí prolongado. Más de 24 h: totales de los días anteriores y el detalle de hoy.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "hours": {"type": "integer", "description": "Horas hacia atrás desde ahora (1-720)"}
+                },
+                "required": ["hours"]
+            }
+        }
+    }
+]
+
+class VehicleToolbox:
+    """Datos de un vehículo bajo demanda para las herramientas del chat"""
+
+    definitions = TOOL_DEFINITIONS
+
+    def __init__(self, service, device_id: int, max_hours: int = MAX_TOOL_HOURS, speed_limit: float = None):
+        self.service = service
+        self.device_id = device_id
+        self.speed_limit = speed_limit
+        self.max_hours = min(max_hours, MAX_TOOL_HOURS)
+        self.calls = []
+
+    # ------------------------------
+    # Carga de datos
+    # ------------------------------
+    def _hours(self, hours) -> int:
+        try:
+            hours = int(hours)
+        except (TypeError, ValueError):
+            hours = 24
+        return max(1, min(hours, self.max_hours))
+
+    def _window(self, hours) -> tuple:
+        hours = self._hours(hours)
+        to_time = datetime.utcnow()
+        return hours, to_time - timedelta(hours=hours), to_time
+
+    def positions(self, hours) -> list:
+        """Posiciones en detalle; la ventana no pasa de RAW_MAX_HOURS (la de la caché de historiales)"""
+        _, from_time, to_time = self._window(min(self._hours(hours), RAW_MAX_HOURS))
+        positions = get_history_cache().get_positions(self.service, self.device_id, from_time, to_time)
+        get_store_writer().save_positions(self.service.base_url, positions)
+        return positions
+
+    def today_positions(self) -> list:
+        """Posiciones del día en curso (UTC), en detalle"""
+        to_time = datetime.utcnow()
+        from_time = datetime(to_time.year, to_time.month, to_time.day)
+        positions = get_history_cache().get_positions(self.service, self.device_id, from_time, to_time)
+        get_store_writer().save_positions(self.service.base_url, positions)
+        return positions
+
+    def daily(self, hours) -> dict:
+        """
+        Totales de los días anteriores a hoy dentro de la ventana: los días enteros
+        salen de los resúmenes diarios y el tramo del primer día se resume aparte
+        """
+        _, from_time, to_time = self._window(hours)
+        first_day = from_time.date()
+        if from_time.time() != datetime.min.time():
+            first_day += timedelta(days=1)
+        head_end = datetime(first_day.year, first_day.month, first_day.day)
+        rollups = get_rollup_store()
+        days, missing = rollups.ensure_days(
+            self.service, self.device_id, first_day, to_time.date() - timedelta(days=1), self.speed_limit
+        )
+        if from_time < head_end:
+            days.append(rollups.window_rollup(self.service, self.device_id, from_time, head_end, self.speed_limit))
+        return merge_rollups(days, missing)
+
+    def events(self, hours, event_type: str = None) -> list:
+        hours, from_time, to_time = self._window(hours)
+        if hours <= RAW_MAX_HOURS:
+            events = get_history_cache().get_events(self.service, self.device_id, from_time, to_time)
+            return [e for e in events if not event_type or e.get("type") == event_type]
+        # Ventanas largas: el registro local solo pide a Traccar lo que falta
+        log = get_event_log()
+        log.sync(self.service, [self.device_id], from_time, to_time)
+        page = log.query(self.service.base_url, [self.device_id], from_time, to_time,
+                         [event_type] if event_type else None, limit=MAX_PAGE_SIZE)
+        return page["events"]
+
+    def latest_position(self) -> list:
+        return self.service.get_positions(self.device_id) or []
+
+    # ------------------------------
+    # Ejecución de herramientas
+    # ------------------------------
+    def _run(self, name: str, args: dict) -> str:
+        if name == "get_latest_position":
+            return format_current_position(self.latest_position())
+
+        if name == "search_events":
+            events = self.events(args.get("hours", 24), args.get("event_type"))
+            text = format_events_for_context(events)
+            if len(events) >= MAX_PAGE_SIZE:
+                text += f"\n(Se muestran los {MAX_PAGE_SIZE} eventos más recientes de la ventana)"
+            return text
+
+        if name not in ("get_statistics", "list_trips", "get_driving_behaviour"):
+            return f"Herramienta desconocida: {name}"
+
+        hours = self._hours(args.get("hours", 24))
+        long_window = hours > RAW_MAX_HOURS
+        positions = self.today_positions() if long_window else self.positions(hours)
+        lines = [format_daily_rollups_for_context(self.daily(hours)), "\n=== HOY ==="] if long_window else []
+
+        if name == "get_statistics":
+            lines += [format_current_position(positions), format_positions_summary(positions)]
+        elif name == "list_trips":
+            lines.append(format_trips_for_context(detect_trips(positions, device_id=self.device_id)))
+            stops = detect_stops(positions, device_id=self.device_id)
+            if stops:
+                lines.append(f"\nParadas de más de 5 min: {len(stops)}")
+        else:
+            behaviour = detect_behaviour(positions, self.device_id, self.speed_limit)
+            lines.append(format_behaviour_for_context(behaviour) or "Sin datos de conducción.")
+        return "\n".join(lines)
+
+    def _cache_key(self, name: str, args: dict) -> str:
+        hours = self._hours(args.get("hours", 24)) if name != "get_latest_position" else 0
+        return (f"tool:{self.service.account_key}:{self.device_id}:{name}:{hours}:"
+                f"{args.get('event_type') or ''}:{self.speed_limit}")
+
+    def execute(self, name: str, arguments: str) -> str:
+        """Ejecuta una herramienta pedida por el modelo y devuelve el resultado como texto"""
+        try:
+            args = json.loads(arguments or "{}")
+        except json.JSONDecodeError:
+            args = {}
+        if not isinstance(args, dict):
+            args = {}
+        self.calls.append({"name": name, "arguments": args})
+
+        backend = get_cache_backend()
+        key = self._cache_key(name, args)
+        cached = backend.get(key)
+        if cached is not None:
+            return cached
+        try:
+            result = self._run(name, args)
+        except Exception as e:
+            print(f"Tool {name} error: {e}")
+            return f"Error al obtener los datos ({name}): {str(e)}"
+        # Los errores no se guardan: el próximo turno vuelve a intentar
+        backend.set(key, result, CACHE_TTL_SECONDS)
+        return result
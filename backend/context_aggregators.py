@@ -0,0 +1,265 @@
+"""
+Agregadores en streaming para el contexto del chat: consumen posiciones,
+eventos y viajes de a uno y guardan solo lo que el prompt necesita (mínimos,
+máximos, sumas, últimos valores y las últimas N entradas a listar).
+
+Con ventanas largas el historial se lee directamente de la respuesta de
+Traccar (ver TraccarService.iter_position_history) sin armar listas, de modo
+que la memoria no depende de la cantidad de días pedidos.
+"""
+from collections import deque
+from typing import Optional
+
+from behaviour import detect_behaviour, merge_behaviour_summaries
+from trip_detector import TripDetector
+
+# Campos OBD numéricos con estadísticas
+NUMERIC_OBD_FIELDS = {
+    'io31': 'Carga del motor (%)',
+    'io32': 'Temperatura refrigerante (°C)',
+    'io35': 'Temperatura aire admisión (°C)',
+    'io36': 'RPM del motor',
+    'io37': 'Velocidad OBD (km/h)',
+    'io39': 'Posición acelerador (%)',
+    'io43': 'Nivel combustible (%)',
+    'io48': 'Carga calculada (%)',
+}
+
+# Campos de los que solo interesa el último valor
+SINGLE_OBD_FIELDS = ['io30', 'io33', 'io38', 'io60', 'io250', 'io252', 'io389', 'vin']
+
+RECENT_MOVING_POSITIONS = 5
+RECENT_IMPORTANT_EVENTS = 5
+MAX_LISTED_ALARMS = 20
+MAX_LISTED_TRIPS = 30
+IMPORTANT_EVENT_TYPES = ('deviceOverspeed', 'ignitionOn', 'ignitionOff', 'deviceMoving')
+
+BEHAVIOUR_CHUNK = 5000             # Posiciones por tramo analizado
+BEHAVIOUR_KEEP = 50                # Eventos y excesos que se conservan para el prompt
+
+
+class ObdStats:
+    """Mínimo, máximo, promedio y último valor de cada campo OBD"""
+
+    def __init__(self):
+        self._numeric = {}   # campo -> [mín, máx, suma, cantidad, último]
+        self._single = {}    # campo -> (fixTime, valor)
+
+    def add(self, position: dict):
+        attrs = position.get('attributes') or {}
+        for field in NUMERIC_OBD_FIELDS:
+            value = attrs.get(field)
+            # Solo valores positivos válidos
+            if isinstance(value, (int, float)) and value > 0:
+                acc = self._numeric.get(field)
+                if acc is None:
+                    self._numeric[field] = [value, value, value, 1, value]
+                else:
+                    if value < acc[0]:
+                        acc[0] = value
+                    if value > acc[1]:
+                        acc[1] = value
+                    acc[2] += value
+                    acc[3] += 1
+                    acc[4] = value
+
+        fix_time = position.get('fixTime') or ''
+        for field in SINGLE_OBD_FIELDS:
+            value = attrs.get(field)
+            if value is not None:
+                last = self._single.get(field)
+                if last is None or fix_time > last[0]:
+                    self._single[field] = (fix_time, value)
+
+    def result(self) -> dict:
+        stats = {}
+        for field, description in NUMERIC_OBD_FIELDS.items():
+            acc = self._numeric.get(field)
+            if acc:
+                low, high, total, count, last = acc
+                stats[field] = {
+                    'description': description,
+                    'min': round(low, 1),
+                    'max': round(high, 1),
+                    'avg': round(total / count, 1),
+                    'last': round(last, 1),
+                    'count': count,
+                }
+        for field in SINGLE_OBD_FIELDS:
+            if field in self._single:
+                stats[field] = {'last': self._single[field][1]}
+        return stats
+
+
+class LatestFix:
+    """Posición con el fixTime más reciente"""
+
+    def __init__(self):
+        self.position = None
+
+    def add(self, position: dict):
+        if self.position is None or (position.get('fixTime') or '') > (self.position.get('fixTime') or ''):
+            self.position = position
+
+
+class SpeedSummary:
+    """Cantidad de registros, velocidad máxima y promedio en movimiento (nudos)"""
+
+    def __init__(self):
+        self.count = 0
+        self.moving_count = 0
+        self.max_speed = 0
+        self.moving_speed_total = 0.0
+        self.recent_moving = deque(maxlen=RECENT_MOVING_POSITIONS)
+
+    def add(self, position: dict):
+        self.count += 1
+        speed = position.get('speed') or 0
+        if speed > 0:
+            self.moving_count += 1
+            self.moving_speed_total += speed
+            if speed > self.max_speed:
+                self.max_speed = speed
+            self.recent_moving.append({'fixTime': position.get('fixTime'), 'speed': speed})
+
+    @property
+    def average_moving_speed(self) -> float:
+        return self.moving_speed_total / self.moving_count if self.moving_count else 0.0
+
+
+class EventCounts:
+    """Eventos por tipo, las últimas alarmas y los últimos eventos importantes"""
+
+    def __init__(self, max_alarms: int = MAX_LISTED_ALARMS):
+        self.count = 0
+        self.by_type = {}
+        self.alarm_count = 0
+        self.alarms = deque(maxlen=max_alarms)                    # (eventTime, tipo de alarma)
+        self.important = deque(maxlen=RECENT_IMPORTANT_EVENTS)    # (eventTime, tipo de evento)
+
+    def add(self, event: dict):
+        self.count += 1
+        event_type = event.get('type', 'unknown')
+        self.by_type[event_type] = self.by_type.get(event_type, 0) + 1
+        if event_type == 'alarm':
+            self.alarm_count += 1
+            self.alarms.append((event.get('eventTime'), (event.get('attributes') or {}).get('alarm', 'desconocida')))
+        elif event_type in IMPORTANT_EVENT_TYPES:
+            self.important.append((event.get('eventTime'), event_type))
+
+
+class TripTotals:
+    """Totales de viajes y los últimos MAX_LISTED_TRIPS para detallar"""
+
+    def __init__(self, max_listed: int = MAX_LISTED_TRIPS):
+        self.count = 0
+        self.distance = 0
+        self.duration = 0
+        self.max_speed = 0
+        self.recent = deque(maxlen=max_listed)
+
+    def add(self, trip: dict):
+        self.count += 1
+        self.distance += trip.get('distance', 0)
+        self.duration += trip.get('duration', 0)
+        self.max_speed = max(self.max_speed, trip.get('maxSpeed', 0))
+        self.recent.append(trip)
+
+
+class BehaviourChunks:
+    """
+    Conducción brusca por tramos de BEHAVIOUR_CHUNK posiciones. Cada tramo
+    empieza con la última posición del anterior para no perder la diferencia
+    entre ambos; los resúmenes se suman y se conservan los últimos eventos.
+    """
+
+    def __init__(self, device_id: Optional[int] = None, speed_limit: Optional[float] = None):
+        self.device_id = device_id
+        self.speed_limit = speed_limit
+        self._chunk = []
+        self._summaries = []
+        self._events = []
+        self._overspeed = []
+        self._idling = []
+
+    def add(self, position: dict):
+        self._chunk.append(position)
+        if len(self._chunk) >= BEHAVIOUR_CHUNK:
+            self._flush()
+
+    def _flush(self):
+        if len(self._chunk) > 1:
+            result = detect_behaviour(self._chunk, self.device_id, self.speed_limit)
+            self._summaries.append(result['summary'])
+            self._events = (self._events + result['events'])[-BEHAVIOUR_KEEP:]
+            self._idling = (self._idling + result['idling'])[-BEHAVIOUR_KEEP:]
+            # Para el prompt interesan los mayores excesos
+            self._overspeed = sorted(
+                self._overspeed + result['overspeed'], key=lambda s: s['maxSpeed']
+            )[-BEHAVIOUR_KEEP:]
+        self._chunk = self._chunk[-1:]
+
+    def result(self) -> Optional[dict]:
+        self._flush()
+        if not self._summaries:
+            return None
+        return {
+            'events': self._events,
+            'overspeed': self._overspeed,
+            'idling': self._idling,
+            'summary': merge_behaviour_summaries(self._summaries),
+        }
+
+
+class VehicleContext:
+    """
+    Agregados del contexto del chat. Con `detect=True` detecta además los
+    viajes y la conducción brusca a partir de las posiciones recibidas.
+    """
+
+    def __init__(self, device_id: Optional[int] = None, speed_limit: Optional[float] = None,
+                 detect: bool = False):
+        self.latest = LatestFix()
+        self.obd = ObdStats()
+        self.speeds = SpeedSummary()
+        self.events = EventCounts()
+        self.trips = TripTotals()
+        self.behaviour = None
+        self._detector = TripDetector(device_id=device_id) if detect else None
+        self._behaviour = BehaviourChunks(device_id, speed_limit) if detect else None
+
+    def add_position(self, position: dict):
+        self.latest.add(position)
+        self.obd.add(position)
+        self.speeds.add(position)
+        if self._detector is not None:
+            self._detector.feed(position)
+            self._behaviour.add(position)
+
+    def add_event(self, event: dict):
+        self.events.add(event)
+
+    def add_trip(self, trip: dict):
+        self.trips.add(trip)
+
+    def finish(self) -> 'VehicleContext':
+        """Cierra las detecciones pendientes (viaje en curso, último tramo)"""
+        if self._detector is not None:
+            for trip in self._detector.current_trips():
+                self.trips.add(trip)
+            self.behaviour = self._behaviour.result()
+            self._detector = self._behaviour = None
+        return self
+
+    @classmethod
+    def from_lists(cls, positions: list, events: list, trips: list, behaviour: dict = None) -> 'VehicleContext':
+        """Agregados de datos ya cargados en memoria (ventanas cortas)"""
+        context = cls()
+        for p in positions or []:
+            context.add_position(p)
+        for e in events or []:
+            context.add_event(e)
+        for t in trips or []:
+            context.add_trip(t)
+        context.behaviour = behaviour
+        return context
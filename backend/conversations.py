@@ -0,0 +1,71 @@
+"""
+Conversaciones del chat guardadas en el servidor: el navegador envía solo el
+conversation_id y el mensaje nuevo, no la transcripción completa.
+
+Se guardan en el backend de caché (compartido entre workers con
+CACHE_BACKEND=sqlite). Cuando el historial supera CONVERSATION_MAX_TOKENS, los
+mensajes más antiguos se condensan en un resumen y solo se conservan los
+últimos KEEP_RECENT_MESSAGES literales.
+"""
+import uuid
+from typing import Optional
+
+from cache_backend import get_cache_backend
+
+CONVERSATION_TTL = 24 * 3600
+CONVERSATION_MAX_TOKENS = 2000     # Historial (sin contar el resumen) antes de compactar
+KEEP_RECENT_MESSAGES = 6           # Últimos mensajes que se mantienen tal cual
+
+
+def estimate_tokens(messages: list) -> int:
+    """Estimación aproximada (~4 caracteres por token más el envoltorio de cada mensaje)"""
+    return sum(len(m.get('content') or '') // 4 + 4 for m in messages)
+
+
+def split_for_compaction(messages: list) -> Optional[tuple]:
+    """(mensajes a resumir, mensajes recientes), o None si no hace falta compactar"""
+    if estimate_tokens(messages) <= CONVERSATION_MAX_TOKENS or len(messages) <= KEEP_RECENT_MESSAGES:
+        return None
+    recent = messages[-KEEP_RECENT_MESSAGES:]
+    # El historial que queda debe empezar con una pregunta del usuario
+    while recent and recent[0].get('role') != 'user':
+        recent = recent[1:]
+    return messages[:len(messages) - len(recent)], recent
+
+
+class ConversationStore:
+    """Conversaciones por id; solo las ve la cuenta de Traccar que las creó"""
+
+    @staticmethod
+    def _key(conversation_id: str) -> str:
+        return f"conversation:{conversation_id}"
+
+    def create(self, service, device_id: int, messages: list = None) -> dict:
+        return {
+            'id': uuid.uuid4().hex,
+            'owner': service.account_key,
+            'device_id': device_id,
+            'summary': '',
+            'messages': list(messages or []),
+        }
+
+    def load(self, conversation_id: str, service, device_id: int) -> Optional[dict]:
+        """La conversación, o None si expiró, es de otra cuenta o de otro dispositivo"""
+        conversation = get_cache_backend().get(self._key(conversation_id))
+        if conversation is None:
+            return None
+        if conversation.get('owner') != service.account_key \
+                or conversation.get('device_id') != device_id:
+            return None
+        # MemoryCache devuelve el mismo objeto: copiar antes de modificarlo
+        return {**conversation, 'messages': list(conversation['messages'])}
+
+    def save(self, conversation: dict):
+        get_cache_backend().set(self._key(conversation['id']), conversation, CONVERSATION_TTL)
+
+
+_store = ConversationStore()
+
+
+def get_conversation_store() -> ConversationStore:
+    return _store
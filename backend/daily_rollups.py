@@ -0,0 +1,333 @@
+"""
+Resúmenes diarios materializados por dispositivo (distancia, tiempo de conducción,
+ralentí, velocidad máxima, alarmas, conducción brusca y estadísticas OBD).
+Se calculan en segundo plano a partir del almacén local, de modo que las
+consultas de períodos largos cuestan lo mismo por día sin importar los datos crudos.
+"""
+import json
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from datetime import date, datetime, timedelta, timezone
+
+from ai_service import calculate_obd_statistics
+from behaviour import detect_behaviour, merge_behaviour_summaries
+from trip_detector import TripDetector, parse_time
+from position_store import get_position_store, STORE_PATH
+
+ROLLUP_INTERVAL_SECONDS = 60     # Cada cuánto se recalculan los días pendientes
+MAX_IDLE_GAP_SECONDS = 300       # Huecos mayores no cuentan como ralentí
+BACKFILL_CONCURRENCY = 4         # Días descargados a la vez (cada pedido pasa por el limitador de Traccar)
+
+
+def day_bounds(day: str) -> tuple:
+    """Inicio y fin (UTC) de un día 'YYYY-MM-DD'"""
+    start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+    return start, start + timedelta(days=1) - timedelta(milliseconds=1)
+
+
+def days_between(from_day: date, to_day: date) -> list:
+    """Lista de días 'YYYY-MM-DD' entre dos fechas (inclusive)"""
+    days = []
+    current = from_day
+    while current <= to_day:
+        days.append(current.isoformat())
+        current += timedelta(days=1)
+    return days
+
+
+def compute_day_rollup(positions: list, events: list, speed_limit: Optional[float] = None) -> dict:
+    """
+    Calcula el resumen de un día a partir de sus posiciones y eventos.
+    `speed_limit` en nudos (el del dispositivo, como en el chat); None = el por defecto.
+    """
+    detector = TripDetector()
+    detector.feed_many(positions)
+    trips = detector.current_trips()
+
+    idle_time = 0.0
+    max_speed = 0
+    prev = None
+    prev_time = None
+    for p in sorted(positions, key=lambda x: x.get('fixTime', '')):
+        time = parse_time(p.get('fixTime'))
+        if time is None:
+            continue
+        max_speed = max(max_speed, p.get('speed') or 0)
+        if prev is not None:
+            gap = (time - prev_time).total_seconds()
+            attrs = prev.get('attributes', {}) or {}
+            if 0 < gap <= MAX_IDLE_GAP_SECONDS and attrs.get('ignition') and not detector.is_moving(prev):
+                idle_time += gap
+        prev, prev_time = p, time
+
+    alarms = {}
+    for e in events:
+        if e.get('type') == 'alarm':
+            alarm_type = (e.get('attributes') or {}).get('alarm', 'desconocida')
+            alarms[alarm_type] = alarms.get(alarm_type, 0) + 1
+        elif e.get('type') == 'deviceOverspeed':
+            alarms['overspeed'] = alarms.get('overspeed', 0) + 1
+
+    obd = {
+        field: {k: s[k] for k in ('min', 'max', 'avg', 'count')}
+        for field, s in calculate_obd_statistics(positions).items()
+        if 'count' in s
+    }
+
+    return {
+        'distance': round(sum(t['distance'] for t in trips), 1),
+        'driving_time': int(sum(t['duration'] for t in trips) / 1000),
+        'idle_time': int(idle_time),
+        'max_speed': max_speed,
+        'trips_count': len(trips),
+        'positions_count': len(positions),
+        'alarm_count': sum(alarms.values()),
+        'alarms': alarms,
+        'obd': obd,
+        'behaviour': detect_behaviour(positions, speed_limit=speed_limit)['summary'],
+    }
+
+
+def merge_rollups(rollups: list, missing_days: Optional[list] = None) -> dict:
+    """
+    Totales de un período a partir de sus resúmenes diarios. `missing_days` son
+    los días que no se pudieron descargar: no están en los totales.
+    """
+    totals = {
+        'days': len(rollups),
+        'missing_days': sorted(missing_days or []),
+        'distance': 0.0,
+        'driving_time': 0,
+        'idle_time': 0,
+        'max_speed': 0,
+        'trips_count': 0,
+        'alarm_count': 0,
+        'alarms': {},
+        'obd': {},
+    }
+    for r in rollups:
+        totals['distance'] += r['distance']
+        totals['driving_time'] += r['driving_time']
+        totals['idle_time'] += r['idle_time']
+        totals['max_speed'] = max(totals['max_speed'], r['max_speed'])
+        totals['trips_count'] += r['trips_count']
+        totals['alarm_count'] += r['alarm_count']
+        for alarm, count in r['alarms'].items():
+            totals['alarms'][alarm] = totals['alarms'].get(alarm, 0) + count
+        for field, s in r['obd'].items():
+            acc = totals['obd'].get(field)
+            if acc is None:
+                totals['obd'][field] = dict(s)
+                continue
+            count = acc['count'] + s['count']
+            acc['avg'] = round((acc['avg'] * acc['count'] + s['avg'] * s['count']) / count, 1)
+            acc['min'] = min(acc['min'], s['min'])
+            acc['max'] = max(acc['max'], s['max'])
+            acc['count'] = count
+    totals['distance'] = round(totals['distance'], 1)
+    totals['behaviour'] = merge_behaviour_summaries([r['behaviour'] for r in rollups if 'behaviour' in r])
+    return totals
+
+
+class DailyRollupStore:
+    """Tabla de resúmenes diarios junto al almacén local de posiciones"""
+
+    def __init__(self, path: str = STORE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_rollups (
+                    server TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    complete INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (server, device_id, day)
+                )
+            """)
+            # Límite de velocidad de cada dispositivo (el worker de fondo no tiene acceso a Traccar)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rollup_speed_limits (
+                    server TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    speed_limit REAL NOT NULL,
+                    PRIMARY KEY (server, device_id)
+                )
+            """)
+
+    def save(self, server: str, device_id: int, day: str, rollup: dict, complete: Optional[bool] = None):
+        """
+        Guarda un resumen. `complete` indica que el día se descargó entero desde
+        Traccar; si es None se conserva el valor anterior.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO daily_rollups (server, device_id, day, data, complete, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (server, device_id, day) DO UPDATE SET data = excluded.data, "
+                "complete = COALESCE(?, complete), updated_at = excluded.updated_at",
+                (server, device_id, day, json.dumps(rollup), int(bool(complete)),
+                 datetime.utcnow().isoformat(), None if complete is None else int(complete))
+            )
+
+    def speed_limit(self, server: str, device_id: int) -> Optional[float]:
+        """Límite en nudos guardado para el dispositivo (None si nunca se informó)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT speed_limit FROM rollup_speed_limits WHERE server = ? AND device_id = ?",
+                (server, device_id)
+            ).fetchone()
+        return row['speed_limit'] if row else None
+
+    def set_speed_limit(self, server: str, device_id: int, speed_limit: float) -> bool:
+        """Guarda el límite del dispositivo. Retorna True si cambió."""
+        if self.speed_limit(server, device_id) == speed_limit:
+            return False
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rollup_speed_limits (server, device_id, speed_limit) VALUES (?, ?, ?)",
+                (server, device_id, speed_limit)
+            )
+        return True
+
+    def get_range(self, server: str, device_ids: list, from_day: str, to_day: str) -> list:
+        """Resúmenes guardados de varios dispositivos entre dos días (inclusive)"""
+        if not device_ids:
+            return []
+        placeholders = ','.join('?' for _ in device_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT device_id, day, data, complete FROM daily_rollups WHERE server = ? "
+                f"AND device_id IN ({placeholders}) AND day BETWEEN ? AND ? ORDER BY device_id, day",
+                [server, *device_ids, from_day, to_day]
+            ).fetchall()
+        return [
+            {'deviceId': r['device_id'], 'day': r['day'], 'complete': bool(r['complete']), **json.loads(r['data'])}
+            for r in rows
+        ]
+
+    # ------------------------------
+    # Cálculo
+    # ------------------------------
+    def rebuild_day(self, server: str, device_id: int, day: str, complete: Optional[bool] = None) -> dict:
+        """Recalcula un día desde las posiciones y eventos guardados"""
+        store = get_position_store()
+        start, end = day_bounds(day)
+        rollup = compute_day_rollup(
+            store.get_positions(server, device_id, start, end),
+            store.get_events(server, device_id, start, end),
+            self.speed_limit(server, device_id)
+        )
+        self.save(server, device_id, day, rollup, complete)
+        return rollup
+
+    def process_dirty(self, limit: int = 100) -> int:
+        """Recalcula los días marcados como modificados. Retorna cuántos procesó."""
+        dirty = get_position_store().pop_dirty_days(limit)
+        for server, device_id, day in dirty:
+            try:
+                self.rebuild_day(server, device_id, day)
+            except Exception as e:
+                print(f"Error rebuilding rollup {server} {device_id} {day}: {e}")
+        return len(dirty)
+
+    def _backfill_day(self, service, device_id: int, day: str) -> bool:
+        """
+        Descarga un día de Traccar y lo materializa (completo solo si ya terminó).
+        Retorna False si la descarga falló.
+        """
+        start, end = day_bounds(day)
+        store = get_position_store()
+        try:
+            store.save_positions(service.base_url, service.get_position_history(device_id, start, end) or [])
+            store.save_events(service.base_url, service.get_events(device_id, start, end) or [])
+        except Exception as e:
+            print(f"Error backfilling rollup day {day}: {e}")
+            return False
+        # El día en curso se resume igual, pero se vuelve a descargar en la próxima consulta
+        self.rebuild_day(service.base_url, device_id, day, complete=end < datetime.now(timezone.utc))
+        return True
+
+    def ensure_days(self, service, device_id: int, from_day: date, to_day: date,
+                    speed_limit: Optional[float] = None) -> tuple:
+        """
+        (resúmenes, días faltantes) de un dispositivo entre dos días. Los días sin
+        resumen completo se descargan de Traccar (BACKFILL_CONCURRENCY a la vez)
+        y quedan materializados; los que fallan se informan como faltantes y no
+        se incluyen en los resúmenes. `speed_limit` (nudos, ver
+        speed_limit_for_device) queda guardado para los recálculos del worker.
+        """
+        server = service.base_url
+        days = days_between(from_day, to_day)
+        if not days:
+            return [], []
+        limit_changed = speed_limit is not None and self.set_speed_limit(server, device_id, speed_limit)
+        existing = {r['day']: r for r in self.get_range(server, [device_id], days[0], days[-1]) if r['complete']}
+        for day, rollup in existing.items():
+            if limit_changed or 'behaviour' not in rollup:
+                # Resumen calculado con otro límite (o anterior a la detección de
+                # conducción): se recalcula desde el almacén
+                self.rebuild_day(server, device_id, day)
+        missing = [day for day in days if day not in existing]
+        failed = []
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(BACKFILL_CONCURRENCY, len(missing))) as pool:
+                loaded = list(pool.map(lambda day: self._backfill_day(service, device_id, day), missing))
+            failed = [day for day, ok in zip(missing, loaded) if not ok]
+        # Un día que falló puede tener un resumen parcial del almacén: no se mezcla con los demás
+        rollups = [r for r in self.get_range(server, [device_id], days[0], days[-1]) if r['day'] not in failed]
+        return rollups, failed
+
+    def window_rollup(self, service, device_id: int, from_time: datetime, to_time: datetime,
+                      speed_limit: Optional[float] = None) -> dict:
+        """
+        Resumen de un tramo de menos de un día (el comienzo de una ventana que no
+        empieza a medianoche). Se calcula con los datos del tramo y no se guarda:
+        el resumen del día entero contaría horas fuera de la ventana.
+        """
+        positions = service.get_position_history(device_id, from_time, to_time) or []
+        events = service.get_events(device_id, from_time, to_time) or []
+        store = get_position_store()
+        store.save_positions(service.base_url, positions)
+        store.save_events(service.base_url, events)
+        return {
+            'deviceId': device_id, 'day': from_time.date().isoformat(), 'complete': False,
+            **compute_day_rollup(positions, events, speed_limit),
+        }
+
+
+_rollups = None
+_rollups_lock = threading.Lock()
+
+
+def get_rollup_store() -> DailyRollupStore:
+    """Instancia compartida de los resúmenes diarios"""
+    global _rollups
+    if _rollups is None:
+        with _rollups_lock:
+            if _rollups is None:
+                _rollups = DailyRollupStore()
+    return _rollups
+
+
+async def run_rollup_worker(interval: int = ROLLUP_INTERVAL_SECONDS, stop: Optional[asyncio.Event] = None):
+    """Tarea de fondo: recalcula periódicamente los días con datos nuevos"""
+    stop = stop or asyncio.Event()
+    while not stop.is_set():
+        try:
+            processed = await asyncio.to_thread(get_rollup_store().process_dirty)
+            if processed:
+                print(f"Rollups: {processed} days rebuilt")
+        except Exception as e:
+            print(f"Rollup worker error: {e}")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,199 @@
+"""
+Registro local de eventos para el panel de eventos. Cada dispositivo guarda
+el rango de tiempo ya sincronizado con Traccar; al consultar solo se piden
+los tramos que faltan (normalmente los eventos nuevos desde la última vez) y
+el filtrado por tipo, la vista de alarmas y la paginación se resuelven en
+SQLite con índices por dispositivo, tipo y tiempo.
+
+Los eventos se guardan en la tabla `events` del almacén local (compartida con
+el resto del backend); aquí solo vive la cobertura sincronizada.
+"""
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from history_cache import to_utc
+from position_store import get_position_store, time_key, STORE_PATH
+from trip_detector import parse_time
+
+SYNC_OVERLAP = timedelta(minutes=10)       # Se vuelve a pedir el final por eventos que llegan tarde
+SYNC_MIN_INTERVAL = timedelta(seconds=30)  # Un final sincronizado hace menos que esto se da por actual
+SYNC_CONCURRENCY = 4
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def parse_cursor(value: Optional[str]) -> Optional[tuple]:
+    """'eventTime|eventId' del último evento de la página anterior"""
+    if not value:
+        return None
+    event_time, _, event_id = value.rpartition("|")
+    key = time_key(event_time)
+    if key is None or not event_id.isdigit():
+        raise ValueError("Cursor inválido")
+    return key, int(event_id)
+
+
+class EventLog:
+    """Cobertura sincronizada por (servidor, dispositivo) y consultas sobre los eventos guardados"""
+
+    def __init__(self, path: str = STORE_PATH):
+        self._store = get_position_store()   # Crea la tabla de eventos y sus índices
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS event_sync (
+                    server TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    synced_from TEXT NOT NULL,
+                    synced_to TEXT NOT NULL,
+                    PRIMARY KEY (server, device_id)
+                )
+            """)
+
+    # ------------------------------
+    # Sincronización
+    # ------------------------------
+    def _coverage(self, server: str, device_ids: list) -> dict:
+        placeholders = ','.join('?' for _ in device_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT device_id, synced_from, synced_to FROM event_sync "
+                f"WHERE server = ? AND device_id IN ({placeholders})",
+                [server, *device_ids]
+            ).fetchall()
+        return {r['device_id']: (r['synced_from'], r['synced_to']) for r in rows}
+
+    def _save_coverage(self, server: str, device_id: int, synced_from: str, synced_to: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO event_sync (server, device_id, synced_from, synced_to) VALUES (?, ?, ?, ?)",
+                (server, device_id, synced_from, synced_to)
+            )
+
+    @staticmethod
+    def missing_ranges(coverage: Optional[tuple], from_time: datetime, to_time: datetime) -> list:
+        """Tramos (desde, hasta) de [from_time, to_time] que aún no se pidieron a Traccar"""
+        if coverage is None:
+            return [(from_time, to_time)]
+        synced_from, synced_to = parse_time(coverage[0]), parse_time(coverage[1])
+        if to_time < synced_from or from_time > synced_to:
+            # Sin contacto con lo sincronizado: se pide la ventana completa
+            return [(from_time, to_time)]
+        ranges = []
+        if from_time < synced_from:
+            ranges.append((from_time, synced_from))
+        if to_time - synced_to > SYNC_MIN_INTERVAL:
+            ranges.append((synced_to - SYNC_OVERLAP, to_time))
+        return ranges
+
+    def _sync_device(self, service, device_id: int, coverage: Optional[tuple],
+                     from_time: datetime, to_time: datetime) -> int:
+        """Descarga los tramos faltantes de un dispositivo. Retorna cuántos eventos llegaron."""
+        server = service.base_url
+        received = 0
+        for start, end in self.missing_ranges(coverage, from_time, to_time):
+            events = service.get_events(device_id, start, end) or []
+            self._store.save_events(server, events)
+            received += len(events)
+            # Se extiende la cobertura tramo a tramo: si falla el siguiente, lo ya bajado queda registrado
+            span = (time_key(start), time_key(end))
+            if coverage is None or span[1] < coverage[0] or span[0] > coverage[1]:
+                coverage = span
+            else:
+                coverage = (min(coverage[0], span[0]), max(coverage[1], span[1]))
+            self._save_coverage(server, device_id, *coverage)
+        return received
+
+    def sync(self, service, device_ids: list, from_time: datetime, to_time: datetime) -> dict:
+        """
+        Trae de Traccar solo los eventos que faltan para la ventana. Un
+        dispositivo que falla se informa en `failed` y se responde con lo guardado.
+        """
+        if not device_ids:
+            return {"received": 0, "failed": []}
+        from_time = to_utc(from_time)
+        to_time = min(to_utc(to_time), datetime.now(timezone.utc))
+        if from_time >= to_time:
+            return {"received": 0, "failed": []}
+        coverage = self._coverage(service.base_url, device_ids)
+
+        def run(device_id: int) -> Optional[int]:
+            try:
+                return self._sync_device(service, device_id, coverage.get(device_id), from_time, to_time)
+            except Exception as e:
+                print(f"Error syncing events for device {device_id}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(SYNC_CONCURRENCY, len(device_ids))) as pool:
+            results = list(pool.map(run, device_ids))
+        return {
+            "received": sum(r for r in results if r),
+            "failed": [d for d, r in zip(device_ids, results) if r is None],
+        }
+
+    # ------------------------------
+    # Consultas
+    # ------------------------------
+    def query(self, server: str, device_ids: list, from_time, to_time, types: Optional[list] = None,
+              limit: int = DEFAULT_PAGE_SIZE, cursor: Optional[tuple] = None) -> dict:
+        """
+        Una página de eventos (del más reciente al más antiguo) y la cantidad por
+        tipo en toda la ventana, para los filtros. `next_cursor` pide la siguiente página.
+        """
+        if not device_ids:
+            return {"events": [], "next_cursor": None, "counts": {}, "total": 0}
+        devices = ','.join('?' for _ in device_ids)
+        where = f"server = ? AND device_id IN ({devices}) AND event_time >= ? AND event_time <= ?"
+        params = [server, *device_ids, time_key(from_time), time_key(to_time)]
+
+        with self._lock:
+            counts = {
+                (r['type'] or 'unknown'): r['count'] for r in self._conn.execute(
+                    f"SELECT type, COUNT(*) AS count FROM events WHERE {where} GROUP BY type", params
+                ).fetchall()
+            }
+
+            sql = f"SELECT event_id, event_time, data FROM events WHERE {where}"
+            page_params = list(params)
+            if types:
+                sql += f" AND type IN ({','.join('?' for _ in types)})"
+                page_params.extend(types)
+            if cursor is not None:
+                sql += " AND (event_time < ? OR (event_time = ? AND event_id < ?))"
+                page_params.extend([cursor[0], cursor[0], cursor[1]])
+            sql += " ORDER BY event_time DESC, event_id DESC LIMIT ?"
+            page_params.append(limit + 1)
+            rows = self._conn.execute(sql, page_params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['event_time']}|{rows[-1]['event_id']}"
+        total = sum(n for t, n in counts.items() if not types or t in types)
+        return {
+            "events": [json.loads(r['data']) for r in rows],
+            "next_cursor": next_cursor,
+            "counts": counts,
+            "total": total,
+        }
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_event_log() -> EventLog:
+    """Instancia compartida del registro de eventos"""
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                _log = EventLog()
+    return _log
@@ -0,0 +1,215 @@
+"""
+Exportación masiva de historial de posiciones en streaming (CSV o Parquet).
+Se recorre cada dispositivo en tramos de tiempo y cada tramo se escribe en
+cuanto llega de Traccar, así la memoria no depende del tamaño de la exportación.
+
+Las filas salen ordenadas por (deviceId, fixTime); para reanudar una exportación
+cortada basta con pasar la última pareja recibida como `resume_after`.
+"""
+import io
+import csv
+import json
+from typing import Optional
+from datetime import datetime, timedelta
+
+from trip_detector import parse_time
+from history_cache import to_utc
+
+DEFAULT_SLICE_HOURS = 6
+
+# Columnas fijas (mismo orden en todas las exportaciones, para poder reanudarlas)
+BASE_COLUMNS = [
+    ("deviceId", "int"),
+    ("id", "int"),
+    ("fixTime", "str"),
+    ("serverTime", "str"),
+    ("latitude", "float"),
+    ("longitude", "float"),
+    ("altitude", "float"),
+    ("speed", "float"),
+    ("course", "float"),
+    ("valid", "bool"),
+]
+
+# Atributos que se aplanan en columnas propias (incluye los OBD io* habituales)
+ATTRIBUTE_COLUMNS = [
+    ("ignition", "bool"),
+    ("motion", "bool"),
+    ("power", "float"),
+    ("battery", "float"),
+    ("odometer", "float"),
+    ("totalDistance", "float"),
+    ("distance", "float"),
+    ("hours", "float"),
+    ("sat", "float"),
+    ("hdop", "float"),
+    ("rssi", "float"),
+    ("alarm", "str"),
+    ("io30", "float"),
+    ("io31", "float"),
+    ("io32", "float"),
+    ("io33", "float"),
+    ("io35", "float"),
+    ("io36", "float"),
+    ("io37", "float"),
+    ("io38", "float"),
+    ("io39", "float"),
+    ("io43", "float"),
+    ("io48", "float"),
+    ("io60", "float"),
+    ("io250", "float"),
+    ("io252", "float"),
+    ("io389", "float"),
+]
+
+OTHER_ATTRIBUTES_COLUMN = "otherAttributes"
+ATTRIBUTE_NAMES = {name for name, _ in ATTRIBUTE_COLUMNS}
+COLUMN_NAMES = ([name for name, _ in BASE_COLUMNS] +
+                [f"attr_{name}" for name, _ in ATTRIBUTE_COLUMNS] +
+                [OTHER_ATTRIBUTES_COLUMN])
+
+
+def _convert(value, kind: str):
+    """Convierte un valor al tipo de su columna (None si no es convertible)"""
+    if value is None:
+        return None
+    try:
+        if kind == "float":
+            return float(value)
+        if kind == "int":
+            return int(value)
+        if kind == "bool":
+            return bool(value)
+        return str(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def flatten_position(position: dict) -> list:
+    """Convierte una posición de Traccar en una fila con columnas fijas"""
+    attrs = position.get("attributes") or {}
+    row = [_convert(position.get(name), kind) for name, kind in BASE_COLUMNS]
+    row.extend(_convert(attrs.get(name), kind) for name, kind in ATTRIBUTE_COLUMNS)
+    other = {k: v for k, v in attrs.items() if k not in ATTRIBUTE_NAMES}
+    row.append(json.dumps(other, separators=(",", ":")) if other else None)
+    return row
+
+
+def parse_resume_cursor(value: Optional[str]) -> Optional[tuple]:
+    """'deviceId:fixTime' -> (deviceId, datetime)"""
+    if not value:
+        return None
+    device_id, _, fix_time = value.partition(":")
+    time = parse_time(fix_time)
+    if time is None:
+        raise ValueError("resume_after debe tener el formato deviceId:fixTime")
+    return int(device_id), time
+
+
+def iter_position_slices(service, device_ids: list, from_time: datetime, to_time: datetime,
+                         slice_hours: int = DEFAULT_SLICE_HOURS, resume_after: Optional[tuple] = None,
+                         on_slice=None):
+    """
+    Genera listas de posiciones por dispositivo y tramo de tiempo, en orden.
+    Traccar incluye ambos extremos del rango, así que se descarta todo lo que no
+    sea posterior a la última posición emitida (también al reanudar).
+    `on_slice(positions)` se llama con cada tramo descargado.
+    """
+    from_time, to_time = to_utc(from_time), to_utc(to_time)
+    step = timedelta(hours=max(1, slice_hours))
+    for device_id in sorted(device_ids):
+        start, last = from_time, None
+        if resume_after is not None:
+            if device_id < resume_after[0]:
+                continue
+            if device_id == resume_after[0]:
+                last = to_utc(resume_after[1])
+                start = max(from_time, last.replace(microsecond=0))
+        while start < to_time:
+            end = min(start + step, to_time)
+            positions = service.get_position_history(device_id, start, end) or []
+            if on_slice and positions:
+                on_slice(positions)
+            timed = [(to_utc(t), p) for p in positions if (t := parse_time(p.get("fixTime")))]
+            timed.sort(key=lambda item: item[0])
+            if last is not None:
+                timed = [(t, p) for t, p in timed if t > last]
+            if timed:
+                last = timed[-1][0]
+                yield [p for _, p in timed]
+            start = end
+
+
+def stream_csv(slices):
+    """Genera el CSV por trozos: cabecera y luego un trozo por tramo"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMN_NAMES)
+    yield buffer.getvalue()
+    for positions in slices:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(flatten_position(p) for p in positions)
+        yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Destino en memoria para pyarrow que se vacía después de cada grupo de filas"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def stream_parquet(slices):
+    """Genera un archivo Parquet por trozos: un grupo de filas por tramo"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "bool": pa.bool_(), "str": pa.string()}
+    fields = [pa.field(name, arrow_types[kind]) for name, kind in BASE_COLUMNS]
+    fields += [pa.field(f"attr_{name}", arrow_types[kind]) for name, kind in ATTRIBUTE_COLUMNS]
+    fields.append(pa.field(OTHER_ATTRIBUTES_COLUMN, pa.string()))
+    schema = pa.schema(fields)
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for positions in slices:
+            rows = [flatten_position(p) for p in positions]
+            columns = list(zip(*rows))
+            table = pa.Table.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                schema=schema
+            )
+            writer.write_table(table)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    yield sink.drain()
@@ -0,0 +1,188 @@
+"""
+Contexto del chat de flota ("¿qué vehículo tuvo más alarmas esta semana?").
+
+El historial de cada vehículo se recorre en streaming, varios a la vez en
+hilos, y pasa de a una posición por los agregadores de VehicleContext: de
+cada vehículo solo se conserva su resumen (métricas, línea de la tabla y
+detalle), así la memoria no crece con la ventana ni con la flota.
+
+Los resúmenes se ordenan según la pregunta y se unen en un contexto con una
+línea por vehículo más el detalle de los primeros, hasta FLEET_CONTEXT_MAX_TOKENS.
+"""
+import asyncio
+from typing import Iterable, Optional
+
+from ai_service import format_fleet_row, format_fleet_vehicle
+from behaviour import HARSH_TYPES
+from context_aggregators import EventCounts, TripTotals, VehicleContext
+
+FLEET_CONCURRENCY = 8              # Vehículos recorriéndose a la vez (cada uno retiene solo sus agregados)
+FLEET_CONTEXT_MAX_TOKENS = 6000
+FLEET_LISTED_TRIPS = 3             # Viajes y alarmas detallados por vehículo
+FLEET_LISTED_ALARMS = 5
+
+# (palabras de la pregunta, métrica, descripción, mayor primero)
+RANKINGS = [
+    (("alarma",), "alarms", "alarmas", True),
+    (("exceso",), "overspeed", "excesos de velocidad", True),
+    (("brusc", "frenad", "aceler", "conducción", "conduce"), "harsh", "eventos bruscos", True),
+    (("combustible", "nafta", "gasolina", "tanque"), "fuel", "combustible (menor primero)", False),
+    (("viaje",), "trips", "cantidad de viajes", True),
+    (("distancia", "km", "kilómetro", "kilometro", "recorr"), "distance", "distancia recorrida", True),
+    (("velocidad", "rápido", "rapido"), "maxSpeed", "velocidad máxima", True),
+    (("desconect", "señal", "conexión", "reportando"), "lastUpdate", "última conexión (más antigua primero)", False),
+    (("tiempo", "hora", "uso", "usó", "manej"), "drivingTime", "tiempo de conducción", True),
+]
+DEFAULT_RANKING = ("distance", "distancia recorrida", True)
+
+
+# ==============================
+# RESUMEN POR VEHÍCULO
+# ==============================
+def fleet_vehicle_context(device_id: Optional[int], speed_limit: Optional[float] = None) -> VehicleContext:
+    """Agregados de un vehículo con los límites de detalle de la flota"""
+    context = VehicleContext(device_id, speed_limit, detect=True)
+    context.events = EventCounts(max_alarms=FLEET_LISTED_ALARMS)
+    context.trips = TripTotals(max_listed=FLEET_LISTED_TRIPS)
+    return context
+
+
+def summarize_context(device: dict, context: VehicleContext) -> dict:
+    """Métricas, línea de la tabla y detalle de un vehículo a partir de sus agregados"""
+    device_id = device.get('id')
+    obd = context.obd.result()
+    behaviour = context.behaviour['summary'] if context.behaviour else {}
+    summary = {
+        'deviceId': device_id,
+        'name': device.get('name') or f"Dispositivo {device_id}",
+        'metrics': {
+            'status': device.get('status'),
+            'lastUpdate': device.get('lastUpdate'),
+            'positions': context.speeds.count,
+            'trips': context.trips.count,
+            'distance': context.trips.distance,
+            'drivingTime': context.trips.duration,
+            'maxSpeed': context.speeds.max_speed,
+            'events': context.events.count,
+            'alarms': context.events.alarm_count,
+            'overspeed': max(context.events.by_type.get('deviceOverspeed', 0), behaviour.get('overspeed', 0)),
+            'harsh': sum(behaviour.get(kind, 0) for kind in HARSH_TYPES),
+            'fuel': obd.get('io43', {}).get('last'),
+        },
+    }
+    summary['row'] = format_fleet_row(summary)
+    summary['detail'] = format_fleet_vehicle(device, context)
+    return summary
+
+
+def summarize_device(device: dict, positions: Iterable, events: Iterable,
+                     speed_limit: Optional[float] = None) -> dict:
+    """Resumen de un vehículo; `positions` y `events` pueden ser listas o iteradores"""
+    context = fleet_vehicle_context(device.get('id'), speed_limit)
+    for p in positions:
+        context.add_position(p)
+    for e in events:
+        context.add_event(e)
+    return summarize_context(device, context.finish())
+
+
+async def collect_fleet(devices: list, stream, speed_limit=None) -> list:
+    """
+    Resúmenes de todos los vehículos. `stream(device_id, context)` recorre el
+    historial del vehículo sobre `context` y corre en un hilo; `speed_limit(device)`
+    el límite en nudos. Un vehículo que falla queda con `error` en lugar de métricas.
+    """
+    semaphore = asyncio.Semaphore(FLEET_CONCURRENCY)
+
+    def summarize(device: dict) -> dict:
+        context = fleet_vehicle_context(device['id'], speed_limit(device) if speed_limit else None)
+        stream(device['id'], context)
+        return summarize_context(device, context.finish())
+
+    async def one(device: dict) -> dict:
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(summarize, device)
+            except Exception as e:
+                print(f"Fleet chat error for device {device.get('id')}: {e}")
+                return {
+                    'deviceId': device.get('id'),
+                    'name': device.get('name') or f"Dispositivo {device.get('id')}",
+                    'error': str(e),
+                }
+
+    return list(await asyncio.gather(*(one(d) for d in devices)))
+
+
+# ==============================
+# CONTEXTO DE LA FLOTA
+# ==============================
+def choose_ranking(message: str) -> tuple:
+    """(métrica, descripción, mayor primero) según las palabras de la pregunta"""
+    text = message.lower()
+    for keywords, metric, label, descending in RANKINGS:
+        if any(keyword in text for keyword in keywords):
+            return metric, label, descending
+    return DEFAULT_RANKING
+
+
+def rank_summaries(summaries: list, metric: str, descending: bool = True) -> list:
+    """Vehículos con la métrica primero (en el orden pedido), luego sin dato y con error"""
+    with_value = [s for s in summaries if not s.get('error') and s['metrics'].get(metric) is not None]
+    with_value.sort(key=lambda s: s['metrics'][metric], reverse=descending)
+    chosen = {id(s) for s in with_value}
+    rest = [s for s in summaries if id(s) not in chosen]
+    rest.sort(key=lambda s: bool(s.get('error')))
+    return with_value + rest
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Misma estimación que conversations.estimate_tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+
+def build_fleet_context(summaries: list, message: str, hours: int,
+                        max_tokens: int = FLEET_CONTEXT_MAX_TOKENS) -> tuple:
+    """
+    (texto, info). Primero la tabla con una línea por vehículo en el orden de
+    la pregunta y después el detalle de los primeros mientras alcance el
+    presupuesto de tokens.
+    """
+    metric, label, descending = choose_ranking(message)
+    ranked = rank_summaries(summaries, metric, descending)
+
+    header = f"=== FLOTA: {len(ranked)} vehículos, últimas {hours} horas, ordenados por {label} ==="
+    lines = [header]
+    used = estimate_text_tokens(header)
+    listed = 0
+    for summary in ranked:
+        row = summary.get('row') or format_fleet_row(summary)
+        tokens = estimate_text_tokens(row)
+        if used + tokens > max_tokens:
+            break
+        lines.append(row)
+        used += tokens
+        listed += 1
+    if listed < len(ranked):
+        lines.append(f"... y {len(ranked) - listed} vehículos más (no incluidos por longitud)")
+
+    detailed = 0
+    for summary in ranked[:listed]:
+        detail = summary.get('detail')
+        if not detail:
+            continue
+        tokens = estimate_text_tokens(detail)
+        if used + tokens > max_tokens:
+            break
+        lines.append(detail)
+        used += tokens
+        detailed += 1
+
+    info = {
+        'ranked_by': metric,
+        'vehicles': len(ranked),
+        'listed': listed,
+        'detailed': detailed,
+        'estimated_tokens': used,
+    }
+    return "\n".join(lines), info
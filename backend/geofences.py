@@ -0,0 +1,291 @@
+"""
+Evaluación local de geocercas sobre el historial de posiciones. Permite
+calcular entradas, salidas y tiempo de permanencia en cualquier ventana, sin
+depender de los eventos geofenceEnter/geofenceExit de Traccar (que solo
+existen para las geocercas que estaban configuradas al recibir los datos).
+
+Las áreas de Traccar vienen en WKT con el orden (latitud longitud):
+POLYGON((lat lon, ...)), CIRCLE (lat lon, radio) y LINESTRING (lat lon, ...),
+esta última como corredor de `polylineDistance` metros.
+
+Cada geocerca descarta primero por rectángulo (sobre las posiciones
+ordenadas por latitud) y evalúa solo las candidatas. Con numpy la prueba de
+punto en polígono se hace para todas las candidatas a la vez, arista por
+arista; sin numpy se usa el mismo cálculo punto a punto.
+"""
+import math
+import re
+from bisect import bisect_left, bisect_right
+from typing import Optional
+
+from position_store import bbox_around
+from trip_detector import parse_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+METERS_PER_DEGREE = math.pi / 180 * 6371000
+DEFAULT_POLYLINE_DISTANCE = 25     # m, igual que geofence.polylineDistance de Traccar
+
+_NUMBER = r"[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?"
+_PAIR = re.compile(rf"({_NUMBER})\s+({_NUMBER})")
+_CIRCLE = re.compile(rf"^\s*CIRCLE\s*\(\s*({_NUMBER})\s+({_NUMBER})\s*,\s*({_NUMBER})\s*\)\s*$", re.I)
+_POLYGON = re.compile(r"^\s*POLYGON\s*\(\s*\((.*?)\)", re.I)
+_LINESTRING = re.compile(r"^\s*LINESTRING\s*\((.*)\)\s*$", re.I)
+
+
+# ==============================
+# GEOMETRÍA
+# ==============================
+# Las funciones reciben escalares o arreglos de numpy y usan solo operaciones
+# válidas para ambos, así la versión vectorizada y la de respaldo coinciden
+def _polygon_contains(lats, lons, v_lats: list, v_lons: list):
+    """Punto en polígono por paridad de cruces (rayo hacia el este)"""
+    inside = False
+    j = len(v_lats) - 1
+    for i in range(len(v_lats)):
+        yi, xi, yj, xj = v_lats[i], v_lons[i], v_lats[j], v_lons[j]
+        if yi != yj:
+            crosses = (yi > lats) != (yj > lats)
+            x_cross = (xj - xi) * (lats - yi) / (yj - yi) + xi
+            inside = inside ^ (crosses & (lons < x_cross))
+        j = i
+    return inside
+
+
+def _circle_contains(lats, lons, lat: float, lon: float, radius: float):
+    """Distancia equirectangular al centro (suficiente para radios de pocos km)"""
+    dy = (lats - lat) * METERS_PER_DEGREE
+    dx = (lons - lon) * (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return dx * dx + dy * dy <= radius * radius
+
+
+def _clip01(value):
+    if np is not None and isinstance(value, np.ndarray):
+        return np.clip(value, 0.0, 1.0)
+    return min(max(value, 0.0), 1.0)
+
+
+def _corridor_contains(lats, lons, v_lats: list, v_lons: list, width: float, cos_lat: float):
+    """A menos de `width` metros de algún tramo de la línea"""
+    inside = False
+    kx = METERS_PER_DEGREE * cos_lat
+    for i in range(len(v_lats) - 1):
+        px = (lons - v_lons[i]) * kx
+        py = (lats - v_lats[i]) * METERS_PER_DEGREE
+        bx = (v_lons[i + 1] - v_lons[i]) * kx
+        by = (v_lats[i + 1] - v_lats[i]) * METERS_PER_DEGREE
+        length2 = bx * bx + by * by
+        t = _clip01((px * bx + py * by) / length2) if length2 else 0.0
+        dx = px - t * bx
+        dy = py - t * by
+        inside = inside | (dx * dx + dy * dy <= width * width)
+    return inside
+
+
+class Geofence:
+    """Geocerca de Traccar ya interpretada, con su rectángulo envolvente"""
+
+    def __init__(self, geofence_id: int, name: str, kind: str, lats: list, lons: list, radius: float = 0.0):
+        self.id = geofence_id
+        self.name = name
+        self.kind = kind          # polygon, circle o corridor
+        self.lats = lats
+        self.lons = lons
+        self.radius = radius      # Radio del círculo o ancho del corredor (m)
+
+        if kind == "circle":
+            self.bbox = bbox_around(lats[0], lons[0], radius)
+        else:
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+            if kind == "corridor":
+                low = bbox_around(self.bbox[0], self.bbox[1], radius)
+                high = bbox_around(self.bbox[2], self.bbox[3], radius)
+                self.bbox = (low[0], low[1], high[2], high[3])
+        self._cos_lat = math.cos(math.radians((self.bbox[0] + self.bbox[2]) / 2))
+
+    def contains(self, lats, lons):
+        """Pertenencia de un punto (escalares) o de varios (arreglos de numpy)"""
+        if self.kind == "circle":
+            return _circle_contains(lats, lons, self.lats[0], self.lons[0], self.radius)
+        if self.kind == "corridor":
+            return _corridor_contains(lats, lons, self.lats, self.lons, self.radius, self._cos_lat)
+        return _polygon_contains(lats, lons, self.lats, self.lons)
+
+
+def parse_geofence(geofence: dict) -> Optional[Geofence]:
+    """Geofence a partir de una geocerca de Traccar; None si el área no se reconoce"""
+    area = geofence.get("area") or ""
+    geofence_id = geofence.get("id")
+    name = geofence.get("name") or f"Geocerca {geofence_id}"
+
+    match = _CIRCLE.match(area)
+    if match:
+        lat, lon, radius = (float(v) for v in match.groups())
+        return Geofence(geofence_id, name, "circle", [lat], [lon], radius) if radius > 0 else None
+
+    match = _POLYGON.match(area)
+    kind = "polygon"
+    if not match:
+        match = _LINESTRING.match(area)
+        kind = "corridor"
+    if not match:
+        return None
+
+    points = [(float(lat), float(lon)) for lat, lon in _PAIR.findall(match.group(1))]
+    if kind == "polygon":
+        if len(points) > 1 and points[0] == points[-1]:
+            points.pop()
+        if len(points) < 3:
+            return None
+        return Geofence(geofence_id, name, kind, [p[0] for p in points], [p[1] for p in points])
+
+    if len(points) < 2:
+        return None
+    width = (geofence.get("attributes") or {}).get("polylineDistance") or DEFAULT_POLYLINE_DISTANCE
+    return Geofence(geofence_id, name, kind, [p[0] for p in points], [p[1] for p in points], float(width))
+
+
+# ==============================
+# MOTOR
+# ==============================
+class GeofenceEngine:
+    """Evalúa muchas geocercas sobre las mismas posiciones"""
+
+    def __init__(self, geofences: list):
+        self.geofences = geofences
+
+    def inside_indices(self, lats: list, lons: list) -> dict:
+        """geofenceId -> índices (ordenados) de las posiciones dentro de la geocerca"""
+        if np is not None:
+            return self._inside_vectorized(lats, lons)
+
+        order = sorted(range(len(lats)), key=lats.__getitem__)
+        sorted_lats = [lats[i] for i in order]
+        result = {}
+        for g in self.geofences:
+            min_lat, min_lon, max_lat, max_lon = g.bbox
+            candidates = order[bisect_left(sorted_lats, min_lat):bisect_right(sorted_lats, max_lat)]
+            result[g.id] = sorted(
+                i for i in candidates
+                if min_lon <= lons[i] <= max_lon and g.contains(lats[i], lons[i])
+            )
+        return result
+
+    def _inside_vectorized(self, lats: list, lons: list) -> dict:
+        lat = np.asarray(lats, dtype=float)
+        lon = np.asarray(lons, dtype=float)
+        order = np.argsort(lat, kind="stable")
+        sorted_lat = lat[order]
+        result = {}
+        for g in self.geofences:
+            min_lat, min_lon, max_lat, max_lon = g.bbox
+            start = np.searchsorted(sorted_lat, min_lat, side="left")
+            end = np.searchsorted(sorted_lat, max_lat, side="right")
+            candidates = order[start:end]
+            candidates = candidates[(lon[candidates] >= min_lon) & (lon[candidates] <= max_lon)]
+            if candidates.size:
+                mask = np.asarray(g.contains(lat[candidates], lon[candidates]), dtype=bool)
+                candidates = candidates[np.broadcast_to(mask, candidates.shape)]
+            result[g.id] = np.sort(candidates).tolist()
+        return result
+
+
+def _runs(indices: list) -> list:
+    """Tramos (primero, último) de índices consecutivos"""
+    runs = []
+    for i in indices:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
+
+# ==============================
+# REPORTES
+# ==============================
+def geofence_report(positions: list, geofences: list, device_id: Optional[int] = None) -> dict:
+    """
+    Visitas, eventos de entrada/salida y permanencia por geocerca. Como en
+    Traccar, la entrada es la primera posición dentro y la salida la primera
+    posición fuera. Una visita ya en curso al inicio de la ventana, o que sigue
+    al final, se marca con startsInside / endsInside y se mide hasta el borde
+    de los datos. Duraciones en milisegundos.
+    """
+    rows = []
+    for p in positions:
+        fix_time = parse_time(p.get("fixTime"))
+        if fix_time is not None and p.get("latitude") is not None and p.get("longitude") is not None:
+            rows.append((fix_time, p))
+    rows.sort(key=lambda row: row[0])
+    times = [row[0] for row in rows]
+    points = [row[1] for row in rows]
+
+    parsed = []
+    skipped = []
+    for geofence in geofences:
+        g = parse_geofence(geofence)
+        if g is None:
+            skipped.append(geofence.get("id"))
+        else:
+            parsed.append(g)
+
+    inside = GeofenceEngine(parsed).inside_indices(
+        [p["latitude"] for p in points], [p["longitude"] for p in points]
+    ) if points else {}
+
+    summaries = []
+    visits = []
+    events = []
+    for g in parsed:
+        total = 0
+        count = 0
+        for first, last in _runs(inside.get(g.id, [])):
+            exit_index = last + 1 if last + 1 < len(points) else None
+            end_time = times[exit_index] if exit_index is not None else times[last]
+            duration = int((end_time - times[first]).total_seconds() * 1000)
+            visit = {
+                "geofenceId": g.id,
+                "name": g.name,
+                "enterTime": points[first].get("fixTime"),
+                "exitTime": points[exit_index].get("fixTime") if exit_index is not None else None,
+                "duration": duration,
+                "positions": last - first + 1,
+                "startsInside": first == 0,
+                "endsInside": exit_index is None,
+            }
+            visits.append(visit)
+            total += duration
+            count += 1
+            if first > 0:
+                events.append(_event("geofenceEnter", device_id, g.id, points[first]))
+            if exit_index is not None:
+                events.append(_event("geofenceExit", device_id, g.id, points[exit_index]))
+        if count:
+            summaries.append({"geofenceId": g.id, "name": g.name, "visits": count, "duration": total})
+
+    summaries.sort(key=lambda s: s["duration"], reverse=True)
+    visits.sort(key=lambda v: (v["enterTime"] or "", v["geofenceId"]))
+    events.sort(key=lambda e: (e["eventTime"] or "", e["type"] == "geofenceEnter"))
+    return {
+        "deviceId": device_id,
+        "geofences": summaries,
+        "visits": visits,
+        "events": events,
+        "skipped": skipped,
+    }
+
+
+def _event(event_type: str, device_id: Optional[int], geofence_id: int, position: dict) -> dict:
+    """Evento con la misma forma que los de /reports/events de Traccar"""
+    return {
+        "type": event_type,
+        "deviceId": device_id if device_id is not None else position.get("deviceId"),
+        "geofenceId": geofence_id,
+        "positionId": position.get("id"),
+        "eventTime": position.get("fixTime"),
+        "attributes": {},
+    }
@@ -0,0 +1,219 @@
+"""
+Caché de ventanas recientes de historial (posiciones, eventos, viajes) por dispositivo.
+Cada entrada cubre un rango [start, end]; las peticiones que caen dentro solo
+descargan de Traccar el tramo nuevo desde `end` (más un solape por los equipos
+que suben posiciones atrasadas). Las entradas que precarga el
+programador de fondo se marcan como "warm" para distinguirlas en las métricas.
+"""
+import threading
+from datetime import datetime, timedelta, timezone
+
+from trip_detector import parse_time
+from cache_backend import get_cache_backend
+
+WARM_WINDOW = timedelta(hours=24)        # Rango que se mantiene en memoria por dispositivo
+MAX_DELTA = timedelta(hours=1)           # Tramo máximo a completar sobre una entrada existente
+LATE_OVERLAP = timedelta(minutes=10)     # Se vuelve a pedir el final por datos que llegan tarde
+TRIPS_MAX_AGE = timedelta(minutes=5)     # Los viajes no se completan por tramos: se renuevan
+ENTRY_TTL_SECONDS = int((WARM_WINDOW + MAX_DELTA).total_seconds())
+
+
+def to_utc(dt: datetime) -> datetime:
+    """Normaliza un datetime (naive = UTC) a UTC con zona"""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+class CacheEntry:
+    def __init__(self, items: list, start: datetime, end: datetime, time_field: str, warmed: bool,
+                 fetched_at: datetime = None):
+        self.items = items
+        self.start = start
+        self.end = end
+        self.time_field = time_field
+        self.warmed = warmed
+        self.fetched_at = fetched_at or datetime.now(timezone.utc)
+
+    def to_dict(self) -> dict:
+        return {
+            "items": self.items,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "time_field": self.time_field,
+            "warmed": self.warmed,
+            "fetched_at": self.fetched_at.isoformat(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CacheEntry":
+        return cls(
+            data["items"],
+            datetime.fromisoformat(data["start"]),
+            datetime.fromisoformat(data["end"]),
+            data["time_field"],
+            data["warmed"],
+            datetime.fromisoformat(data["fetched_at"]),
+        )
+
+    def item_time(self, item: dict):
+        t = parse_time(item.get(self.time_field))
+        return to_utc(t) if t else None
+
+    def slice(self, from_time: datetime, to_time: datetime) -> list:
+        result = []
+        for item in self.items:
+            t = self.item_time(item)
+            if t is not None and from_time <= t <= to_time:
+                result.append(item)
+        return result
+
+    def _identity(self, item: dict):
+        item_id = item.get('id')
+        return item_id if item_id is not None else (None, item.get(self.time_field))
+
+    def extend(self, new_items: list, end: datetime):
+        """
+        Agrega un tramo nuevo sin duplicados (el tramo se solapa con lo ya
+        guardado) y recorta lo más antiguo que WARM_WINDOW. Los elementos
+        atrasados se intercalan por tiempo.
+        """
+        seen = {self._identity(i) for i in self.items}
+        last = self.item_time(self.items[-1]) if self.items else None
+        late = False
+        for item in new_items:
+            identity = self._identity(item)
+            if identity in seen:
+                continue
+            seen.add(identity)
+            t = self.item_time(item)
+            if last is not None and t is not None and t < last:
+                late = True
+            self.items.append(item)
+        if late:
+            self.items.sort(key=lambda i: self.item_time(i) or self.start)
+        self.end = end
+        self.fetched_at = datetime.now(timezone.utc)
+        cutoff = end - WARM_WINDOW
+        if self.start < cutoff:
+            self.items = [i for i in self.items if (self.item_time(i) or cutoff) >= cutoff]
+            self.start = cutoff
+
+
+class HistoryCache:
+    """
+    Caché de historiales recientes con métricas de aciertos. Las entradas viven
+    en el backend de caché configurado (en memoria o compartido entre workers).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = {
+            "warm_hits": 0,       # Servido desde una entrada precargada
+            "hits": 0,            # Servido desde una entrada creada por otra petición
+            "misses": 0,          # Descarga completa desde Traccar
+            "delta_fetches": 0,   # Tramos nuevos descargados sobre una entrada
+            "warm_refreshes": 0,  # Precargas/renovaciones del programador
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self.metrics[name] += 1
+
+    @staticmethod
+    def _key(service, device_id: int, kind: str) -> str:
+        # La cuenta (con su contraseña) forma parte de la clave: Traccar decide qué
+        # dispositivos ve cada uno y solo quien se autenticó puede leer lo descargado
+        return f"history:{kind}:{service.account_key}:{device_id}"
+
+    def _lookup(self, key: str):
+        value = get_cache_backend().get(key)
+        if isinstance(value, dict):
+            return CacheEntry.from_dict(value)
+        return value
+
+    def _put(self, key: str, entry: CacheEntry):
+        backend = get_cache_backend()
+        backend.set(key, entry.to_dict() if backend.shared else entry, ENTRY_TTL_SECONDS)
+
+    # ------------------------------
+    # Ventanas incrementales (posiciones y eventos)
+    # ------------------------------
+    def _get_window(self, kind: str, time_field: str, fetch, service, device_id: int,
+                    from_time: datetime, to_time: datetime, warm: bool = False) -> list:
+        from_time, to_time = to_utc(from_time), to_utc(to_time)
+        key = self._key(service, device_id, kind)
+        entry = self._lookup(key)
+
+        if entry is not None and entry.start <= from_time and to_time - entry.end <= MAX_DELTA:
+            changed = False
+            if to_time > entry.end:
+                # Traccar filtra por fixTime/eventTime: lo que el equipo sube tarde con un
+                # tiempo anterior a `end` solo aparece si se vuelve a pedir ese tramo
+                delta = fetch(device_id, max(entry.start, entry.end - LATE_OVERLAP), to_time) or []
+                with self._lock:
+                    entry.extend(delta, to_time)
+                self._count("delta_fetches")
+                changed = True
+            if warm:
+                entry.warmed = True
+                self._count("warm_refreshes")
+                changed = True
+            else:
+                self._count("warm_hits" if entry.warmed else "hits")
+            if changed:
+                self._put(key, entry)
+            with self._lock:
+                return entry.slice(from_time, to_time)
+
+        items = fetch(device_id, from_time, to_time) or []
+        self._count("warm_refreshes" if warm else "misses")
+        # Solo se guardan ventanas recientes, que son las que se repiten
+        if datetime.now(timezone.utc) - to_time <= MAX_DELTA and to_time - from_time <= WARM_WINDOW:
+            self._put(key, CacheEntry(list(items), from_time, to_time, time_field, warm))
+        return items
+
+    def get_positions(self, service, device_id: int, from_time: datetime, to_time: datetime,
+                      warm: bool = False, fetch=None) -> list:
+        """`fetch(device_id, from, to)` permite usar otra forma de descarga (p. ej. hedged)"""
+        return self._get_window("positions", "fixTime", fetch or service.get_position_history,
+                                service, device_id, from_time, to_time, warm)
+
+    def get_events(self, service, device_id: int, from_time: datetime, to_time: datetime,
+                   warm: bool = False) -> list:
+        return self._get_window("events", "eventTime", service.get_events,
+                                service, device_id, from_time, to_time, warm)
+
+    # ------------------------------
+    # Viajes (se renuevan completos)
+    # ------------------------------
+    def get_trips(self, service, device_id: int, from_time: datetime, to_time: datetime,
+                  warm: bool = False) -> list:
+        from_time, to_time = to_utc(from_time), to_utc(to_time)
+        key = self._key(service, device_id, "trips")
+        entry = self._lookup(key)
+        now = datetime.now(timezone.utc)
+
+        if (not warm and entry is not None and entry.start <= from_time
+                and to_time <= entry.end + MAX_DELTA and now - entry.fetched_at <= TRIPS_MAX_AGE):
+            self._count("warm_hits" if entry.warmed else "hits")
+            return entry.slice(from_time, to_time)
+
+        trips = service.get_trips(device_id, from_time, to_time) or []
+        self._count("warm_refreshes" if warm else "misses")
+        if now - to_time <= MAX_DELTA and to_time - from_time <= WARM_WINDOW:
+            self._put(key, CacheEntry(list(trips), from_time, to_time, "startTime", warm))
+        return trips
+
+    def snapshot(self) -> dict:
+        """Métricas de este proceso"""
+        with self._lock:
+            return dict(self.metrics)
+
+
+_cache = HistoryCache()
+
+
+def get_history_cache() -> HistoryCache:
+    """Instancia compartida de la caché de historiales"""
+    return _cache
@@ -0,0 +1,162 @@
+"""
+Descarga del historial de posiciones para el chat con peticiones "hedged".
+
+Se lanza la fuente principal (/positions con rango o /reports/route) y, si no
+responde dentro del umbral aprendido para ese servidor, se lanza también la
+secundaria y se usa la primera que devuelva datos. Por cada servidor Traccar se
+recuerda qué fuente funciona: las que fallan seguido se saltan durante un tiempo.
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from cache_backend import get_cache_backend
+
+DEFAULT_HEDGE_SECONDS = 3.0      # Umbral inicial mientras no hay latencias medidas
+MIN_HEDGE_SECONDS = 0.5
+MAX_HEDGE_SECONDS = 10.0
+BROKEN_AFTER_FAILURES = 3        # Fallos seguidos para considerar rota una fuente
+BROKEN_TTL_SECONDS = 60 * 60     # Tiempo que se salta una fuente rota
+LATENCY_SAMPLES = 50
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="history-hedge")
+
+
+class SourceStats:
+    """Latencias y fallos de una fuente en un servidor"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+
+    def hedge_threshold(self) -> float:
+        """Percentil 90 de las latencias con éxito"""
+        if not self.latencies:
+            return DEFAULT_HEDGE_SECONDS
+        ordered = sorted(self.latencies)
+        p90 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+        return min(max(p90, MIN_HEDGE_SECONDS), MAX_HEDGE_SECONDS)
+
+    def success_rate(self) -> float:
+        total = self.successes + self.failures
+        return self.successes / total if total else 0.5
+
+
+class HistoryFetcher:
+    """Selecciona y combina fuentes de historial por servidor"""
+
+    SOURCES = ("history", "route")
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _source_stats(self, host: str, source: str) -> SourceStats:
+        with self._lock:
+            key = (host, source)
+            if key not in self._stats:
+                self._stats[key] = SourceStats()
+            return self._stats[key]
+
+    @staticmethod
+    def _broken_key(host: str, source: str) -> str:
+        return f"history_source_broken:{host}:{source}"
+
+    def _record(self, host: str, source: str, latency: float, ok: bool):
+        stats = self._source_stats(host, source)
+        with self._lock:
+            if ok:
+                stats.successes += 1
+                stats.consecutive_failures = 0
+                stats.latencies.append(latency)
+            else:
+                stats.failures += 1
+                stats.consecutive_failures += 1
+                broken = stats.consecutive_failures >= BROKEN_AFTER_FAILURES
+        if ok:
+            get_cache_backend().delete(self._broken_key(host, source))
+        elif broken:
+            # Compartido con los demás workers a través del backend de caché
+            get_cache_backend().set(self._broken_key(host, source), True, BROKEN_TTL_SECONDS)
+
+    def _ordered_sources(self, host: str) -> list:
+        """Fuentes no marcadas como rotas, la más fiable primero"""
+        backend = get_cache_backend()
+        sources = [s for s in self.SOURCES if not backend.get(self._broken_key(host, s))]
+        if not sources:
+            # Todas marcadas: volver a intentar en el orden original
+            sources = list(self.SOURCES)
+        return sorted(sources, key=lambda s: -self._source_stats(host, s).success_rate())
+
+    def _call(self, service, source: str, device_id: int, from_time: datetime, to_time: datetime) -> list:
+        started = time.monotonic()
+        try:
+            if source == "history":
+                result = service.get_position_history(device_id, from_time, to_time) or []
+            else:
+                result = service.get_route(device_id, from_time, to_time) or []
+        except Exception as e:
+            self._record(service.base_url, source, time.monotonic() - started, False)
+            print(f"History source {source} failed: {e}")
+            raise
+        self._record(service.base_url, source, time.monotonic() - started, True)
+        return result
+
+    def fetch(self, service, device_id: int, from_time: datetime, to_time: datetime) -> tuple:
+        """
+        Retorna (posiciones, fuente). Lanza una excepción si todas las fuentes fallan.
+        """
+        host = service.base_url
+        sources = self._ordered_sources(host)
+        # Autenticar antes de lanzar peticiones en paralelo (un solo login)
+        service.get_session()
+
+        pending = {}
+        primary = sources[0]
+        pending[_executor.submit(self._call, service, primary, device_id, from_time, to_time)] = primary
+        threshold = self._source_stats(host, primary).hedge_threshold()
+        remaining = sources[1:]
+        empty_source = None
+
+        while pending:
+            done, _ = wait(pending, timeout=threshold if remaining else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # La principal tarda más que el umbral aprendido: lanzar la siguiente
+                source = remaining.pop(0)
+                print(f"Hedging history fetch with {source} after {threshold:.1f}s")
+                pending[_executor.submit(self._call, service, source, device_id, from_time, to_time)] = source
+                continue
+            for future in done:
+                source = pending.pop(future)
+                if future.exception() is None:
+                    positions = future.result()
+                    if positions:
+                        return positions, source
+                    empty_source = empty_source or source
+            # Falló o vino vacía: lanzar la siguiente de inmediato
+            if remaining and not pending:
+                source = remaining.pop(0)
+                pending[_executor.submit(self._call, service, source, device_id, from_time, to_time)] = source
+
+        if empty_source:
+            return [], empty_source
+        raise Exception(f"Ninguna fuente de historial respondió ({', '.join(sources)})")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            items = list(self._stats.items())
+        return {
+            f"{host}:{source}": {
+                "successes": s.successes,
+                "failures": s.failures,
+                "hedge_threshold": round(s.hedge_threshold(), 2),
+            }
+            for (host, source), s in items
+        }
+
+
+history_fetcher = HistoryFetcher()
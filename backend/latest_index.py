@@ -0,0 +1,182 @@
+"""
+Índice en memoria de las últimas posiciones de cada cuenta: agrupa vehículos
+en el mapa (clusters) sin recorrer la flota completa y sirve el feed de cambios
+(`/api/positions?since=`) con solo las posiciones nuevas desde un cursor.
+
+Cada posición se ubica en una grilla por nivel de zoom (celdas de
+CLUSTER_CELL_PX píxeles en proyección Web Mercator). Al actualizar solo se
+mueven los dispositivos cuya posición cambió; una consulta recorre únicamente
+las celdas visibles.
+"""
+import math
+import threading
+
+from position_store import time_key
+
+CLUSTER_CELL_PX = 80      # Tamaño de celda en píxeles de pantalla
+TILE_PX = 256
+MAX_ZOOM = 20
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def mercator(latitude: float, longitude: float) -> tuple:
+    """Coordenadas Web Mercator normalizadas en [0, 1)"""
+    lat = max(min(latitude, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    x = (longitude + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 0.999999999), min(max(y, 0.0), 0.999999999)
+
+
+def cells_per_side(zoom: int) -> int:
+    return max(1, int((2 ** zoom) * TILE_PX / CLUSTER_CELL_PX))
+
+
+def parse_bbox(value: str) -> tuple:
+    """'oeste,sur,este,norte' (formato de Leaflet toBBoxString) -> tupla de floats"""
+    parts = [float(v) for v in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox debe tener el formato oeste,sur,este,norte")
+    west, south, east, north = parts
+    if south > north:
+        raise ValueError("bbox inválido: sur mayor que norte")
+    return west, south, east, north
+
+
+class LatestPositionIndex:
+    """Últimas posiciones de una cuenta con su grilla de clusters por zoom"""
+
+    def __init__(self):
+        self.positions = {}     # device_id -> posición
+        self._coords = {}       # device_id -> (x, y) Mercator
+        self._cells = [{} for _ in range(MAX_ZOOM + 1)]   # zoom -> {(cx, cy): set(device_id)}
+        self._changed_at = {}   # device_id -> serverTime normalizado de su última posición
+        self.cursor = ""        # Mayor serverTime conocido
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cell(coords: tuple, zoom: int) -> tuple:
+        n = cells_per_side(zoom)
+        return int(coords[0] * n), int(coords[1] * n)
+
+    def _place(self, device_id: int, coords: tuple):
+        for zoom, cells in enumerate(self._cells):
+            cells.setdefault(self._cell(coords, zoom), set()).add(device_id)
+
+    def _unplace(self, device_id: int, coords: tuple):
+        for zoom, cells in enumerate(self._cells):
+            key = self._cell(coords, zoom)
+            members = cells.get(key)
+            if members is not None:
+                members.discard(device_id)
+                if not members:
+                    del cells[key]
+
+    def update(self, positions: list) -> list:
+        """Incorpora posiciones nuevas; retorna los device_id que cambiaron"""
+        changed = []
+        with self._lock:
+            for p in positions:
+                device_id = p.get('deviceId')
+                if device_id is None or p.get('latitude') is None or p.get('longitude') is None:
+                    continue
+                current = self.positions.get(device_id)
+                if current is not None and current.get('id') == p.get('id') \
+                        and current.get('fixTime') == p.get('fixTime') \
+                        and current.get('serverTime') == p.get('serverTime'):
+                    continue
+                coords = mercator(p['latitude'], p['longitude'])
+                old = self._coords.get(device_id)
+                if old != coords:
+                    if old is not None:
+                        self._unplace(device_id, old)
+                    self._place(device_id, coords)
+                    self._coords[device_id] = coords
+                self.positions[device_id] = p
+                # serverTime lo pone el servidor: no depende del reloj del equipo y
+                # también avanza con posiciones atrasadas que llegan tarde
+                changed_at = time_key(p.get('serverTime') or p.get('fixTime')) or ""
+                self._changed_at[device_id] = changed_at
+                if changed_at > self.cursor:
+                    self.cursor = changed_at
+                changed.append(device_id)
+        return changed
+
+    def changed_since(self, cursor: str) -> tuple:
+        """(posiciones cuyo serverTime es posterior al cursor, nuevo cursor)"""
+        with self._lock:
+            positions = [self.positions[d] for d, t in self._changed_at.items() if t > cursor]
+            return positions, max(self.cursor, cursor)
+
+    def retain(self, device_ids: set):
+        """Descarta los dispositivos que la cuenta ya no ve"""
+        with self._lock:
+            for device_id in [d for d in self.positions if d not in device_ids]:
+                self._unplace(device_id, self._coords.pop(device_id))
+                del self.positions[device_id]
+                del self._changed_at[device_id]
+
+    def _visible_cells(self, zoom: int, west: float, south: float, east: float, north: float) -> list:
+        cells = self._cells[zoom]
+        n = cells_per_side(zoom)
+        x0, y0 = mercator(north, west)
+        x1, y1 = mercator(south, east)
+        cx0, cx1 = int(x0 * n), int(x1 * n)
+        cy0, cy1 = int(y0 * n), int(y1 * n)
+        # Un bbox que cruza el antimeridiano se parte en dos rangos de columnas
+        x_ranges = [(cx0, cx1)] if west <= east else [(cx0, n - 1), (0, cx1)]
+
+        span = sum(b - a + 1 for a, b in x_ranges) * (cy1 - cy0 + 1)
+        if span > len(cells):
+            # Más celdas visibles que ocupadas: recorrer las ocupadas
+            return [
+                members for (cx, cy), members in cells.items()
+                if cy0 <= cy <= cy1 and any(a <= cx <= b for a, b in x_ranges)
+            ]
+        visible = []
+        for a, b in x_ranges:
+            for cx in range(a, b + 1):
+                for cy in range(cy0, cy1 + 1):
+                    members = cells.get((cx, cy))
+                    if members:
+                        visible.append(members)
+        return visible
+
+    def clusters(self, bbox: tuple, zoom: int) -> list:
+        """
+        Clusters visibles: cantidad, centroide, límites y una posición
+        representativa (la más cercana al centroide; la única si count == 1).
+        """
+        zoom = max(0, min(int(zoom), MAX_ZOOM))
+        with self._lock:
+            groups = [[self.positions[d] for d in members]
+                      for members in self._visible_cells(zoom, *bbox)]
+
+        result = []
+        for group in groups:
+            lats = [p['latitude'] for p in group]
+            lons = [p['longitude'] for p in group]
+            lat = sum(lats) / len(group)
+            lon = sum(lons) / len(group)
+            representative = min(group, key=lambda p: (p['latitude'] - lat) ** 2 + (p['longitude'] - lon) ** 2)
+            result.append({
+                'count': len(group),
+                'latitude': lat,
+                'longitude': lon,
+                'bounds': [min(lats), min(lons), max(lats), max(lons)],
+                'position': representative,
+            })
+        return result
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_latest_index(service) -> LatestPositionIndex:
+    """Índice de la cuenta (la clave incluye la contraseña: Traccar decide qué ve cada uno)"""
+    key = service.account_key
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = LatestPositionIndex()
+        return _indexes[key]
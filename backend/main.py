@@ -2,23 +2,77 @@
 Backend API para el cliente Traccar
 Actúa como proxy entre el frontend Vue y el servidor Traccar
 """
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import FastAPI, HTTPException, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Optional, List
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import asyncio
 import base64
+import hashlib
+import json
+import os
+import time
 import traceback
 
+from dotenv import load_dotenv
+
+# Antes de importar los módulos locales: varios leen su configuración del entorno al cargarse
+load_dotenv()
+
 from traccar_service import TraccarService
-from ai_service import chat_with_vehicle
+from trip_detector import TripDetector, detect_trips
+from position_store import get_position_store, get_store_writer, time_key
+from daily_rollups import get_rollup_store, merge_rollups, run_rollup_worker
+from history_cache import get_history_cache, to_utc
+from cache_warmer import activity_tracker, cache_warmer
+from cache_backend import get_cache_backend
+from upstream_limiter import UpstreamBusyError, limiter_snapshot, request_stats
+from history_fetch import history_fetcher
+from export_service import (
+    iter_position_slices, parse_resume_cursor, stream_csv, stream_parquet,
+    parquet_available, DEFAULT_SLICE_HOURS
+)
+from replay_service import ReplaySource, ReplayPlayer
+from behaviour import detect_behaviour, speed_limit_for_device
+from latest_index import get_latest_index, parse_bbox
+from conversations import get_conversation_store, split_for_compaction
+from context_aggregators import VehicleContext
+from event_log import get_event_log, parse_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from geofences import geofence_report
+from telemetry import build_telemetry, parse_fields, DEFAULT_POINTS, MIN_POINTS, MAX_POINTS, METHODS
+from response_encoding import FastJSONResponse, CompressionMiddleware, POSITION_ENCODINGS, encode_positions
 
 app = FastAPI(
     title="Traccar Client API",
     description="API proxy para conectar con Traccar",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse
 )
 
+# El chat de IA (chat_tools y el cliente de openai) se carga en la primera
+# consulta; AI_ENABLED=false lo desactiva en despliegues que no lo usan
+AI_ENABLED = os.getenv("AI_ENABLED", "true").lower() not in ("0", "false", "no", "off")
+
+# Ventanas de chat más largas que esto usan los resúmenes diarios materializados
+# (o, si no están disponibles, se recorren en streaming sin cargarlas en memoria)
+LONG_WINDOW_HOURS = 48
+MAX_CHAT_HOURS = 720
+MAX_FLEET_HOURS = 168           # El chat de flota recorre el historial de todos los vehículos
+STORE_BATCH_SIZE = 2000        # Posiciones por lote al guardar un historial en streaming
+
+# Tiempos de vida en la caché (segundos)
+DEVICES_CACHE_TTL = 30
+LATEST_POSITIONS_CACHE_TTL = 10
+GEOFENCES_CACHE_TTL = 300
+TELEMETRY_CACHE_TTL = 3600        # Ventanas ya cerradas
+TELEMETRY_LIVE_CACHE_TTL = 30     # Ventanas que llegan hasta ahora
+CHAT_CACHE_TTL = 120
+
+MAX_BATCH_CALLS = 20
+REPLAY_AUTH_TIMEOUT_SECONDS = 10  # Espera del primer mensaje (credenciales) del WebSocket de reproducción
+
 # Configurar CORS para permitir requests desde el frontend Vue
 app.add_middleware(
     CORSMiddleware,
@@ -26,8 +80,40 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Upstream-Queued-Ms", "Retry-After"],
 )
 
+# Compresión negociada (zstd, br o gzip) de las respuestas grandes
+app.add_middleware(CompressionMiddleware)
+
+
+@app.middleware("http")
+async def upstream_stats_middleware(request: Request, call_next):
+    """Informa al frontend si la petición tuvo que esperar en cola hacia Traccar"""
+    stats = {"queued_ms": 0.0, "upstream_calls": 0}
+    request_stats.set(stats)
+    response = await call_next(request)
+    if stats["queued_ms"] >= 1:
+        response.headers["X-Upstream-Queued-Ms"] = str(int(stats["queued_ms"]))
+    return response
+
+
+@app.on_event("startup")
+async def start_background_jobs():
+    """Lanza los trabajos de fondo (resúmenes diarios y precarga de caché)"""
+    app.state.rollup_task = asyncio.create_task(run_rollup_worker())
+    app.state.warmer_task = asyncio.create_task(cache_warmer.run())
+
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    for name in ("rollup_task", "warmer_task"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    # Aplicar las escrituras al almacén que quedaron encoladas
+    await asyncio.to_thread(get_store_writer().flush)
+
 
 # ==============================
 # MODELOS
@@ -52,8 +138,27 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     device_id: int
     message: str
-    hours_of_data: int = 24  # Horas de datos a incluir en el contexto
-    conversation_history: List[ChatMessage] = []
+    hours_of_data: int = Field(24, ge=1, le=MAX_CHAT_HOURS)  # Horas de datos a incluir en el contexto
+    conversation_history: List[ChatMessage] = []  # Solo si no hay conversation_id (clientes antiguos)
+    conversation_id: Optional[str] = None  # Conversación guardada en el servidor
+    mode: str = "full"  # "full" (todo el contexto en el prompt) o "tools" (datos bajo demanda)
+
+
+class FleetChatRequest(BaseModel):
+    message: str
+    hours_of_data: int = Field(24, ge=1, le=MAX_FLEET_HOURS)
+    device_ids: Optional[List[int]] = None  # Por defecto todos los vehículos del usuario
+    conversation_id: Optional[str] = None
+
+
+class BatchCall(BaseModel):
+    id: Optional[str] = None  # Lo elige el cliente para reconocer la respuesta
+    type: str                 # devices, positions, history, route, events, trips o telemetry
+    params: dict = {}
+
+
+class BatchRequest(BaseModel):
+    calls: List[BatchCall]
 
 
 # ==============================
@@ -76,9 +181,81 @@ def get_traccar_service(authorization: str = Header(...)) -> TraccarService:
             raise ValueError("Invalid credentials format")
         
         traccar_url, username, password = parts
-        return TraccarService(traccar_url, username, password)
+        service = TraccarService(traccar_url, username, password)
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid authorization: {str(e)}")
+    
+    # Registrar la sesión como activa para la precarga de caché
+    activity_tracker.touch(authorization, lambda: TraccarService(traccar_url, username, password))
+    return service
+
+
+def http_error(e: Exception) -> HTTPException:
+    """Convierte un error en HTTPException (503 + Retry-After si Traccar está saturado)"""
+    if isinstance(e, UpstreamBusyError):
+        return HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after + 0.5))}
+        )
+    return HTTPException(status_code=500, detail=str(e))
+
+
+def cached_call(key: str, ttl: float, loader):
+    """Obtiene un valor del backend de caché o lo carga y lo guarda"""
+    backend = get_cache_backend()
+    value = backend.get(key)
+    if value is None:
+        value = loader()
+        if value is not None:
+            backend.set(key, value, ttl)
+    return value
+
+
+def list_devices(service: TraccarService) -> list:
+    """Dispositivos del usuario (compartidos entre peticiones y workers durante unos segundos)"""
+    key = f"devices:{service.account_key}"
+    return cached_call(key, DEVICES_CACHE_TTL, service.get_devices) or []
+
+
+def list_geofences(service: TraccarService) -> list:
+    """Geocercas del usuario (cambian poco; se comparten unos minutos)"""
+    key = f"geofences:{service.account_key}"
+    return cached_call(key, GEOFENCES_CACHE_TTL, service.get_geofences) or []
+
+
+def latest_positions(service: TraccarService, device_id: Optional[int] = None) -> list:
+    """
+    Últimas posiciones del usuario (caché muy corta). Las de toda la flota
+    actualizan además el índice en memoria que usan los clusters del mapa.
+    """
+    key = f"positions:{service.account_key}:{device_id or 'all'}"
+    positions = cached_call(key, LATEST_POSITIONS_CACHE_TTL, lambda: service.get_positions(device_id)) or []
+    if device_id is None:
+        index = get_latest_index(service)
+        index.update(positions)
+        index.retain({p.get("deviceId") for p in positions})
+    return positions
+
+
+def store_positions(service: TraccarService, positions: list, block: bool = False):
+    """
+    Encola posiciones para el almacén local: la serialización y el upsert corren
+    en el hilo del escritor, no en la respuesta (ver StoreWriter para `block`)
+    """
+    get_store_writer().save_positions(service.base_url, positions, block)
+
+
+def store_events(service: TraccarService, events: list, block: bool = False):
+    """Encola eventos para el almacén local (como store_positions)"""
+    get_store_writer().save_events(service.base_url, events, block)
+
+
+def parse_time_param(value: Optional[str]) -> Optional[datetime]:
+    """Convierte un parámetro ISO opcional en datetime"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
 
 def encode_credentials(traccar_url: str, username: str, password: str) -> str:
@@ -88,11 +265,153 @@ def encode_credentials(traccar_url: str, username: str, password: str) -> str:
     return f"Basic {encoded}"
 
 
+# ==============================
+# CONSULTAS (compartidas por los endpoints y /api/batch)
+# ==============================
+def query_devices(service: TraccarService, authorization: str) -> dict:
+    return {"devices": list_devices(service)}
+
+
+def query_positions(service: TraccarService, authorization: str,
+                    device_id: Optional[int] = None, since: Optional[str] = None) -> dict:
+    positions = latest_positions(service, device_id)
+    if device_id is not None:
+        return {"positions": positions}
+    
+    index = get_latest_index(service)
+    if since:
+        cursor = time_key(since)
+        if cursor is None:
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        changed, cursor = index.changed_since(cursor)
+        return {"positions": changed, "cursor": cursor, "delta": True}
+    return {"positions": positions, "cursor": index.cursor, "delta": False}
+
+
+def check_encoding(encoding: Optional[str]):
+    if encoding and encoding not in POSITION_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"encoding debe ser uno de {', '.join(POSITION_ENCODINGS)}")
+
+
+def query_history(service: TraccarService, authorization: str, device_id: int,
+                  from_time: str, to_time: str, encoding: Optional[str] = None) -> dict:
+    check_encoding(encoding)
+    activity_tracker.view(authorization, device_id)
+    positions = get_history_cache().get_positions(
+        service, device_id, parse_time_param(from_time), parse_time_param(to_time)
+    )
+    store_positions(service, positions)
+    return {"positions": encode_positions(positions, encoding)}
+
+
+def query_route(service: TraccarService, authorization: str, device_id: int,
+                from_time: str, to_time: str, encoding: Optional[str] = None) -> dict:
+    check_encoding(encoding)
+    activity_tracker.view(authorization, device_id)
+    route = service.get_route(device_id, parse_time_param(from_time), parse_time_param(to_time))
+    store_positions(service, route)
+    return {"route": encode_positions(route, encoding)}
+
+
+def query_events(service: TraccarService, authorization: str, device_id: Optional[int] = None,
+                 from_time: Optional[str] = None, to_time: Optional[str] = None) -> dict:
+    from_dt = parse_time_param(from_time)
+    to_dt = parse_time_param(to_time)
+    if device_id and from_dt and to_dt:
+        activity_tracker.view(authorization, device_id)
+        events = get_history_cache().get_events(service, device_id, from_dt, to_dt)
+    else:
+        events = service.get_events(device_id, from_dt, to_dt)
+    store_events(service, events)
+    return {"events": events}
+
+
+def query_event_log(service: TraccarService, authorization: str, device_id: Optional[int] = None,
+                    from_time: Optional[str] = None, to_time: Optional[str] = None,
+                    types: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE,
+                    cursor: Optional[str] = None) -> dict:
+    limit = int(limit)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit debe estar entre 1 y {MAX_PAGE_SIZE}")
+    try:
+        after = parse_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    type_list = [t.strip() for t in (types or "").split(",") if t.strip()] or None
+    
+    to_dt = to_utc(parse_time_param(to_time) or datetime.utcnow().replace(microsecond=0))
+    from_dt = to_utc(parse_time_param(from_time) or to_dt - timedelta(hours=24))
+    if from_dt >= to_dt:
+        raise HTTPException(status_code=400, detail="from_time debe ser anterior a to_time")
+    
+    device_ids = [d['id'] for d in list_devices(service)]
+    if device_id is not None:
+        if device_id not in device_ids:
+            raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+        device_ids = [device_id]
+        activity_tracker.view(authorization, device_id)
+    
+    log = get_event_log()
+    # Las páginas siguientes (con cursor) y los cambios de filtro no vuelven a Traccar
+    # si la ventana ya está sincronizada: solo se piden los eventos nuevos
+    sync = {"received": 0, "failed": []} if after else log.sync(service, device_ids, from_dt, to_dt)
+    page = log.query(service.base_url, device_ids, from_dt, to_dt, type_list, limit, after)
+    return {"from": time_key(from_dt), "to": time_key(to_dt), **page, "sync": sync}
+
+
+def query_trips(service: TraccarService, authorization: str,
+                device_id: int, from_time: str, to_time: str) -> dict:
+    activity_tracker.view(authorization, device_id)
+    trips = get_history_cache().get_trips(
+        service, device_id, parse_time_param(from_time), parse_time_param(to_time)
+    )
+    return {"trips": trips}
+
+
+def query_telemetry(service: TraccarService, authorization: str, device_id: int,
+                    fields: str = "speed", from_time: Optional[str] = None, to_time: Optional[str] = None,
+                    points: int = DEFAULT_POINTS, method: str = "lttb") -> dict:
+    try:
+        field_list = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    points = int(points)
+    if not MIN_POINTS <= points <= MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"points debe estar entre {MIN_POINTS} y {MAX_POINTS}")
+    if method not in METHODS:
+        raise HTTPException(status_code=400, detail=f"method debe ser uno de {', '.join(METHODS)}")
+    
+    # Sin to_time: hasta el minuto actual, para que las consultas seguidas compartan la caché
+    to_dt = to_utc(parse_time_param(to_time) or datetime.utcnow().replace(second=0, microsecond=0))
+    from_dt = to_utc(parse_time_param(from_time) or to_dt - timedelta(hours=24))
+    if from_dt >= to_dt:
+        raise HTTPException(status_code=400, detail="from_time debe ser anterior a to_time")
+    
+    def load() -> dict:
+        activity_tracker.view(authorization, device_id)
+        positions = get_history_cache().get_positions(service, device_id, from_dt, to_dt)
+        store_positions(service, positions)
+        result = build_telemetry(
+            positions, field_list, from_dt.timestamp() * 1000, to_dt.timestamp() * 1000, points, method
+        )
+        return {"deviceId": device_id, "from": time_key(from_dt), "to": time_key(to_dt),
+                "positions_count": len(positions), **result}
+    
+    key = (f"telemetry:{service.account_key}:{device_id}:{time_key(from_dt)}:"
+           f"{time_key(to_dt)}:{','.join(field_list)}:{points}:{method}")
+    live = to_dt > datetime.now(timezone.utc) - timedelta(minutes=5)
+    return cached_call(key, TELEMETRY_LIVE_CACHE_TTL if live else TELEMETRY_CACHE_TTL, load)
+
+
 # ==============================
 # ENDPOINTS - AUTH
 # ==============================
+# Las llamadas a Traccar son bloqueantes (requests) y pueden esperar turno en el
+# limitador: los endpoints que las hacen son `def` (FastAPI los corre en su pool de
+# hilos) y los `async def` las pasan por asyncio.to_thread. Así una saturación de
+# Traccar no congela el loop (/api/health, WebSockets).
 @app.post("/api/auth/login")
-async def login(request: LoginRequest):
+def login(request: LoginRequest):
     """
     Valida las credenciales contra el servidor Traccar.
     Retorna un token (credenciales codificadas) si es exitoso.
@@ -131,19 +450,18 @@ async def login(request: LoginRequest):
 # ENDPOINTS - DEVICES
 # ==============================
 @app.get("/api/devices")
-async def get_devices(authorization: str = Header(...)):
+def get_devices(authorization: str = Header(...)):
     """Obtiene todos los dispositivos del usuario"""
     service = get_traccar_service(authorization)
     try:
-        devices = service.get_devices()
-        return {"devices": devices}
+        return query_devices(service, authorization)
     except Exception as e:
         print(f"Get devices error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @app.get("/api/devices/{device_id}")
-async def get_device(device_id: int, authorization: str = Header(...)):
+def get_device(device_id: int, authorization: str = Header(...)):
     """Obtiene un dispositivo específico"""
     service = get_traccar_service(authorization)
     try:
@@ -155,72 +473,322 @@ async def get_device(device_id: int, authorization: str = Header(...)):
         raise
     except Exception as e:
         print(f"Get device error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 # ==============================
 # ENDPOINTS - POSITIONS
 # ==============================
 @app.get("/api/positions")
-async def get_positions(
+def get_positions(
     device_id: Optional[int] = None,
+    since: Optional[str] = None,
     authorization: str = Header(...)
 ):
-    """Obtiene las últimas posiciones"""
+    """
+    Obtiene las últimas posiciones. Con `since` (el cursor de la respuesta
+    anterior) solo se devuelven las que cambiaron desde entonces.
+    """
     service = get_traccar_service(authorization)
     try:
-        positions = service.get_positions(device_id)
-        return {"positions": positions}
+        return query_positions(service, authorization, device_id, since)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Get positions error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @app.get("/api/positions/history")
-async def get_position_history(
+def get_position_history(
     device_id: int,
     from_time: str,
     to_time: str,
+    encoding: Optional[str] = None,
     authorization: str = Header(...)
 ):
-    """Obtiene el historial de posiciones de un dispositivo"""
+    """
+    Obtiene el historial de posiciones de un dispositivo.
+    Con encoding=compact las posiciones llegan como {"columns", "rows"}.
+    """
     service = get_traccar_service(authorization)
     try:
-        from_dt = datetime.fromisoformat(from_time.replace("Z", "+00:00"))
-        to_dt = datetime.fromisoformat(to_time.replace("Z", "+00:00"))
-        
-        positions = service.get_position_history(device_id, from_dt, to_dt)
-        return {"positions": positions}
+        return query_history(service, authorization, device_id, from_time, to_time, encoding)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Get position history error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+
+@app.get("/api/positions/near")
+def get_positions_near(
+    latitude: float,
+    longitude: float,
+    radius: float = 200,
+    device_id: Optional[int] = None,
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    authorization: str = Header(...)
+):
+    """
+    ¿Cuándo estuvo un vehículo cerca de un punto? Consulta el almacén local
+    (posiciones ya descargadas) y devuelve las visitas dentro del radio (metros).
+    """
+    service = get_traccar_service(authorization)
+    try:
+        device_ids = [d["id"] for d in list_devices(service)]
+        if device_id is not None:
+            device_ids = [d for d in device_ids if d == device_id]
+        
+        visits = get_position_store().near(
+            service.base_url, latitude, longitude, radius,
+            device_ids=device_ids,
+            from_time=parse_time_param(from_time),
+            to_time=parse_time_param(to_time)
+        )
+        return {"visits": visits}
+    except Exception as e:
+        print(f"Get positions near error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+@app.get("/api/positions/within")
+def get_positions_within(
+    min_lat: float,
+    min_lon: float,
+    max_lat: float,
+    max_lon: float,
+    device_id: Optional[int] = None,
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    authorization: str = Header(...)
+):
+    """¿Qué vehículos pasaron por un área? Consulta el almacén local por rectángulo."""
+    service = get_traccar_service(authorization)
+    try:
+        device_ids = [d["id"] for d in list_devices(service)]
+        if device_id is not None:
+            device_ids = [d for d in device_ids if d == device_id]
+        
+        devices = get_position_store().within(
+            service.base_url, min_lat, min_lon, max_lat, max_lon,
+            device_ids=device_ids,
+            from_time=parse_time_param(from_time),
+            to_time=parse_time_param(to_time)
+        )
+        return {"devices": devices}
+    except Exception as e:
+        print(f"Get positions within error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+@app.get("/api/positions/clusters")
+def get_position_clusters(
+    bbox: str,
+    zoom: int,
+    authorization: str = Header(...)
+):
+    """
+    Vehículos agrupados para el mapa: solo las celdas visibles en `bbox`
+    (oeste,sur,este,norte) al nivel de `zoom`, con su cantidad, centroide y
+    una posición representativa. La respuesta crece con lo visible, no con la flota.
+    """
+    service = get_traccar_service(authorization)
+    try:
+        area = parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        latest_positions(service)
+        clusters = get_latest_index(service).clusters(area, zoom)
+        return {
+            "zoom": zoom,
+            "total": sum(c["count"] for c in clusters),
+            "clusters": clusters
+        }
+    except Exception as e:
+        print(f"Get position clusters error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+@app.get("/api/export")
+def export_positions(
+    from_time: str,
+    to_time: str,
+    device_ids: Optional[str] = None,
+    group_ids: Optional[str] = None,
+    format: str = "csv",
+    slice_hours: int = DEFAULT_SLICE_HOURS,
+    resume_after: Optional[str] = None,
+    authorization: str = Header(...)
+):
+    """
+    Exporta el historial de varios dispositivos en streaming (CSV o Parquet).
+    device_ids y group_ids son listas separadas por comas; sin ninguna de las
+    dos se exportan todos los dispositivos del usuario. Las filas salen ordenadas
+    por (deviceId, fixTime): para reanudar, resume_after=deviceId:fixTime de la
+    última fila recibida.
+    """
+    service = get_traccar_service(authorization)
+    if format not in ("csv", "parquet"):
+        raise HTTPException(status_code=400, detail="Formato no soportado (csv o parquet)")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="Exportar a Parquet requiere instalar pyarrow")
+    try:
+        from_dt = parse_time_param(from_time)
+        to_dt = parse_time_param(to_time)
+        resume = parse_resume_cursor(resume_after)
+        wanted_devices = {int(d) for d in device_ids.split(",") if d.strip()} if device_ids else set()
+        wanted_groups = {int(g) for g in group_ids.split(",") if g.strip()} if group_ids else set()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        devices = list_devices(service)
+    except Exception as e:
+        print(f"Export error: {traceback.format_exc()}")
+        raise http_error(e)
+    
+    selected = [
+        d["id"] for d in devices
+        if (not wanted_devices and not wanted_groups)
+        or d["id"] in wanted_devices or d.get("groupId") in wanted_groups
+    ]
+    if not selected:
+        raise HTTPException(status_code=404, detail="Ningún dispositivo coincide con la selección")
+    
+    slices = iter_position_slices(
+        service, selected, from_dt, to_dt,
+        slice_hours=slice_hours, resume_after=resume,
+        on_slice=lambda positions: store_positions(service, positions)
+    )
+    if format == "parquet":
+        body, media_type = stream_parquet(slices), "application/vnd.apache.parquet"
+    else:
+        body, media_type = stream_csv(slices), "text/csv"
+    
+    filename = f"export_{from_dt:%Y%m%d}_{to_dt:%Y%m%d}.{format}"
+    # Generadores síncronos: Starlette los recorre en un hilo sin bloquear el loop
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.websocket("/api/replay")
+async def replay_history(
+    websocket: WebSocket,
+    device_id: int,
+    from_time: str,
+    to_time: str,
+    speed: float = 10
+):
+    """
+    Reproduce el historial de un dispositivo al ritmo indicado (1x-500x).
+    El navegador no puede poner headers en un WebSocket y en la URL quedarían en
+    los logs de proxies y de uvicorn: el primer mensaje del cliente trae las
+    credenciales, {"action": "auth", "token": <mismo valor que el header Authorization>}.
+    Órdenes siguientes: {"action": "play" | "pause" | "seek" | "speed", ...}
+    """
+    await websocket.accept()
+    try:
+        message = await asyncio.wait_for(websocket.receive_json(), REPLAY_AUTH_TIMEOUT_SECONDS)
+        token = message.get("token") if message.get("action") == "auth" else None
+        if not token:
+            raise ValueError("El primer mensaje debe ser {action: 'auth', token}")
+        authorization = token if token.startswith("Basic ") else f"Basic {token}"
+        service = get_traccar_service(authorization)
+        from_dt = parse_time_param(from_time)
+        to_dt = parse_time_param(to_time)
+        devices = await asyncio.to_thread(list_devices, service)
+    except WebSocketDisconnect:
+        return
+    except Exception as e:
+        print(f"Replay setup error: {e}")
+        await websocket.close(code=4401)
+        return
+    if device_id not in {d["id"] for d in devices}:
+        await websocket.close(code=4404)
+        return
+    
+    activity_tracker.view(authorization, device_id)
+    player = ReplayPlayer(ReplaySource(service, device_id), from_dt, to_dt, websocket.send_json, speed)
+    
+    async def play():
+        try:
+            await player.run()
+        except Exception as e:
+            print(f"Replay error: {traceback.format_exc()}")
+            detail = str(e)
+            if isinstance(e, UpstreamBusyError):
+                detail = f"{e} (reintenta en {int(e.retry_after + 0.5)} s)"
+            await websocket.send_json({"type": "error", "detail": detail})
+            await websocket.close(code=1011)
+    
+    play_task = asyncio.create_task(play())
+    try:
+        while True:
+            await player.command(await websocket.receive_json())
+    except (WebSocketDisconnect, RuntimeError, ValueError):
+        pass
+    finally:
+        play_task.cancel()
 
 
 @app.get("/api/route")
-async def get_route(
+def get_route(
     device_id: int,
     from_time: str,
     to_time: str,
+    encoding: Optional[str] = None,
     authorization: str = Header(...)
 ):
-    """Obtiene la ruta de un dispositivo (para dibujar en el mapa)"""
+    """Obtiene la ruta de un dispositivo (para dibujar en el mapa); admite encoding=compact"""
     service = get_traccar_service(authorization)
     try:
-        from_dt = datetime.fromisoformat(from_time.replace("Z", "+00:00"))
-        to_dt = datetime.fromisoformat(to_time.replace("Z", "+00:00"))
-        
-        route = service.get_route(device_id, from_dt, to_dt)
-        return {"route": route}
+        return query_route(service, authorization, device_id, from_time, to_time, encoding)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Get route error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+
+# ==============================
+# ENDPOINTS - TELEMETRY
+# ==============================
+@app.get("/api/telemetry")
+def get_telemetry(
+    device_id: int,
+    fields: str = "speed",
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    points: int = DEFAULT_POINTS,
+    method: str = "lttb",
+    authorization: str = Header(...)
+):
+    """
+    Series para gráficos (velocidad, io36, io32, io43...) reducidas a `points`
+    puntos por campo con LTTB o, con method=minmax, a mínimo/máximo/promedio
+    por tramo. Por defecto las últimas 24 horas.
+    """
+    service = get_traccar_service(authorization)
+    try:
+        return query_telemetry(service, authorization, device_id, fields, from_time, to_time, points, method)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Get telemetry error: {traceback.format_exc()}")
+        raise http_error(e)
 
 
 # ==============================
 # ENDPOINTS - EVENTS
 # ==============================
 @app.get("/api/events")
-async def get_events(
+def get_events(
     device_id: Optional[int] = None,
     from_time: Optional[str] = None,
     to_time: Optional[str] = None,
@@ -229,23 +797,41 @@ async def get_events(
     """Obtiene eventos/alertas"""
     service = get_traccar_service(authorization)
     try:
-        from_dt = None
-        to_dt = None
-        
-        if from_time:
-            from_dt = datetime.fromisoformat(from_time.replace("Z", "+00:00"))
-        if to_time:
-            to_dt = datetime.fromisoformat(to_time.replace("Z", "+00:00"))
-        
-        events = service.get_events(device_id, from_dt, to_dt)
-        return {"events": events}
+        return query_events(service, authorization, device_id, from_time, to_time)
     except Exception as e:
         print(f"Get events error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+
+@app.get("/api/events/log")
+def get_event_log_page(
+    device_id: Optional[int] = None,
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    types: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    authorization: str = Header(...)
+):
+    """
+    Eventos del registro local, del más reciente al más antiguo. Antes de la
+    primera página se piden a Traccar solo los eventos posteriores a los ya
+    guardados; `types` (ej: "alarm,deviceOverspeed") filtra y `cursor`
+    (el `next_cursor` anterior) pagina sin volver a Traccar. Por defecto las
+    últimas 24 horas de todos los dispositivos.
+    """
+    service = get_traccar_service(authorization)
+    try:
+        return query_event_log(service, authorization, device_id, from_time, to_time, types, limit, cursor)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Get event log error: {traceback.format_exc()}")
+        raise http_error(e)
 
 
 @app.get("/api/trips")
-async def get_trips(
+def get_trips(
     device_id: int,
     from_time: str,
     to_time: str,
@@ -254,14 +840,217 @@ async def get_trips(
     """Obtiene los viajes de un dispositivo"""
     service = get_traccar_service(authorization)
     try:
-        from_dt = datetime.fromisoformat(from_time.replace("Z", "+00:00"))
-        to_dt = datetime.fromisoformat(to_time.replace("Z", "+00:00"))
-        
-        trips = service.get_trips(device_id, from_dt, to_dt)
-        return {"trips": trips}
+        return query_trips(service, authorization, device_id, from_time, to_time)
     except Exception as e:
         print(f"Get trips error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+
+@app.get("/api/behaviour")
+def get_behaviour(
+    device_id: int,
+    from_time: str,
+    to_time: str,
+    speed_limit: Optional[float] = None,
+    authorization: str = Header(...)
+):
+    """
+    Conducción detectada a partir del historial: aceleraciones, frenadas y giros
+    bruscos, excesos de velocidad y ralentí prolongado. `speed_limit` en km/h;
+    por defecto el speedLimit configurado en Traccar para el dispositivo.
+    """
+    service = get_traccar_service(authorization)
+    try:
+        from_dt = parse_time_param(from_time)
+        to_dt = parse_time_param(to_time)
+        device = next((d for d in list_devices(service) if d["id"] == device_id), None)
+        if device is None:
+            raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+        
+        activity_tracker.view(authorization, device_id)
+        positions = get_history_cache().get_positions(service, device_id, from_dt, to_dt)
+        store_positions(service, positions)
+        behaviour = detect_behaviour(positions, device_id, speed_limit_for_device(device, speed_limit))
+        return {**behaviour, "positions_count": len(positions)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Get behaviour error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+@app.get("/api/geofences")
+def get_geofences(authorization: str = Header(...)):
+    """Obtiene las geocercas del usuario"""
+    service = get_traccar_service(authorization)
+    try:
+        return {"geofences": list_geofences(service)}
+    except Exception as e:
+        print(f"Get geofences error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+@app.get("/api/reports/geofences")
+def get_geofence_report(
+    device_id: int,
+    from_time: str,
+    to_time: str,
+    geofence_ids: Optional[str] = None,
+    authorization: str = Header(...)
+):
+    """
+    Entradas, salidas y tiempo de permanencia en cada geocerca, calculados
+    sobre el historial (sirve para geocercas creadas después de los datos).
+    `geofence_ids` separados por comas; por defecto todas las del usuario.
+    """
+    service = get_traccar_service(authorization)
+    try:
+        wanted = {int(g) for g in geofence_ids.split(",") if g.strip()} if geofence_ids else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="geofence_ids debe ser una lista de números separados por comas")
+    try:
+        from_dt = parse_time_param(from_time)
+        to_dt = parse_time_param(to_time)
+        if not any(d["id"] == device_id for d in list_devices(service)):
+            raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+        
+        geofences = list_geofences(service)
+        if wanted is not None:
+            geofences = [g for g in geofences if g.get("id") in wanted]
+        
+        activity_tracker.view(authorization, device_id)
+        positions = get_history_cache().get_positions(service, device_id, from_dt, to_dt)
+        store_positions(service, positions)
+        report = geofence_report(positions, geofences, device_id)
+        return {**report, "positions_count": len(positions)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Get geofence report error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+@app.get("/api/reports/daily")
+def get_daily_report(
+    from_date: str,
+    to_date: str,
+    device_id: Optional[int] = None,
+    authorization: str = Header(...)
+):
+    """
+    Resúmenes diarios (distancia, conducción, ralentí, alarmas, OBD) por dispositivo.
+    Con device_id se completan los días que falten descargándolos de Traccar;
+    sin él se responde para toda la flota solo con lo ya materializado.
+    """
+    service = get_traccar_service(authorization)
+    try:
+        from_day = datetime.fromisoformat(from_date).date()
+        to_day = datetime.fromisoformat(to_date).date()
+        devices_by_id = {d["id"]: d for d in list_devices(service)}
+        device_ids = list(devices_by_id)
+        rollups = get_rollup_store()
+        
+        if device_id is not None:
+            if device_id not in devices_by_id:
+                raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+            # Mismo límite de velocidad que el chat, para que los excesos coincidan
+            days, missing_days = rollups.ensure_days(
+                service, device_id, from_day, min(to_day, datetime.utcnow().date()),
+                speed_limit_for_device(devices_by_id[device_id])
+            )
+        else:
+            days = rollups.get_range(service.base_url, device_ids, from_day.isoformat(), to_day.isoformat())
+            missing_days = []
+        
+        devices = {}
+        for day in days:
+            devices.setdefault(day["deviceId"], []).append(day)
+        if missing_days:
+            devices.setdefault(device_id, [])
+        
+        return {
+            "devices": [
+                {
+                    "deviceId": d,
+                    # Días que no se pudieron descargar de Traccar (no están en los totales)
+                    "totals": merge_rollups(items, missing_days if d == device_id else None),
+                    "days": items,
+                }
+                for d, items in devices.items()
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Get daily report error: {traceback.format_exc()}")
+        raise http_error(e)
+
+
+# ==============================
+# ENDPOINTS - BATCH
+# ==============================
+BATCH_QUERIES = {
+    "devices": query_devices,
+    "positions": query_positions,
+    "history": query_history,
+    "route": query_route,
+    "events": query_events,
+    "event_log": query_event_log,
+    "trips": query_trips,
+    "telemetry": query_telemetry,
+}
+
+
+def batch_error(e: Exception) -> dict:
+    """Error de una consulta del lote con el mismo código que tendría su endpoint"""
+    if isinstance(e, HTTPException):
+        return {"status": e.status_code, "error": e.detail}
+    if isinstance(e, UpstreamBusyError):
+        return {"status": 503, "error": str(e), "retry_after": int(e.retry_after + 0.5)}
+    if isinstance(e, (TypeError, ValueError)):
+        return {"status": 400, "error": f"Parámetros inválidos: {e}"}
+    return {"status": 500, "error": str(e)}
+
+
+@app.post("/api/batch")
+async def batch(request: BatchRequest, authorization: str = Header(...)):
+    """
+    Ejecuta varias consultas en una sola petición (p. ej. dispositivos y
+    posiciones del panel, o historial y viajes). Comparten una sesión de
+    Traccar y se ejecutan en paralelo; cada resultado trae su propio `status`,
+    de modo que el fallo de una no afecta a las demás.
+    """
+    if not request.calls:
+        return {"results": []}
+    if len(request.calls) > MAX_BATCH_CALLS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_BATCH_CALLS} consultas por lote")
+    
+    service = get_traccar_service(authorization)
+    try:
+        # Un único login antes de repartir las consultas entre hilos
+        await asyncio.to_thread(service.get_session)
+    except Exception as e:
+        print(f"Batch login error: {traceback.format_exc()}")
+        raise http_error(e)
+    
+    async def run(call: BatchCall) -> dict:
+        query = BATCH_QUERIES.get(call.type)
+        if query is None:
+            return {"status": 400, "error": f"Tipo de consulta desconocido: {call.type}"}
+        try:
+            data = await asyncio.to_thread(query, service, authorization, **call.params)
+            return {"status": 200, "data": data}
+        except Exception as e:
+            print(f"Batch {call.type} error: {e}")
+            return batch_error(e)
+    
+    results = await asyncio.gather(*(run(call) for call in request.calls))
+    return {
+        "results": [
+            {"id": call.id, "type": call.type, **result}
+            for call, result in zip(request.calls, results)
+        ]
+    }
 
 
 # ==============================
@@ -275,102 +1064,426 @@ async def chat(
     """
     Chat con IA para consultar sobre el vehículo.
     Recopila datos del dispositivo y los envía a OpenAI junto con el mensaje del usuario.
+    La misma pregunta repetida en poco tiempo se responde desde la caché.
+    
+    El historial se guarda en el servidor: la respuesta trae `conversation_id`
+    y el siguiente turno solo envía ese id y el mensaje nuevo.
     """
+    if not AI_ENABLED:
+        raise HTTPException(status_code=503, detail="El chat de IA está deshabilitado en este servidor")
     service = get_traccar_service(authorization)
     
+    conversations = get_conversation_store()
+    conversation = None
+    if request.conversation_id:
+        conversation = conversations.load(request.conversation_id, service, request.device_id)
+    if conversation is None:
+        # Nueva, expirada o de otro dispositivo: se empieza otra
+        conversation = conversations.create(
+            service, request.device_id,
+            [{"role": m.role, "content": m.content} for m in request.conversation_history]
+        )
+    await compact_conversation(conversation)
+    
+    # La clave incluye el estado de la conversación: la misma pregunta en otro
+    # punto de la conversación no reutiliza la respuesta
+    fingerprint = json.dumps(
+        [
+            service.account_key,
+            request.model_dump(exclude={"conversation_id", "conversation_history"}),
+            conversation["summary"], conversation["messages"]
+        ],
+        sort_keys=True, ensure_ascii=False
+    )
+    cache_key = "chat:" + hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+    cached = get_cache_backend().get(cache_key)
+    if cached is not None:
+        result = {**cached, "cached": True}
+    else:
+        result = await answer_chat(service, request, authorization, conversation)
+        get_cache_backend().set(cache_key, result, CHAT_CACHE_TTL)
+    
+    conversation["messages"].append({"role": "user", "content": request.message})
+    conversation["messages"].append({"role": "assistant", "content": result["response"]})
+    conversations.save(conversation)
+    return {**result, "conversation_id": conversation["id"]}
+
+
+@app.post("/api/chat/fleet")
+async def chat_fleet(
+    request: FleetChatRequest,
+    authorization: str = Header(...)
+):
+    """
+    Chat con IA sobre toda la flota (o los `device_ids` indicados): compara
+    vehículos con los datos de las últimas `hours_of_data` horas. Mismo manejo
+    de conversación y caché que /api/chat.
+    """
+    if not AI_ENABLED:
+        raise HTTPException(status_code=503, detail="El chat de IA está deshabilitado en este servidor")
+    service = get_traccar_service(authorization)
+    
+    # Las conversaciones de flota se guardan sin dispositivo
+    conversations = get_conversation_store()
+    conversation = None
+    if request.conversation_id:
+        conversation = conversations.load(request.conversation_id, service, None)
+    if conversation is None:
+        conversation = conversations.create(service, None)
+    await compact_conversation(conversation)
+    
+    fingerprint = json.dumps(
+        [
+            "fleet", service.account_key,
+            request.model_dump(exclude={"conversation_id"}),
+            conversation["summary"], conversation["messages"]
+        ],
+        sort_keys=True, ensure_ascii=False
+    )
+    cache_key = "chat:" + hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+    cached = get_cache_backend().get(cache_key)
+    if cached is not None:
+        result = {**cached, "cached": True}
+    else:
+        result = await answer_fleet_chat(service, request, conversation)
+        get_cache_backend().set(cache_key, result, CHAT_CACHE_TTL)
+    
+    conversation["messages"].append({"role": "user", "content": request.message})
+    conversation["messages"].append({"role": "assistant", "content": result["response"]})
+    conversations.save(conversation)
+    return {**result, "conversation_id": conversation["id"]}
+
+
+async def answer_fleet_chat(service: TraccarService, request: FleetChatRequest, conversation: dict) -> dict:
+    """Resume cada vehículo (historiales en streaming, varios a la vez) y consulta a la IA"""
+    from fleet_context import collect_fleet, build_fleet_context
+    from ai_service import chat_with_fleet
+    try:
+        devices = await asyncio.to_thread(list_devices, service)
+        if request.device_ids:
+            wanted = set(request.device_ids)
+            devices = [d for d in devices if d["id"] in wanted]
+        if not devices:
+            raise HTTPException(status_code=404, detail="No hay dispositivos para consultar")
+        
+        to_time = datetime.utcnow()
+        from_time = to_time - timedelta(hours=request.hours_of_data)
+        
+        def stream(device_id: int, context: VehicleContext):
+            # El límite de velocidad ya viene en el contexto que arma collect_fleet
+            stream_chat_context(service, device_id, from_time, to_time, None, context)
+        
+        started = time.perf_counter()
+        summaries = await collect_fleet(devices, stream, speed_limit_for_device)
+        fleet_context, info = await asyncio.to_thread(
+            build_fleet_context, summaries, request.message, request.hours_of_data
+        )
+        print(f"Fleet context for {len(devices)} devices in {time.perf_counter() - started:.1f}s: {info}")
+        
+        response = await chat_with_fleet(
+            user_message=request.message,
+            fleet_context=fleet_context,
+            conversation_history=conversation["messages"],
+            conversation_summary=conversation["summary"]
+        )
+        
+        return {
+            "response": response,
+            "data_summary": {
+                **info,
+                "failed_devices": [s["deviceId"] for s in summaries if s.get("error")],
+                "positions_count": sum(s["metrics"]["positions"] for s in summaries if not s.get("error")),
+                "hours_analyzed": request.hours_of_data
+            }
+        }
+    except HTTPException:
+        raise
+    except UpstreamBusyError as e:
+        raise http_error(e)
+    except Exception as e:
+        print(f"Fleet chat error: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Error en el chat: {str(e)}")
+
+
+async def compact_conversation(conversation: dict):
+    """Resume los mensajes antiguos si el historial superó el umbral de tokens"""
+    split = split_for_compaction(conversation["messages"])
+    if split is None:
+        return
+    older, recent = split
+    from ai_service import summarize_conversation
+    try:
+        conversation["summary"] = await summarize_conversation(conversation["summary"], older)
+        print(f"Compacted {len(older)} chat messages into the conversation summary")
+    except Exception as e:
+        # Sin resumen se descartan igual: el prompt no debe crecer sin límite
+        print(f"Error summarizing conversation: {e}")
+    conversation["messages"] = recent
+
+
+async def answer_chat(service: TraccarService, request: ChatRequest, authorization: str,
+                      conversation: dict) -> dict:
+    """Recopila los datos del vehículo y consulta a la IA"""
     try:
         # Calcular rango de tiempo
         to_time = datetime.utcnow()
         from_time = to_time - timedelta(hours=request.hours_of_data)
         
         # Obtener datos del dispositivo
-        device = service.get_device(request.device_id)
+        device = await asyncio.to_thread(service.get_device, request.device_id)
         if not device:
             raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+        activity_tracker.view(authorization, request.device_id)
         
-        # Recopilar datos en paralelo (posiciones, eventos, viajes)
-        positions = []
-        events = []
-        trips = []
+        if request.mode == "tools":
+            return await chat_with_tools(service, device, request, conversation)
         
-        # Intentar obtener posiciones del historial
-        try:
-            positions = service.get_position_history(request.device_id, from_time, to_time)
-            print(f"Got {len(positions)} positions from history")
-        except Exception as e:
-            print(f"Error getting position history for chat: {e}")
-            # Fallback: intentar con get_route
+        # Ventanas largas: los días ya terminados salen de los resúmenes diarios
+        # y solo se descarga en detalle el día en curso
+        daily_rollups = []
+        missing_days = []
+        if request.hours_of_data > LONG_WINDOW_HOURS:
+            today = to_time.date()
+            # Solo los días enteros dentro de la ventana salen de los resúmenes diarios;
+            # el tramo del primer día se resume aparte con sus propios datos
+            first_day = from_time.date()
+            if from_time.time() != datetime.min.time():
+                first_day += timedelta(days=1)
+            head_end = datetime(first_day.year, first_day.month, first_day.day)
             try:
-                positions = service.get_route(request.device_id, from_time, to_time)
-                print(f"Got {len(positions)} positions from route")
-            except Exception as e2:
-                print(f"Error getting route for chat: {e2}")
-                # Último intento: obtener posición actual
-                try:
-                    current_positions = service.get_positions(request.device_id)
-                    if current_positions:
-                        positions = current_positions
-                        print(f"Got {len(positions)} current positions")
-                except Exception as e3:
-                    print(f"Error getting current positions: {e3}")
-        
-        try:
-            events = service.get_events(request.device_id, from_time, to_time)
-            print(f"Got {len(events)} events")
-        except Exception as e:
-            print(f"Error getting events for chat: {e}")
+                rollups = get_rollup_store()
+                daily_rollups, missing_days = await asyncio.to_thread(
+                    rollups.ensure_days, service, request.device_id, first_day, today - timedelta(days=1),
+                    speed_limit_for_device(device)
+                )
+                if from_time < head_end:
+                    daily_rollups.append(await asyncio.to_thread(
+                        rollups.window_rollup, service, request.device_id, from_time, head_end,
+                        speed_limit_for_device(device)
+                    ))
+                from_time = datetime(today.year, today.month, today.day)
+                print(f"Using {len(daily_rollups)} daily rollups ({len(missing_days)} days missing)")
+            except Exception as e:
+                print(f"Error getting daily rollups for chat: {e}")
+                daily_rollups = []
+                missing_days = []
         
-        try:
-            trips = service.get_trips(request.device_id, from_time, to_time)
-            if trips:
-                print(f"Got {len(trips)} trips")
-                for i, trip in enumerate(trips[:3]):  # Log primeros 3
-                    print(f"  Trip {i+1}: {trip.get('startTime')} -> {trip.get('endTime')}, {trip.get('distance', 0)/1000:.1f}km")
-            else:
-                print(f"No trips returned (trips={trips})")
-        except Exception as e:
-            print(f"Error getting trips for chat: {e}")
-            import traceback
-            traceback.print_exc()
-        
-        # Convertir historial de conversación al formato esperado
-        conversation_history = [
-            {"role": msg.role, "content": msg.content}
-            for msg in request.conversation_history
-        ]
+        speed_limit = speed_limit_for_device(device)
+        places = []
+        if to_time - from_time > timedelta(hours=LONG_WINDOW_HOURS):
+            # Sin resúmenes diarios: el historial se recorre en streaming y
+            # solo se conservan los agregados (memoria acotada con cualquier ventana)
+            positions_source = "stream"
+            try:
+                context = await asyncio.to_thread(
+                    stream_chat_context, service, request.device_id, from_time, to_time, speed_limit
+                )
+                print(f"Streamed {context.speeds.count} positions and {context.events.count} events")
+            except Exception as e:
+                print(f"Error streaming history for chat: {e}")
+                positions_source = "current"
+                context = VehicleContext.from_lists(
+                    await asyncio.to_thread(latest_positions, service, request.device_id), [], []
+                )
+            if context.speeds.count > 1:
+                try:
+                    await asyncio.to_thread(get_store_writer().flush)
+                    places = await asyncio.to_thread(
+                        get_position_store().frequent_places, service.base_url, request.device_id, from_time, to_time
+                    )
+                except Exception as e:
+                    print(f"Error getting frequent places for chat: {e}")
+        else:
+            context, positions_source, places = await asyncio.to_thread(
+                collect_chat_data, service, request.device_id, from_time, to_time, speed_limit
+            )
         
         # Enviar a la IA
+        from ai_service import chat_with_vehicle
         response = await chat_with_vehicle(
             user_message=request.message,
             device=device,
-            positions=positions,
-            events=events,
-            trips=trips,
-            conversation_history=conversation_history
+            context=context,
+            places=places,
+            daily=merge_rollups(daily_rollups, missing_days) if daily_rollups or missing_days else None,
+            conversation_history=conversation["messages"],
+            conversation_summary=conversation["summary"]
         )
         
         return {
             "response": response,
             "data_summary": {
-                "positions_count": len(positions),
-                "events_count": len(events),
-                "trips_count": len(trips),
+                "positions_count": context.speeds.count,
+                "events_count": context.events.count,
+                "trips_count": context.trips.count,
+                "days_from_rollups": len(daily_rollups),
+                "missing_days": missing_days,
+                "positions_source": positions_source,
                 "hours_analyzed": request.hours_of_data
             }
         }
         
     except HTTPException:
         raise
+    except UpstreamBusyError as e:
+        raise http_error(e)
     except Exception as e:
         print(f"Chat error: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error en el chat: {str(e)}")
 
 
+def collect_chat_data(service: TraccarService, device_id: int, from_time: datetime,
+                      to_time: datetime, speed_limit: float) -> tuple:
+    """
+    Datos de una ventana corta para el chat: (contexto, origen de las posiciones,
+    zonas frecuentes). Hace llamadas bloqueantes a Traccar: se ejecuta en un hilo.
+    """
+    positions = []
+    events = []
+    trips = []
+    places = []
+    
+    # Historial de posiciones: fuente principal con respaldo "hedged"
+    # (ver history_fetch.py); si todo falla, la última posición conocida
+    positions_source = "cache"
+    
+    def fetch_hedged(device_id, from_dt, to_dt):
+        nonlocal positions_source
+        result, positions_source = history_fetcher.fetch(service, device_id, from_dt, to_dt)
+        return result
+    
+    try:
+        positions = get_history_cache().get_positions(
+            service, device_id, from_time, to_time, fetch=fetch_hedged
+        )
+        print(f"Got {len(positions)} positions from {positions_source}")
+    except Exception as e:
+        print(f"Error getting position history for chat: {e}")
+        try:
+            positions = latest_positions(service, device_id)
+            positions_source = "current"
+            print(f"Got {len(positions)} current positions")
+        except Exception as e2:
+            print(f"Error getting current positions: {e2}")
+    
+    try:
+        events = get_history_cache().get_events(service, device_id, from_time, to_time)
+        store_events(service, events)
+        print(f"Got {len(events)} events")
+    except Exception as e:
+        print(f"Error getting events for chat: {e}")
+    
+    # Guardar en el almacén local y obtener las zonas más frecuentes
+    if len(positions) > 1:
+        store_positions(service, positions)
+        try:
+            get_store_writer().flush()
+            places = get_position_store().frequent_places(
+                service.base_url, device_id, from_time, to_time
+            )
+        except Exception as e:
+            print(f"Error getting frequent places for chat: {e}")
+    
+    # Viajes: se detectan localmente a partir de las posiciones ya descargadas.
+    # Solo si no hay historial suficiente se recurre a /reports/trips.
+    if len(positions) > 1:
+        trips = detect_trips(positions, device_id=device_id)
+        print(f"Detected {len(trips)} trips locally")
+    else:
+        try:
+            trips = get_history_cache().get_trips(service, device_id, from_time, to_time)
+            if trips:
+                print(f"Got {len(trips)} trips")
+                for i, trip in enumerate(trips[:3]):  # Log primeros 3
+                    print(f"  Trip {i+1}: {trip.get('startTime')} -> {trip.get('endTime')}, {trip.get('distance', 0)/1000:.1f}km")
+            else:
+                print(f"No trips returned (trips={trips})")
+        except Exception as e:
+            print(f"Error getting trips for chat: {e}")
+            traceback.print_exc()
+    
+    # Conducción brusca detectada localmente (muchos equipos no envían alarmas)
+    behaviour = None
+    if len(positions) > 1:
+        try:
+            behaviour = detect_behaviour(positions, device_id, speed_limit)
+        except Exception as e:
+            print(f"Error detecting driving behaviour for chat: {e}")
+    
+    return VehicleContext.from_lists(positions, events, trips, behaviour), positions_source, places
+
+
+def stream_chat_context(service: TraccarService, device_id: int, from_time: datetime,
+                        to_time: datetime, speed_limit: float,
+                        context: Optional[VehicleContext] = None) -> VehicleContext:
+    """
+    Recorre posiciones y eventos de la ventana a medida que llegan de Traccar y
+    los pasa de a uno por los agregadores del contexto (`context` permite usar
+    uno ya armado, como el de la flota). Para el almacén local solo se retienen
+    dos lotes de STORE_BATCH_SIZE (uno escribiéndose y el siguiente).
+    """
+    if context is None:
+        context = VehicleContext(device_id, speed_limit, detect=True)
+    # block=True: cada lote espera al anterior, así se escribe mientras se lee
+    # el siguiente sin acumular lotes en la cola
+    batch = []
+    for p in service.iter_position_history(device_id, from_time, to_time):
+        context.add_position(p)
+        batch.append(p)
+        if len(batch) >= STORE_BATCH_SIZE:
+            store_positions(service, batch, block=True)
+            batch = []
+    store_positions(service, batch, block=True)
+    
+    batch = []
+    try:
+        for e in service.iter_events(device_id, from_time, to_time):
+            context.add_event(e)
+            batch.append(e)
+            if len(batch) >= STORE_BATCH_SIZE:
+                store_events(service, batch, block=True)
+                batch = []
+        store_events(service, batch, block=True)
+    except Exception as e:
+        print(f"Error streaming events for chat: {e}")
+    return context.finish()
+
+
+async def chat_with_tools(service: TraccarService, device: dict, request: ChatRequest,
+                          conversation: dict) -> dict:
+    """Chat en modo herramientas: el modelo pide solo los datos que necesita"""
+    from ai_service import chat_with_vehicle_tools
+    from chat_tools import VehicleToolbox
+
+    # hours_of_data es solo la ventana sugerida al modelo: las herramientas aceptan hasta
+    # MAX_TOOL_HOURS ("la última semana" no se recorta a 24 h); más allá de la caché de
+    # historiales responden con los resúmenes diarios, sin bajar el historial completo
+    toolbox = VehicleToolbox(service, request.device_id, speed_limit=speed_limit_for_device(device))
+    
+    response = await chat_with_vehicle_tools(
+        user_message=request.message,
+        device=device,
+        toolbox=toolbox,
+        hours=request.hours_of_data,
+        conversation_history=conversation["messages"],
+        conversation_summary=conversation["summary"]
+    )
+    
+    return {
+        "response": response,
+        "data_summary": {
+            "mode": "tools",
+            "tool_calls": toolbox.calls,
+            "hours_analyzed": request.hours_of_data
+        }
+    }
+
+
 # ==============================
 # DEBUG - Ver datos raw de un dispositivo
 # ==============================
 @app.get("/api/debug/device/{device_id}")
-async def debug_device_data(
+def debug_device_data(
     device_id: int,
     hours: int = 24,
     authorization: str = Header(...)
@@ -454,13 +1567,81 @@ async def debug_device_data(
     return result
 
 
+@app.get("/api/debug/trips/{device_id}")
+def debug_compare_trips(
+    device_id: int,
+    hours: int = 24,
+    authorization: str = Header(...)
+):
+    """
+    Compara los viajes detectados localmente con el reporte /reports/trips de Traccar
+    (cantidad, distancia total y tiempos de cada método).
+    """
+    service = get_traccar_service(authorization)
+    
+    to_time = datetime.utcnow()
+    from_time = to_time - timedelta(hours=hours)
+    
+    result = {"local": None, "upstream": None, "errors": []}
+    
+    try:
+        started = time.perf_counter()
+        positions = service.get_position_history(device_id, from_time, to_time) or []
+        fetch_ms = (time.perf_counter() - started) * 1000
+        
+        started = time.perf_counter()
+        detector = TripDetector(device_id=device_id)
+        detector.feed_many(positions)
+        trips = detector.current_trips()
+        detect_ms = (time.perf_counter() - started) * 1000
+        
+        result["local"] = {
+            "positions_count": len(positions),
+            "fetch_positions_ms": round(fetch_ms, 1),
+            "detect_ms": round(detect_ms, 1),
+            "count": len(trips),
+            "total_distance_km": round(sum(t["distance"] for t in trips) / 1000, 2),
+            "trips": trips,
+            "stops": detector.stops
+        }
+    except Exception as e:
+        result["errors"].append(f"local: {str(e)}")
+    
+    try:
+        started = time.perf_counter()
+        trips = service.get_trips(device_id, from_time, to_time) or []
+        report_ms = (time.perf_counter() - started) * 1000
+        
+        result["upstream"] = {
+            "report_ms": round(report_ms, 1),
+            "count": len(trips),
+            "total_distance_km": round(sum(t.get("distance", 0) for t in trips) / 1000, 2),
+            "trips": trips
+        }
+    except Exception as e:
+        result["errors"].append(f"upstream: {str(e)}")
+    
+    return result
+
+
 # ==============================
-# HEALTH CHECK
+# HEALTH CHECK / MÉTRICAS
 # ==============================
+@app.get("/api/metrics")
+async def metrics():
+    """Métricas de caché: aciertos precargados (warm) frente a descargas en frío"""
+    return {
+        "history_cache": get_history_cache().snapshot(),
+        "cache_warmer": cache_warmer.snapshot(),
+        "upstream_limiter": limiter_snapshot(),
+        "history_sources": history_fetcher.snapshot()
+    }
+
+
 @app.get("/api/health")
 async def health_check():
     """Endpoint de salud para verificar que el servidor está corriendo"""
-    return {"status": "ok", "timestamp": datetime.now().isoformat()}
+    return {"status": "ok", "ai_enabled": AI_ENABLED, "timestamp": datetime.now().isoformat()}
 
 
 if __name__ == "__main__":
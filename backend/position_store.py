@@ -0,0 +1,469 @@
+"""
+Almacén local de posiciones (SQLite) con índice espacial por geohash.
+Permite responder consultas de proximidad y de área sin volver a descargar
+historiales completos desde Traccar.
+"""
+import os
+import json
+import math
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from datetime import timezone
+
+from trip_detector import haversine_m, parse_time
+
+STORE_PATH = os.getenv("POSITION_STORE_PATH", os.path.join(os.path.dirname(__file__), "traccar_local.db"))
+
+GEOHASH_PRECISION = 9            # ~5 m, precisión con la que se guarda cada punto
+MAX_COVER_CELLS = 64             # Máximo de celdas para cubrir un área de búsqueda
+MAX_PENDING_WRITES = 200000      # Elementos encolados para escribir antes de descartar escrituras
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+# ==============================
+# GEOHASH
+# ==============================
+def geohash_encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Codifica una coordenada como geohash"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bit = 0
+    ch = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                ch |= 1 << (4 - bit)
+                lon_range[0] = mid
+            else:
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                ch |= 1 << (4 - bit)
+                lat_range[0] = mid
+            else:
+                lat_range[1] = mid
+        even = not even
+        if bit < 4:
+            bit += 1
+        else:
+            chars.append(_BASE32[ch])
+            bit = 0
+            ch = 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision: int) -> tuple:
+    """Alto y ancho (en grados) de una celda geohash"""
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits)
+
+
+def geohash_cover(min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                  max_cells: int = MAX_COVER_CELLS) -> list:
+    """
+    Devuelve los prefijos geohash que cubren un rectángulo, usando la mayor
+    precisión que no supere max_cells celdas.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_size(precision)
+        rows = math.floor(max_lat / height) - math.floor(min_lat / height) + 1
+        cols = math.floor(max_lon / width) - math.floor(min_lon / width) + 1
+        if rows * cols > max_cells:
+            continue
+        cells = set()
+        for r in range(rows):
+            lat = min(min_lat + r * height, max_lat)
+            for c in range(cols):
+                lon = min(min_lon + c * width, max_lon)
+                cells.add(geohash_encode(lat, lon, precision))
+        # Asegurar las esquinas (los pasos pueden quedarse cortos por redondeo)
+        for lat in (min_lat, max_lat):
+            for lon in (min_lon, max_lon):
+                cells.add(geohash_encode(lat, lon, precision))
+        return sorted(cells)
+    return [""]
+
+
+def bbox_around(latitude: float, longitude: float, radius_m: float) -> tuple:
+    """Rectángulo (min_lat, min_lon, max_lat, max_lon) que contiene un círculo"""
+    d_lat = math.degrees(radius_m / 6371000)
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    d_lon = min(d_lat / cos_lat, 180.0)
+    return (max(latitude - d_lat, -90.0), max(longitude - d_lon, -180.0),
+            min(latitude + d_lat, 90.0), min(longitude + d_lon, 180.0))
+
+
+def time_key(value) -> Optional[str]:
+    """Normaliza una fecha (datetime o ISO) a una clave UTC ordenable"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = parse_time(value)
+        if value is None:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+# ==============================
+# ALMACÉN
+# ==============================
+class PositionStore:
+    """Posiciones guardadas localmente, indexadas por servidor, dispositivo, tiempo y geohash"""
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS positions (
+                    server TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    fix_time TEXT NOT NULL,
+                    position_id INTEGER,
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL,
+                    speed REAL,
+                    course REAL,
+                    geohash TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (server, device_id, fix_time)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_positions_geohash
+                    ON positions (server, geohash);
+                CREATE TABLE IF NOT EXISTS events (
+                    server TEXT NOT NULL,
+                    event_id INTEGER NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    event_time TEXT NOT NULL,
+                    type TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (server, event_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_events_device_time
+                    ON events (server, device_id, event_time);
+                CREATE INDEX IF NOT EXISTS idx_events_device_type_time
+                    ON events (server, device_id, type, event_time);
+                CREATE TABLE IF NOT EXISTS dirty_days (
+                    server TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    day TEXT NOT NULL,
+                    PRIMARY KEY (server, device_id, day)
+                );
+            """)
+
+    # ------------------------------
+    # Escritura
+    # ------------------------------
+    def _upsert(self, sql: str, rows: list, day_of) -> int:
+        """
+        Aplica el upsert agrupado por (dispositivo, día) y marca como modificados
+        solo los días donde cambió alguna fila. Retorna cuántas filas cambiaron.
+        """
+        groups = {}
+        for r in rows:
+            groups.setdefault(day_of(r), []).append(r)
+        changed_days = set()
+        changed = 0
+        with self._lock, self._conn:
+            for day, group in groups.items():
+                before = self._conn.total_changes
+                self._conn.executemany(sql, group)
+                if self._conn.total_changes > before:
+                    changed += self._conn.total_changes - before
+                    changed_days.add(day)
+            self._mark_dirty(changed_days)
+        return changed
+
+    def save_positions(self, server: str, positions: list) -> int:
+        """
+        Guarda (o actualiza) posiciones de Traccar. Retorna cuántas filas cambiaron:
+        volver a guardar las mismas posiciones no escribe ni marca días.
+        """
+        rows = []
+        for p in positions or []:
+            fix_time = time_key(p.get('fixTime'))
+            lat = p.get('latitude')
+            lon = p.get('longitude')
+            if fix_time is None or lat is None or lon is None or p.get('deviceId') is None:
+                continue
+            rows.append((
+                server, p['deviceId'], fix_time, p.get('id'), lat, lon,
+                p.get('speed'), p.get('course'), geohash_encode(lat, lon),
+                json.dumps(p, separators=(',', ':'))
+            ))
+        if not rows:
+            return 0
+        return self._upsert(
+            "INSERT INTO positions "
+            "(server, device_id, fix_time, position_id, latitude, longitude, speed, course, geohash, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (server, device_id, fix_time) DO UPDATE SET "
+            "position_id = excluded.position_id, latitude = excluded.latitude, "
+            "longitude = excluded.longitude, speed = excluded.speed, course = excluded.course, "
+            "geohash = excluded.geohash, data = excluded.data "
+            "WHERE positions.data IS NOT excluded.data",
+            rows,
+            lambda r: (server, r[1], r[2][:10])
+        )
+
+    def save_events(self, server: str, events: list) -> int:
+        """Guarda (o actualiza) eventos de Traccar. Retorna cuántas filas cambiaron."""
+        rows = []
+        for e in events or []:
+            event_time = time_key(e.get('eventTime'))
+            if event_time is None or e.get('id') is None or e.get('deviceId') is None:
+                continue
+            rows.append((
+                server, e['id'], e['deviceId'], event_time, e.get('type'),
+                json.dumps(e, separators=(',', ':'))
+            ))
+        if not rows:
+            return 0
+        return self._upsert(
+            "INSERT INTO events (server, event_id, device_id, event_time, type, data) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (server, event_id) DO UPDATE SET "
+            "device_id = excluded.device_id, event_time = excluded.event_time, "
+            "type = excluded.type, data = excluded.data "
+            "WHERE events.data IS NOT excluded.data",
+            rows,
+            lambda r: (server, r[2], r[3][:10])
+        )
+
+    def _mark_dirty(self, days: set):
+        """Marca los días (servidor, dispositivo, día UTC) cuyos resúmenes deben recalcularse"""
+        if not days:
+            return
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO dirty_days (server, device_id, day) VALUES (?, ?, ?)",
+            list(days)
+        )
+
+    def pop_dirty_days(self, limit: int = 100) -> list:
+        """Retira y devuelve días pendientes de recalcular"""
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT server, device_id, day FROM dirty_days LIMIT ?", (limit,)
+            ).fetchall()
+            self._conn.executemany(
+                "DELETE FROM dirty_days WHERE server = ? AND device_id = ? AND day = ?",
+                [tuple(r) for r in rows]
+            )
+        return [tuple(r) for r in rows]
+
+    # ------------------------------
+    # Lectura
+    # ------------------------------
+    def get_positions(self, server: str, device_id: int, from_time=None, to_time=None) -> list:
+        """Historial guardado de un dispositivo, ordenado por fixTime"""
+        sql = "SELECT data FROM positions WHERE server = ? AND device_id = ?"
+        params = [server, device_id]
+        sql, params = self._time_filter(sql, params, from_time, to_time)
+        sql += " ORDER BY fix_time"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(r['data']) for r in rows]
+
+    def get_events(self, server: str, device_id: int, from_time=None, to_time=None) -> list:
+        """Eventos guardados de un dispositivo, ordenados por eventTime"""
+        sql = "SELECT data FROM events WHERE server = ? AND device_id = ?"
+        params = [server, device_id]
+        sql, params = self._time_filter(sql, params, from_time, to_time, column="event_time")
+        sql += " ORDER BY event_time"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(r['data']) for r in rows]
+
+    def _time_filter(self, sql: str, params: list, from_time, to_time, column: str = "fix_time") -> tuple:
+        if from_time is not None:
+            sql += f" AND {column} >= ?"
+            params.append(time_key(from_time))
+        if to_time is not None:
+            sql += f" AND {column} <= ?"
+            params.append(time_key(to_time))
+        return sql, params
+
+    def _query_cells(self, server: str, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                     device_ids: Optional[list], from_time, to_time, columns: str) -> list:
+        """Candidatos dentro del rectángulo usando el índice geohash"""
+        if device_ids is not None and not device_ids:
+            return []
+        sql = (f"SELECT {columns} FROM positions WHERE server = ? AND geohash >= ? AND geohash < ?"
+               " AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?")
+        base = [min_lat, max_lat, min_lon, max_lon]
+        if device_ids is not None:
+            sql += f" AND device_id IN ({','.join('?' for _ in device_ids)})"
+            base.extend(device_ids)
+        sql, base = self._time_filter(sql, base, from_time, to_time)
+
+        # Una consulta por celda: cada una recorre solo su rango del índice geohash
+        rows = []
+        with self._lock:
+            for cell in geohash_cover(min_lat, min_lon, max_lat, max_lon):
+                rows.extend(self._conn.execute(sql, [server, cell, cell + "~"] + base).fetchall())
+        rows.sort(key=lambda r: (r['device_id'], r['fix_time']))
+        return rows
+
+    def near(self, server: str, latitude: float, longitude: float, radius_m: float,
+             device_ids: Optional[list] = None, from_time=None, to_time=None,
+             gap_seconds: int = 600) -> list:
+        """
+        Visitas a menos de radius_m metros de un punto. Las posiciones consecutivas
+        separadas por menos de gap_seconds se agrupan en una misma visita.
+        """
+        rows = self._query_cells(server, *bbox_around(latitude, longitude, radius_m),
+                                 device_ids, from_time, to_time,
+                                 "device_id, fix_time, latitude, longitude, speed")
+        visits = []
+        current = None
+        for r in rows:
+            distance = haversine_m(latitude, longitude, r['latitude'], r['longitude'])
+            if distance > radius_m:
+                continue
+            time = parse_time(r['fix_time'])
+            if (current is None or current['deviceId'] != r['device_id'] or
+                    (time - current['_last']).total_seconds() > gap_seconds):
+                current = {
+                    'deviceId': r['device_id'],
+                    'from': r['fix_time'],
+                    'to': r['fix_time'],
+                    'count': 0,
+                    'minDistance': distance,
+                    '_last': time,
+                }
+                visits.append(current)
+            current['to'] = r['fix_time']
+            current['count'] += 1
+            current['minDistance'] = min(current['minDistance'], distance)
+            current['_last'] = time
+        for v in visits:
+            v.pop('_last')
+            v['minDistance'] = round(v['minDistance'], 1)
+        return visits
+
+    def within(self, server: str, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+               device_ids: Optional[list] = None, from_time=None, to_time=None) -> list:
+        """Dispositivos que pasaron por un rectángulo, con su primer y último paso"""
+        rows = self._query_cells(server, min_lat, min_lon, max_lat, max_lon,
+                                 device_ids, from_time, to_time, "device_id, fix_time")
+        summary = {}
+        for r in rows:
+            item = summary.get(r['device_id'])
+            if item is None:
+                summary[r['device_id']] = {
+                    'deviceId': r['device_id'],
+                    'firstTime': r['fix_time'],
+                    'lastTime': r['fix_time'],
+                    'count': 1,
+                }
+            else:
+                item['lastTime'] = r['fix_time']
+                item['count'] += 1
+        return list(summary.values())
+
+    def frequent_places(self, server: str, device_id: int, from_time=None, to_time=None,
+                        precision: int = 7, limit: int = 5) -> list:
+        """Zonas (celdas geohash de ~150 m) donde el vehículo pasó más tiempo detenido"""
+        sql = (f"SELECT substr(geohash, 1, {int(precision)}) AS cell, COUNT(*) AS count,"
+               " AVG(latitude) AS latitude, AVG(longitude) AS longitude,"
+               " MIN(fix_time) AS first_time, MAX(fix_time) AS last_time"
+               " FROM positions WHERE server = ? AND device_id = ? AND COALESCE(speed, 0) < 1")
+        params = [server, device_id]
+        sql, params = self._time_filter(sql, params, from_time, to_time)
+        sql += " GROUP BY cell ORDER BY count DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(r) for r in rows]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_position_store() -> PositionStore:
+    """Instancia compartida del almacén local"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = PositionStore()
+    return _store
+
+
+class StoreWriter:
+    """
+    Escrituras al almacén fuera del camino de la respuesta: un solo hilo las
+    aplica en orden. Con la cola llena se descartan (el almacén es una copia
+    local; los datos siguen en Traccar). `block=True` espera en cambio a que
+    termine lo encolado antes, para los recorridos en streaming que no deben
+    acumular lotes en memoria.
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING_WRITES):
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-writer")
+        self._idle = threading.Condition()
+        self._pending = 0
+        self.max_pending = max_pending
+        self.dropped = 0
+
+    def _submit(self, method: str, server: str, items: list, block: bool) -> bool:
+        if not items:
+            return True
+        with self._idle:
+            if block:
+                self._idle.wait_for(lambda: self._pending == 0)
+            elif self._pending and self._pending + len(items) > self.max_pending:
+                self.dropped += 1
+                print(f"Store writer busy: dropped {len(items)} items ({method})")
+                return False
+            self._pending += len(items)
+
+        def run():
+            try:
+                getattr(get_position_store(), method)(server, items)
+            except Exception as e:
+                print(f"Error storing {method}: {e}")
+            finally:
+                with self._idle:
+                    self._pending -= len(items)
+                    self._idle.notify_all()
+
+        self._pool.submit(run)
+        return True
+
+    def save_positions(self, server: str, positions: list, block: bool = False) -> bool:
+        return self._submit("save_positions", server, positions, block)
+
+    def save_events(self, server: str, events: list, block: bool = False) -> bool:
+        return self._submit("save_events", server, events, block)
+
+    def flush(self, timeout: Optional[float] = None):
+        """Espera a que se apliquen las escrituras encoladas hasta ahora"""
+        self._pool.submit(lambda: None).result(timeout)
+
+
+_writer = StoreWriter()
+
+
+def get_store_writer() -> StoreWriter:
+    """Escritor en segundo plano compartido"""
+    return _writer
@@ -0,0 +1,203 @@
+"""
+Reproducción del historial de un dispositivo marcada por el servidor.
+Las posiciones se leen por ventanas (almacén local, caché de historial o Traccar)
+según avanza la reproducción, con la siguiente ventana precargada en un hilo,
+y se envían al cliente al ritmo del multiplicador de velocidad elegido.
+"""
+import asyncio
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from trip_detector import parse_time
+from history_cache import get_history_cache, to_utc, WARM_WINDOW
+from position_store import get_position_store, get_store_writer
+from daily_rollups import get_rollup_store, days_between
+
+MIN_SPEED = 1
+MAX_SPEED = 500
+WINDOW = timedelta(hours=2)        # Tramo de historial que se carga de una vez
+FRAME_SECONDS = 0.1                # Las posiciones dentro de un mismo frame se envían juntas
+MAX_WAIT_SECONDS = 2.0             # Las paradas largas no congelan la reproducción
+MAX_FRAME_POSITIONS = 200
+
+
+def clamp_speed(value) -> float:
+    return min(max(float(value), MIN_SPEED), MAX_SPEED)
+
+
+class ReplaySource:
+    """Lee tramos de historial de la fuente más barata disponible"""
+
+    def __init__(self, service, device_id: int):
+        self.service = service
+        self.device_id = device_id
+        self._complete_days = set()
+
+    def _stored(self, start: datetime, end: datetime) -> bool:
+        """El almacén tiene el tramo completo si sus días ya se materializaron enteros"""
+        days = days_between(start.date(), end.date())
+        if all(d in self._complete_days for d in days):
+            return True
+        rows = get_rollup_store().get_range(self.service.base_url, [self.device_id], days[0], days[-1])
+        self._complete_days.update(r['day'] for r in rows if r['complete'])
+        return all(d in self._complete_days for d in days)
+
+    def load(self, start: datetime, end: datetime) -> list:
+        """Posiciones de [start, end] como (fixTime, posición) ordenadas (se ejecuta en un hilo)"""
+        store = get_position_store()
+        server = self.service.base_url
+        if datetime.now(timezone.utc) - end <= WARM_WINDOW:
+            positions = get_history_cache().get_positions(self.service, self.device_id, start, end)
+            get_store_writer().save_positions(server, positions)
+        elif self._stored(start, end):
+            positions = store.get_positions(server, self.device_id, start, end)
+        else:
+            positions = self.service.get_position_history(self.device_id, start, end) or []
+            get_store_writer().save_positions(server, positions)
+
+        timed = []
+        for p in positions:
+            t = parse_time(p.get("fixTime"))
+            if t is not None:
+                t = to_utc(t)
+                if start <= t <= end:
+                    timed.append((t, p))
+        timed.sort(key=lambda item: item[0])
+        return timed
+
+
+class ReplayPlayer:
+    """
+    Estado de una reproducción. `run()` emite mensajes al cliente con `send`
+    y `command(message)` aplica las órdenes que llegan (play, pause, seek, speed).
+    """
+
+    def __init__(self, source: ReplaySource, from_time: datetime, to_time: datetime, send, speed: float = 10):
+        self.source = source
+        self.from_time = to_utc(from_time)
+        self.to_time = min(to_utc(to_time), datetime.now(timezone.utc))
+        self.speed = clamp_speed(speed)
+        self.paused = False
+        self._wakeup = asyncio.Event()
+        self._send = send
+        self._reset(self.from_time)
+
+    def _reset(self, at: datetime):
+        # Tiempo de historial de la última posición enviada (justo antes de `at` para incluirla)
+        self.cursor = at - timedelta(milliseconds=1)
+        self.loaded_until = at           # Hasta dónde se ha leído el historial
+        self.buffer = deque()
+        self.generation = getattr(self, "generation", 0) + 1
+        self._prefetch = None            # (inicio, fin, tarea) de la siguiente ventana
+
+    def status(self) -> dict:
+        return {
+            "type": "status",
+            "state": "paused" if self.paused else "playing",
+            "time": self.cursor.isoformat(),
+            "speed": self.speed,
+            "from": self.from_time.isoformat(),
+            "to": self.to_time.isoformat(),
+        }
+
+    # ------------------------------
+    # Órdenes del cliente
+    # ------------------------------
+    async def command(self, message: dict):
+        action = message.get("action")
+        if action == "pause":
+            self.paused = True
+        elif action == "play":
+            if self.cursor >= self.to_time:
+                self._reset(self.from_time)
+            self.paused = False
+        elif action == "speed":
+            self.speed = clamp_speed(message.get("value", self.speed))
+        elif action == "seek":
+            target = parse_time(message.get("time"))
+            if target is None:
+                await self._send({"type": "error", "detail": "Tiempo de seek inválido"})
+                return
+            target = min(max(to_utc(target), self.from_time), self.to_time)
+            self._reset(target)
+            await self._send({"type": "seeked", "time": target.isoformat()})
+        else:
+            await self._send({"type": "error", "detail": f"Acción desconocida: {action}"})
+            return
+        await self._send(self.status())
+        self._wakeup.set()
+
+    async def _wait(self, timeout) -> bool:
+        """Espera el tiempo indicado; True si una orden la interrumpió"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+            woke = True
+        except asyncio.TimeoutError:
+            woke = False
+        self._wakeup.clear()
+        return woke
+
+    # ------------------------------
+    # Lectura por ventanas
+    # ------------------------------
+    def _start_prefetch(self):
+        start = self.loaded_until
+        if start < self.to_time:
+            end = min(start + WINDOW, self.to_time)
+            task = asyncio.ensure_future(asyncio.to_thread(self.source.load, start, end))
+            self._prefetch = (start, end, task)
+
+    async def _fill(self):
+        """Carga ventanas hasta tener posiciones o llegar al final"""
+        generation = self.generation
+        while not self.buffer and self.loaded_until < self.to_time:
+            if self._prefetch and self._prefetch[0] == self.loaded_until:
+                _, end, task = self._prefetch
+            else:
+                end = min(self.loaded_until + WINDOW, self.to_time)
+                task = asyncio.ensure_future(asyncio.to_thread(self.source.load, self.loaded_until, end))
+            self._prefetch = None
+            timed = await task
+            if generation != self.generation:
+                return  # Hubo un seek mientras se cargaba
+            self.buffer.extend((t, p) for t, p in timed if t > self.cursor)
+            self.loaded_until = end
+        if generation == self.generation and self._prefetch is None:
+            self._start_prefetch()
+
+    # ------------------------------
+    # Reproducción
+    # ------------------------------
+    async def run(self):
+        send = self._send
+        await send(self.status())
+        while True:
+            if self.paused:
+                await self._wait(None)
+                continue
+
+            if not self.buffer:
+                await self._fill()
+                if not self.buffer:
+                    if self.loaded_until >= self.to_time:
+                        self.cursor = self.to_time
+                        self.paused = True
+                        await send({"type": "end"})
+                        await send(self.status())
+                    continue
+
+            first_time = self.buffer[0][0]
+            delay = (first_time - self.cursor).total_seconds() / self.speed
+            if delay > 0 and await self._wait(min(delay, MAX_WAIT_SECONDS)):
+                continue  # Cambió el estado (pausa, seek, velocidad)
+
+            frame_end = first_time + timedelta(seconds=FRAME_SECONDS * self.speed)
+            frame = []
+            while self.buffer and self.buffer[0][0] <= frame_end and len(frame) < MAX_FRAME_POSITIONS:
+                frame.append(self.buffer.popleft())
+            self.cursor = frame[-1][0]
+            await send({
+                "type": "positions",
+                "time": self.cursor.isoformat(),
+                "positions": [p for _, p in frame],
+            })
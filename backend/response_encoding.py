@@ -0,0 +1,240 @@
+"""
+Codificación de las respuestas de la API:
+
+- FastJSONResponse: serializa con orjson si está instalado (varias veces más
+  rápido que json con rutas de decenas de MB) y si no con json compacto.
+- CompressionMiddleware: comprime según Accept-Encoding (zstd, br o gzip) las
+  respuestas de al menos COMPRESS_MIN_BYTES. zstd y brotli solo se ofrecen si
+  están instalados `zstandard` y `brotli`; gzip está siempre.
+- encode_positions: formato compacto opcional para listas de posiciones
+  ({"columns": [...], "rows": [[...], ...]}), sin repetir las claves.
+"""
+import json
+import zlib
+from operator import itemgetter
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4        # Calidades altas de brotli son demasiado lentas para respuestas dinámicas
+ZSTD_LEVEL = 3
+
+# Ya comprimidos o que no deben retenerse (eventos en vivo)
+SKIP_CONTENT_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip",
+                      "application/vnd.apache.parquet", "text/event-stream")
+
+POSITION_ENCODINGS = ("objects", "compact")
+
+
+def dumps(content: Any) -> bytes:
+    """JSON compacto en UTF-8 (orjson si está disponible)"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # Enteros de más de 64 bits u objetos que orjson no conoce
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """Respuesta JSON por defecto de la API"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def encode_positions(positions: list, encoding: str = None):
+    """
+    Lista de posiciones en el formato pedido. "compact" envía los nombres de
+    campo una sola vez y cada posición como fila; el frontend la reconstruye.
+    """
+    if not encoding or encoding == "objects":
+        return positions
+    if encoding != "compact":
+        raise ValueError(f"Codificación desconocida: {encoding}")
+
+    columns = []
+    known = set()
+    uniform = True
+    for p in positions:
+        if len(p) != len(columns) or not known.issuperset(p):
+            uniform = uniform and not columns
+            for key in p:
+                if key not in known:
+                    known.add(key)
+                    columns.append(key)
+    if uniform and len(columns) > 1:
+        # Todas con los mismos campos (lo habitual): itemgetter arma cada fila en C
+        getter = itemgetter(*columns)
+        rows = [getter(p) for p in positions]
+    else:
+        rows = [[p.get(key) for key in columns] for p in positions]
+    return {"columns": columns, "rows": rows}
+
+
+# ==============================
+# COMPRESIÓN
+# ==============================
+class _GzipEncoder:
+    name = "gzip"
+
+    def __init__(self):
+        self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        out = self._obj.compress(data)
+        return out + self._obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _BrotliEncoder:
+    name = "br"
+
+    def __init__(self):
+        self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        out = self._obj.process(data)
+        return out + (self._obj.finish() if final else self._obj.flush())
+
+
+class _ZstdEncoder:
+    name = "zstd"
+
+    def __init__(self):
+        self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        out = self._obj.compress(data)
+        return out + self._obj.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+
+def available_encodings() -> list:
+    """Codificaciones soportadas, en orden de preferencia del servidor"""
+    encoders = []
+    if zstandard is not None:
+        encoders.append(_ZstdEncoder)
+    if brotli is not None:
+        encoders.append(_BrotliEncoder)
+    encoders.append(_GzipEncoder)
+    return encoders
+
+
+def choose_encoder(accept_encoding: str):
+    """Primera codificación del servidor que el cliente acepta (q > 0), o None"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+    for encoder in available_encodings():
+        if accepted.get(encoder.name, accepted.get("*", 0)) > 0:
+            return encoder
+    return None
+
+
+class CompressionMiddleware:
+    """
+    Middleware ASGI de compresión. Una respuesta de un solo cuerpo se comprime
+    si supera COMPRESS_MIN_BYTES; las respuestas en streaming (exportaciones)
+    se comprimen trozo a trozo, vaciando el compresor en cada uno para que el
+    cliente reciba los datos a medida que se generan.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        encoder_class = choose_encoder(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoder_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        encoder = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                response_headers = dict(message.get("headers") or [])
+                content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+                passthrough = (
+                    b"content-encoding" in response_headers
+                    or content_type.startswith(SKIP_CONTENT_TYPES)
+                )
+                if passthrough:
+                    await send(message)
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                if not more_body and len(body) < self.minimum_size:
+                    # Respuesta corta: se envía tal cual
+                    await send(start_message)
+                    await send(message)
+                    passthrough = True
+                    return
+                encoder = encoder_class()
+                response_headers = [
+                    (k, v) for k, v in start_message.get("headers", [])
+                    if k not in (b"content-length", b"content-encoding")
+                ]
+                response_headers.append((b"content-encoding", encoder.name.encode("latin-1")))
+                vary = [v for k, v in response_headers if k == b"vary"]
+                if not vary:
+                    response_headers.append((b"vary", b"Accept-Encoding"))
+                elif b"accept-encoding" not in vary[0].lower():
+                    response_headers = [
+                        (k, v + b", Accept-Encoding" if k == b"vary" else v) for k, v in response_headers
+                    ]
+                compressed = encoder.compress(body, final=not more_body)
+                if not more_body:
+                    response_headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                await send({**start_message, "headers": response_headers})
+                await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+                return
+
+            await send({
+                "type": "http.response.body",
+                "body": encoder.compress(body, final=not more_body),
+                "more_body": more_body,
+            })
+
+        await self.app(scope, receive, send_wrapper)
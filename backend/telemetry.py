@@ -0,0 +1,208 @@
+"""
+Series de telemetría (velocidad y campos OBD) reducidas para gráficos: en
+lugar de enviar cada posición al navegador se envían como mucho `points`
+puntos por campo, con el mismo tamaño para un día que para un mes.
+
+Dos métodos:
+- lttb: Largest-Triangle-Three-Buckets; elige en cada tramo la muestra que
+  mejor conserva la forma de la curva (picos incluidos).
+- minmax: tramos de igual duración con mínimo, máximo y promedio de cada uno.
+
+Con numpy la selección de cada tramo y las reducciones por tramo son
+vectorizadas; sin numpy se usa el mismo cálculo en Python.
+Los valores quedan en las unidades de Traccar (velocidad en nudos).
+"""
+import re
+
+from trip_detector import parse_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TOP_LEVEL_FIELDS = ("speed", "altitude", "course", "accuracy")
+DEFAULT_POINTS = 500
+MIN_POINTS = 10
+MAX_POINTS = 5000
+MAX_FIELDS = 8
+METHODS = ("lttb", "minmax")
+VALUE_DECIMALS = 2
+NUMPY_MIN_BUCKET = 32              # Con tramos más chicos LTTB en Python puro es más rápido
+
+_FIELD_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+
+
+def parse_fields(value: str) -> list:
+    """Lista de campos pedidos ("io36,io32,speed"), sin repetir"""
+    fields = []
+    for name in (value or "").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if not _FIELD_NAME.match(name):
+            raise ValueError(f"Campo inválido: {name}")
+        if name not in fields:
+            fields.append(name)
+    if not fields:
+        raise ValueError("Hay que pedir al menos un campo")
+    if len(fields) > MAX_FIELDS:
+        raise ValueError(f"Como máximo {MAX_FIELDS} campos por consulta")
+    return fields
+
+
+def extract_series(positions: list, fields: list) -> dict:
+    """campo -> (tiempos en ms, valores), ordenados por tiempo y solo con valores numéricos"""
+    # Columnas (listas paralelas) en lugar de tuplas por posición: con cientos
+    # de miles de posiciones las tuplas disparan el recolector de basura
+    times = []
+    kept = []
+    for p in positions:
+        fix_time = parse_time(p.get("fixTime"))
+        if fix_time is not None:
+            times.append(fix_time.timestamp() * 1000)
+            kept.append(p)
+    if any(times[i] > times[i + 1] for i in range(len(times) - 1)):
+        order = sorted(range(len(times)), key=times.__getitem__)
+        times = [times[i] for i in order]
+        kept = [kept[i] for i in order]
+    attributes = [p.get("attributes") or {} for p in kept]
+
+    series = {}
+    for field in fields:
+        source = kept if field in TOP_LEVEL_FIELDS else attributes
+        raw = [item.get(field) for item in source]
+        # bool es int: ignition/motion se grafican como 0/1
+        valid = [i for i, value in enumerate(raw) if isinstance(value, (int, float))]
+        series[field] = ([times[i] for i in valid], [float(raw[i]) for i in valid])
+    return series
+
+
+# ==============================
+# LTTB
+# ==============================
+def _lttb_numpy(t, v, threshold: int) -> list:
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v, dtype=float)
+    size = len(t)
+    every = (size - 2) / (threshold - 2)
+    bounds = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    bounds[-1] = size - 1
+    # Promedios de todos los tramos de una vez (el último tramo es la última muestra)
+    counts = np.diff(np.r_[bounds, size])
+    avg_t = np.add.reduceat(t, bounds) / counts
+    avg_v = np.add.reduceat(v, bounds) / counts
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        ta, va = t[a], v[a]
+        area = np.abs((ta - avg_t[i + 1]) * (v[start:end] - va) - (ta - t[start:end]) * (avg_v[i + 1] - va))
+        a = int(start + area.argmax())
+        selected.append(a)
+    selected.append(size - 1)
+    return selected
+
+
+def _lttb_python(t: list, v: list, threshold: int) -> list:
+    size = len(t)
+    every = (size - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, size)
+        count = next_end - end
+        avg_t = sum(t[end:next_end]) / count
+        avg_v = sum(v[end:next_end]) / count
+        best = -1.0
+        for j in range(start, end):
+            area = abs((t[a] - avg_t) * (v[j] - v[a]) - (t[a] - t[j]) * (avg_v - v[a]))
+            if area > best:
+                best = area
+                chosen = j
+        a = chosen
+        selected.append(a)
+    selected.append(size - 1)
+    return selected
+
+
+def lttb(times: list, values: list, threshold: int) -> dict:
+    """Como mucho `threshold` muestras elegidas por LTTB (siempre la primera y la última)"""
+    if threshold >= len(times) or threshold < 3:
+        indices = range(len(times))
+    elif np is not None and len(times) >= threshold * NUMPY_MIN_BUCKET:
+        indices = _lttb_numpy(times, values, threshold)
+    else:
+        indices = _lttb_python(times, values, threshold)
+    return {
+        "t": [int(times[i]) for i in indices],
+        "v": [round(values[i], VALUE_DECIMALS) for i in indices],
+    }
+
+
+# ==============================
+# MÍNIMO / MÁXIMO / PROMEDIO POR TRAMO
+# ==============================
+def minmax_buckets(times: list, values: list, from_ms: float, to_ms: float, buckets: int) -> dict:
+    """
+    Tramos de igual duración entre from_ms y to_ms (los que no tienen datos se
+    omiten, así los huecos se ven en el gráfico). `t` es el inicio de cada tramo.
+    """
+    width = max((to_ms - from_ms) / buckets, 1.0)
+    result = {"t": [], "min": [], "max": [], "avg": []}
+    if not times:
+        return result
+
+    if np is not None:
+        t = np.asarray(times, dtype=float)
+        v = np.asarray(values, dtype=float)
+        index = np.clip(((t - from_ms) // width).astype(np.int64), 0, buckets - 1)
+        # Los tiempos están ordenados: cada tramo es un bloque contiguo
+        starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        counts = np.diff(np.r_[starts, len(v)])
+        result["t"] = (from_ms + index[starts] * width).astype(np.int64).tolist()
+        # round de Python (y no np.round) para redondear igual que sin numpy
+        result["min"] = [round(x, VALUE_DECIMALS) for x in np.minimum.reduceat(v, starts).tolist()]
+        result["max"] = [round(x, VALUE_DECIMALS) for x in np.maximum.reduceat(v, starts).tolist()]
+        result["avg"] = [round(x, VALUE_DECIMALS) for x in (np.add.reduceat(v, starts) / counts).tolist()]
+        return result
+
+    def close(index, low, high, total, count):
+        result["t"].append(int(from_ms + index * width))
+        result["min"].append(round(low, VALUE_DECIMALS))
+        result["max"].append(round(high, VALUE_DECIMALS))
+        result["avg"].append(round(total / count, VALUE_DECIMALS))
+
+    current = None
+    for ms, value in zip(times, values):
+        index = min(max(int((ms - from_ms) // width), 0), buckets - 1)
+        if index != current:
+            if current is not None:
+                close(current, low, high, total, count)
+            current = index
+            low = high = total = value
+            count = 1
+        else:
+            if value < low:
+                low = value
+            if value > high:
+                high = value
+            total += value
+            count += 1
+    close(current, low, high, total, count)
+    return result
+
+
+def build_telemetry(positions: list, fields: list, from_ms: float, to_ms: float,
+                    points: int = DEFAULT_POINTS, method: str = "lttb") -> dict:
+    """Series reducidas de cada campo, con la cantidad de muestras originales"""
+    series = {}
+    for field, (times, values) in extract_series(positions, fields).items():
+        if method == "minmax":
+            reduced = minmax_buckets(times, values, from_ms, to_ms, points)
+        else:
+            reduced = lttb(times, values, points)
+        series[field] = {**reduced, "samples": len(times)}
+    return {"method": method, "points": points, "series": series}
@@ -0,0 +1,13 @@
+"""
+Configuración común de los tests: los módulos del backend se importan como en
+producción (desde backend/) y el almacén local va a un archivo temporal.
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Antes de importar main: position_store lee la ruta al cargarse
+os.environ.setdefault("POSITION_STORE_PATH", os.path.join(tempfile.mkdtemp(), "traccar_test.db"))
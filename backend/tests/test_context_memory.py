@@ -0,0 +1,127 @@
+"""
+Memoria del contexto del chat en streaming (consultas largas sin resúmenes
+diarios y chat de flota): el pico no debe crecer con la ventana.
+
+El historial sintético es más ralo que el de bench_context_memory (una
+posición cada 2 minutos, 1 contra 7 días) y los lotes (almacén local y tramos de
+conducción) más chicos, para que el test sea rápido y un día ya los llene; el
+benchmark sigue midiendo 30 días a 10 s.
+"""
+import asyncio
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from bench_context_memory import as_json_chunks, synthetic_events, synthetic_positions
+from fleet_context import collect_fleet
+from traccar_service import iter_json_array
+import context_aggregators
+import main
+
+SAMPLE_SECONDS = 120
+STORE_BATCH_SIZE = 200
+BEHAVIOUR_CHUNK = 500
+SHORT_DAYS = 1
+LONG_DAYS = 7
+FLEET_VEHICLES = 4
+MAX_PEAK_MB = 40.0
+MAX_GROWTH = 2.0
+SPEED_LIMIT = 54.0
+FROM_TIME = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+class SyntheticTraccar:
+    """Entrega el historial sintético como bytes JSON, igual que el streaming de TraccarService"""
+
+    base_url = "http://traccar.test"
+
+    def __init__(self, days: int):
+        self.days = days
+
+    def iter_position_history(self, device_id, from_time, to_time):
+        positions = ({**p, 'deviceId': device_id} for p in synthetic_positions(self.days, SAMPLE_SECONDS))
+        return iter_json_array(as_json_chunks(positions))
+
+    def iter_events(self, device_id, from_time, to_time):
+        events = ({**e, 'deviceId': device_id} for e in synthetic_events(self.days))
+        return iter_json_array(as_json_chunks(events))
+
+
+def traced(run) -> tuple:
+    """(pico en MB, resultado) de `run()` bajo tracemalloc"""
+    tracemalloc.start()
+    try:
+        result = run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024 / 1024, result
+
+
+def vehicle_context(days: int) -> tuple:
+    service = SyntheticTraccar(days)
+    return traced(lambda: main.stream_chat_context(
+        service, 1, FROM_TIME, FROM_TIME + timedelta(days=days), SPEED_LIMIT
+    ))
+
+
+def fleet_summaries(days: int) -> tuple:
+    """Mismo recorrido que answer_fleet_chat sobre FLEET_VEHICLES vehículos"""
+    service = SyntheticTraccar(days)
+    devices = [{'id': i, 'name': f'Vehículo {i}'} for i in range(1, FLEET_VEHICLES + 1)]
+
+    def stream(device_id, context):
+        main.stream_chat_context(service, device_id, FROM_TIME, FROM_TIME + timedelta(days=days), None, context)
+
+    return traced(lambda: asyncio.run(collect_fleet(devices, stream, lambda device: SPEED_LIMIT)))
+
+
+@pytest.fixture(scope="module")
+def small_batches():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(main, "STORE_BATCH_SIZE", STORE_BATCH_SIZE)
+        patch.setattr(context_aggregators, "BEHAVIOUR_CHUNK", BEHAVIOUR_CHUNK)
+        yield
+
+
+@pytest.fixture(scope="module")
+def vehicle(small_batches):
+    return {days: vehicle_context(days) for days in (SHORT_DAYS, LONG_DAYS)}
+
+
+@pytest.fixture(scope="module")
+def fleet(small_batches):
+    return {days: fleet_summaries(days) for days in (SHORT_DAYS, LONG_DAYS)}
+
+
+def test_context_aggregates_every_sample(vehicle):
+    for days, (_, context) in vehicle.items():
+        assert context.speeds.count == days * 86400 // SAMPLE_SECONDS
+        assert context.events.count > 0
+        assert context.trips.count > 0
+
+
+def test_peak_memory_is_bounded(vehicle):
+    peak, _ = vehicle[LONG_DAYS]
+    assert peak <= MAX_PEAK_MB, f"pico {peak:.1f} MB con {LONG_DAYS} días"
+
+
+def test_peak_memory_does_not_grow_with_window(vehicle):
+    growth = vehicle[LONG_DAYS][0] / vehicle[SHORT_DAYS][0]
+    assert growth <= MAX_GROWTH, f"el pico crece {growth:.1f}x entre {SHORT_DAYS} y {LONG_DAYS} días"
+
+
+def test_fleet_summarizes_every_vehicle(fleet):
+    for days, (_, summaries) in fleet.items():
+        assert [s['deviceId'] for s in summaries] == list(range(1, FLEET_VEHICLES + 1))
+        for summary in summaries:
+            assert not summary.get('error')
+            assert summary['metrics']['positions'] == days * 86400 // SAMPLE_SECONDS
+
+
+def test_fleet_peak_memory_does_not_grow_with_window(fleet):
+    peak = fleet[LONG_DAYS][0]
+    growth = peak / fleet[SHORT_DAYS][0]
+    assert peak <= MAX_PEAK_MB, f"pico de la flota {peak:.1f} MB con {LONG_DAYS} días"
+    assert growth <= MAX_GROWTH, f"el pico de la flota crece {growth:.1f}x entre {SHORT_DAYS} y {LONG_DAYS} días"
@@ -1,10 +1,61 @@
 """
 Servicio para comunicación con la API de Traccar
 """
+import codecs
+import json
+import time
+import hashlib
 import requests
-from typing import Optional
+from typing import Iterator, Optional
 from datetime import datetime
 
+from cache_backend import get_session_cache
+from upstream_limiter import get_host_limiter, record_queue_time
+
+SESSION_TTL_SECONDS = 30 * 60  # Reutilizar el login de Traccar entre peticiones del proceso
+STREAM_CHUNK_BYTES = 64 * 1024
+STREAM_TIMEOUT = 120           # Las respuestas en streaming pueden ser de varios días
+
+
+def iter_json_array(chunks: Iterator[bytes]) -> Iterator:
+    """
+    Recorre un arreglo JSON (`[{...}, {...}]`) a medida que llegan los bytes,
+    entregando cada elemento sin cargar el arreglo completo en memoria.
+    """
+    decoder = json.JSONDecoder()
+    # Decodificador incremental: un carácter multibyte puede quedar partido entre chunks
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    stream = (utf8.decode(chunk) if isinstance(chunk, bytes) else chunk for chunk in chunks)
+
+    buffer = ""
+    pos = 0
+    started = False
+    for chunk in stream:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            # Saltar espacios y separadores entre elementos
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("La respuesta no es un arreglo JSON")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # Elemento incompleto: esperar más datos
+            yield item
+            pos = end
+    if started:
+        raise ValueError("Arreglo JSON incompleto")
+
 
 class TraccarService:
     """Cliente para la API REST de Traccar"""
@@ -17,12 +68,34 @@ class TraccarService:
         self.session = requests.Session()
         self._authenticated = False
         self._cookies = None
+        self._session_cached = False
+    
+    @property
+    def account_key(self) -> str:
+        """
+        Hash de url|usuario|contraseña para las claves de caché por cuenta: con
+        otra contraseña la clave es otra y los datos no se sirven sin pasar por Traccar
+        """
+        raw = f"{self.base_url}|{self.username}|{self.password}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _session_key(self) -> str:
+        """Clave de caché del login (no incluye la contraseña en claro)"""
+        return "session:" + self.account_key
     
     def _authenticate(self):
         """Autentica contra Traccar usando el endpoint de sesión"""
         if self._authenticated:
             return
         
+        # Reutilizar una sesión abierta por otra petición de este proceso
+        cached = get_session_cache().get(self._session_key())
+        if cached:
+            self.session.cookies.update(cached["cookies"])
+            self._authenticated = True
+            self._session_cached = True
+            return cached["user"]
+        
         url = f"{self.base_url}/api/session"
         response = self.session.post(
             url,
@@ -35,23 +108,56 @@ class TraccarService:
         response.raise_for_status()
         self._authenticated = True
         self._cookies = response.cookies
-        return response.json()
+        user = response.json()
+        get_session_cache().set(
+            self._session_key(),
+            {"cookies": self.session.cookies.get_dict(), "user": user},
+            SESSION_TTL_SECONDS
+        )
+        return user
     
-    def _request(self, method: str, endpoint: str, params: dict = None, json: dict = None, headers: dict = None):
-        """Realiza una petición HTTP a la API de Traccar"""
+    def _send(self, method: str, endpoint: str, params: dict = None, json: dict = None,
+              headers: dict = None, stream: bool = False) -> requests.Response:
+        """Envía la petición (autenticando si hace falta) y retorna la respuesta ya verificada"""
         # Asegurar que estamos autenticados
         self._authenticate()
         
         url = f"{self.base_url}/api{endpoint}"
-        response = self.session.request(
-            method=method,
-            url=url,
-            params=params,
-            json=json,
-            headers=headers,
-            timeout=self.timeout
-        )
+        
+        # Esperar turno en el presupuesto del servidor (los reportes tienen uno propio)
+        limiter = get_host_limiter(self.base_url).for_endpoint(endpoint)
+        record_queue_time(limiter.acquire())
+        started = time.monotonic()
+        failed = True
+        try:
+            response = self.session.request(
+                method=method,
+                url=url,
+                params=params,
+                json=json,
+                headers=headers,
+                timeout=STREAM_TIMEOUT if stream else self.timeout,
+                stream=stream
+            )
+            failed = response.status_code >= 500
+        finally:
+            limiter.release(time.monotonic() - started, failed)
+        
+        # La sesión reutilizada expiró en Traccar: volver a autenticar una vez
+        if response.status_code == 401 and self._session_cached:
+            response.close()
+            get_session_cache().delete(self._session_key())
+            self.session.cookies.clear()
+            self._authenticated = False
+            self._session_cached = False
+            return self._send(method, endpoint, params=params, json=json, headers=headers, stream=stream)
+        
         response.raise_for_status()
+        return response
+    
+    def _request(self, method: str, endpoint: str, params: dict = None, json: dict = None, headers: dict = None):
+        """Realiza una petición HTTP a la API de Traccar"""
+        response = self._send(method, endpoint, params=params, json=json, headers=headers)
         
         # Manejar respuestas vacías o no-JSON
         if not response.content:
@@ -91,6 +197,13 @@ class TraccarService:
             params["deviceId"] = device_id
         return self._request("GET", "/positions", params=params if params else None)
     
+    def get_geofences(self, device_id: Optional[int] = None) -> list:
+        """Obtiene las geocercas del usuario (opcionalmente solo las de un dispositivo)"""
+        params = {}
+        if device_id:
+            params["deviceId"] = device_id
+        return self._request("GET", "/geofences", params=params if params else None)
+    
     def get_position_history(
         self, 
         device_id: int, 
@@ -105,6 +218,42 @@ class TraccarService:
         }
         return self._request("GET", "/positions", params=params)
     
+    def _iter(self, endpoint: str, params: dict, headers: dict = None) -> Iterator[dict]:
+        """Elementos de una respuesta JSON leídos a medida que llegan"""
+        response = self._send("GET", endpoint, params=params, headers=headers, stream=True)
+        try:
+            yield from iter_json_array(response.iter_content(STREAM_CHUNK_BYTES))
+        finally:
+            response.close()
+    
+    def iter_position_history(
+        self,
+        device_id: int,
+        from_time: datetime,
+        to_time: datetime
+    ) -> Iterator[dict]:
+        """Como get_position_history, pero entrega las posiciones de a una sin cargarlas todas"""
+        params = {
+            "deviceId": device_id,
+            "from": from_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "to": to_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        }
+        return self._iter("/positions", params)
+    
+    def iter_events(
+        self,
+        device_id: int,
+        from_time: datetime,
+        to_time: datetime
+    ) -> Iterator[dict]:
+        """Como get_events, pero entrega los eventos de a uno"""
+        params = {
+            "deviceId": device_id,
+            "from": from_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "to": to_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        }
+        return self._iter("/reports/events", params, headers={"Accept": "application/json"})
+    
     def get_events(
         self, 
         device_id: Optional[int] = None,
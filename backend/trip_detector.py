@@ -0,0 +1,248 @@
+"""
+Detección local de viajes y paradas a partir del historial de posiciones.
+Evita llamar a /reports/trips de Traccar cuando ya tenemos las posiciones crudas.
+"""
+import math
+from typing import Optional
+from datetime import datetime
+
+# Umbrales por defecto (similares a los de Traccar)
+SPEED_THRESHOLD_KNOTS = 1.0      # Por debajo se considera detenido
+MIN_STOP_DURATION = 300          # segundos detenido para cerrar un viaje
+MIN_TRIP_DISTANCE = 500          # metros mínimos para reportar un viaje
+MIN_TRIP_DURATION = 60           # segundos mínimos para reportar un viaje
+
+EARTH_RADIUS_M = 6371000
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia en metros entre dos coordenadas"""
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = (math.sin(d_lat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(d_lon / 2) ** 2)
+    return EARTH_RADIUS_M * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def parse_time(iso_string: str) -> Optional[datetime]:
+    """Parsea una fecha ISO de Traccar (fixTime, eventTime...)"""
+    if not iso_string:
+        return None
+    try:
+        return datetime.fromisoformat(iso_string.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+class TripDetector:
+    """
+    Segmenta un flujo de posiciones (ordenado por fixTime) en viajes y paradas.
+    Se alimenta de forma incremental con feed(); las posiciones repetidas o
+    anteriores a la última procesada se ignoran.
+    """
+
+    def __init__(
+        self,
+        device_id: Optional[int] = None,
+        speed_threshold: float = SPEED_THRESHOLD_KNOTS,
+        min_stop_duration: int = MIN_STOP_DURATION,
+        min_trip_distance: float = MIN_TRIP_DISTANCE,
+        min_trip_duration: int = MIN_TRIP_DURATION,
+        use_ignition: bool = True
+    ):
+        self.device_id = device_id
+        self.speed_threshold = speed_threshold
+        self.min_stop_duration = min_stop_duration
+        self.min_trip_distance = min_trip_distance
+        self.min_trip_duration = min_trip_duration
+        self.use_ignition = use_ignition
+
+        self.trips = []
+        self.stops = []
+
+        self._last = None          # (time, position) de la última posición procesada
+        self._trip = None          # Viaje en curso
+        self._pause = None         # (time, position) del inicio de una posible parada
+        self._stop_start = None    # (time, position) del inicio de la parada actual
+
+    # ------------------------------
+    # Estado de movimiento
+    # ------------------------------
+    def is_moving(self, position: dict) -> bool:
+        """Decide si la posición corresponde a un vehículo en movimiento"""
+        attrs = position.get('attributes', {}) or {}
+        if self.use_ignition and attrs.get('ignition') is False:
+            return False
+        if 'motion' in attrs and attrs['motion'] is not None:
+            return bool(attrs['motion'])
+        return (position.get('speed') or 0) > self.speed_threshold
+
+    @staticmethod
+    def _segment_distance(prev: dict, curr: dict) -> float:
+        """Distancia recorrida entre dos posiciones consecutivas (metros)"""
+        prev_total = (prev.get('attributes') or {}).get('totalDistance')
+        curr_total = (curr.get('attributes') or {}).get('totalDistance')
+        if prev_total is not None and curr_total is not None and curr_total >= prev_total:
+            return curr_total - prev_total
+        try:
+            return haversine_m(prev['latitude'], prev['longitude'], curr['latitude'], curr['longitude'])
+        except (KeyError, TypeError):
+            return 0.0
+
+    # ------------------------------
+    # Alimentación
+    # ------------------------------
+    def feed(self, position: dict):
+        """Procesa una posición nueva"""
+        time = parse_time(position.get('fixTime'))
+        if time is None:
+            return
+        if self._last is not None and time <= self._last[0]:
+            return
+
+        if self.device_id is None:
+            self.device_id = position.get('deviceId')
+
+        moving = self.is_moving(position)
+
+        if self._trip is not None:
+            self._advance_trip(time, position, moving)
+        elif moving:
+            self._start_trip(time, position)
+        elif self._stop_start is None:
+            self._stop_start = (time, position)
+
+        self._last = (time, position)
+
+    def feed_many(self, positions: list):
+        """Procesa una lista de posiciones (se ordenan por fixTime)"""
+        for p in sorted(positions or [], key=lambda x: x.get('fixTime', '')):
+            self.feed(p)
+
+    def _start_trip(self, time: datetime, position: dict):
+        """Abre un viaje nuevo y cierra la parada anterior si existía"""
+        if self._stop_start is not None:
+            self._close_stop(time, position)
+        self._trip = {
+            'start': (time, position),
+            'end': (time, position),
+            'distance': 0.0,
+            'max_speed': position.get('speed') or 0,
+            'speed_sum': 0.0,
+            'speed_count': 0,
+        }
+        self._pause = None
+
+    def _advance_trip(self, time: datetime, position: dict, moving: bool):
+        """Acumula una posición dentro del viaje en curso"""
+        trip = self._trip
+        trip['distance'] += self._segment_distance(self._last[1], position)
+        speed = position.get('speed') or 0
+
+        if moving:
+            self._pause = None
+            trip['end'] = (time, position)
+            trip['max_speed'] = max(trip['max_speed'], speed)
+            trip['speed_sum'] += speed
+            trip['speed_count'] += 1
+            return
+
+        if self._pause is None:
+            self._pause = (time, position)
+            trip['distance_at_pause'] = trip['distance']
+        elif (time - self._pause[0]).total_seconds() >= self.min_stop_duration:
+            self._close_trip()
+
+    def _close_trip(self):
+        """Cierra el viaje en curso; la parada comienza donde empezó la pausa"""
+        trip = self._trip
+        pause = self._pause
+        distance = trip['distance']
+        if pause is not None:
+            trip['end'] = pause
+            distance = trip.get('distance_at_pause', distance)
+
+        start_time, start_pos = trip['start']
+        end_time, end_pos = trip['end']
+        duration = (end_time - start_time).total_seconds()
+
+        if distance >= self.min_trip_distance or duration >= self.min_trip_duration:
+            self.trips.append(self._build_trip(trip, distance, duration))
+
+        self._trip = None
+        self._pause = None
+        self._stop_start = pause
+
+    def _close_stop(self, end_time: datetime, end_position: dict):
+        """Registra la parada actual si supera la duración mínima"""
+        start_time, position = self._stop_start
+        duration = (end_time - start_time).total_seconds()
+        if duration >= self.min_stop_duration:
+            self.stops.append({
+                'deviceId': self.device_id,
+                'startTime': position.get('fixTime'),
+                'endTime': end_position.get('fixTime'),
+                'duration': int(duration * 1000),
+                'latitude': position.get('latitude'),
+                'longitude': position.get('longitude'),
+            })
+        self._stop_start = None
+
+    def _build_trip(self, trip: dict, distance: float, duration: float) -> dict:
+        """Construye el viaje con los mismos campos que /reports/trips"""
+        _, start_pos = trip['start']
+        _, end_pos = trip['end']
+        duration_ms = int(duration * 1000)
+        if duration > 0:
+            # Velocidad media en nudos: metros/segundo -> nudos
+            average_speed = (distance / duration) / 0.514444
+        elif trip['speed_count']:
+            average_speed = trip['speed_sum'] / trip['speed_count']
+        else:
+            average_speed = 0
+        return {
+            'deviceId': self.device_id,
+            'startTime': start_pos.get('fixTime'),
+            'endTime': end_pos.get('fixTime'),
+            'distance': round(distance, 1),
+            'duration': duration_ms,
+            'averageSpeed': round(average_speed, 2),
+            'maxSpeed': trip['max_speed'],
+            'startLat': start_pos.get('latitude'),
+            'startLon': start_pos.get('longitude'),
+            'endLat': end_pos.get('latitude'),
+            'endLon': end_pos.get('longitude'),
+            'startPositionId': start_pos.get('id'),
+            'endPositionId': end_pos.get('id'),
+        }
+
+    # ------------------------------
+    # Resultados
+    # ------------------------------
+    def current_trips(self, include_open: bool = True) -> list:
+        """Viajes cerrados más (opcionalmente) el viaje en curso"""
+        trips = list(self.trips)
+        if include_open and self._trip is not None:
+            trip = self._trip
+            start_time, _ = trip['start']
+            end_time, _ = trip['end']
+            duration = (end_time - start_time).total_seconds()
+            distance = trip['distance_at_pause'] if self._pause else trip['distance']
+            if distance >= self.min_trip_distance or duration >= self.min_trip_duration:
+                trips.append(self._build_trip(trip, distance, duration))
+        return trips
+
+
+def detect_trips(positions: list, device_id: Optional[int] = None, **options) -> list:
+    """Atajo: detecta los viajes de una lista de posiciones"""
+    detector = TripDetector(device_id=device_id, **options)
+    detector.feed_many(positions)
+    return detector.current_trips()
+
+
+def detect_stops(positions: list, device_id: Optional[int] = None, **options) -> list:
+    """Atajo: detecta las paradas de una lista de posiciones"""
+    detector = TripDetector(device_id=device_id, **options)
+    detector.feed_many(positions)
+    return list(detector.stops)
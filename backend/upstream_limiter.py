@@ -0,0 +1,164 @@
+"""
+Limitación de peticiones hacia cada servidor Traccar.
+
+Por servidor hay dos presupuestos: uno general y otro, más bajo, para los
+reportes (/reports/*), que son los que más cargan a Traccar. Cada uno combina
+un token bucket (peticiones por segundo) con un máximo de peticiones en vuelo
+que se ajusta solo: baja cuando suben la latencia o los errores y vuelve a
+subir poco a poco cuando el servidor responde bien (AIMD).
+"""
+import os
+import time
+import asyncio
+import threading
+import contextvars
+
+GENERAL_RATE = float(os.getenv("TRACCAR_RATE_LIMIT", "20"))          # peticiones/s por servidor
+GENERAL_MAX_IN_FLIGHT = int(os.getenv("TRACCAR_MAX_IN_FLIGHT", "16"))
+REPORTS_RATE = float(os.getenv("TRACCAR_REPORTS_RATE_LIMIT", "4"))
+REPORTS_MAX_IN_FLIGHT = int(os.getenv("TRACCAR_REPORTS_MAX_IN_FLIGHT", "4"))
+QUEUE_TIMEOUT_SECONDS = 10.0        # Tiempo máximo en cola antes de rechazar
+TARGET_LATENCY_SECONDS = 3.0        # Por encima se reduce la concurrencia
+DECREASE_FACTOR = 0.7
+INCREASE_EVERY = 10                 # Éxitos seguidos necesarios para subir el límite en 1
+
+# Estadísticas de la petición HTTP en curso (las completa el middleware de main.py)
+request_stats = contextvars.ContextVar("upstream_request_stats", default=None)
+
+
+class UpstreamBusyError(Exception):
+    """El servidor Traccar está saturado y la petición no pudo entrar en el presupuesto"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def on_event_loop() -> bool:
+    """True si se llama desde el hilo del loop de asyncio (donde no se puede esperar)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class AdaptiveLimiter:
+    """Token bucket + concurrencia adaptativa para un tipo de petición"""
+
+    def __init__(self, name: str, rate: float, max_in_flight: int):
+        self.name = name
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.max_limit = max_in_flight
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.successes = 0
+        self.ewma_latency = 0.0
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self.metrics = {"requests": 0, "queued": 0, "rejected": 0, "errors": 0, "decreases": 0}
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: float = QUEUE_TIMEOUT_SECONDS) -> float:
+        """
+        Espera turno. Retorna los segundos que pasó en cola o lanza UpstreamBusyError.
+        Desde el loop de asyncio no se espera (congelaría todo el worker): sin turno
+        libre se rechaza enseguida. Las llamadas a Traccar deben hacerse en hilos.
+        """
+        if on_event_loop():
+            timeout = 0.0
+        started = time.monotonic()
+        deadline = started + timeout
+        queued = False
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.in_flight < int(self.limit) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.metrics["requests"] += 1
+                    if queued:
+                        self.metrics["queued"] += 1
+                    return now - started
+                if now >= deadline:
+                    self.metrics["rejected"] += 1
+                    raise UpstreamBusyError(
+                        f"Servidor Traccar saturado ({self.name}), intenta de nuevo en unos segundos",
+                        retry_after=max(1.0, self.ewma_latency)
+                    )
+                queued = True
+                wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.05
+                self._cond.wait(min(max(wait, 0.01), deadline - now))
+
+    def release(self, latency: float, failed: bool):
+        """Libera el turno y ajusta el límite según la respuesta"""
+        with self._cond:
+            self.in_flight -= 1
+            self.ewma_latency = latency if self.ewma_latency == 0 else 0.8 * self.ewma_latency + 0.2 * latency
+            if failed or latency > TARGET_LATENCY_SECONDS:
+                if failed:
+                    self.metrics["errors"] += 1
+                self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                self.successes = 0
+                self.metrics["decreases"] += 1
+            else:
+                self.successes += 1
+                if self.successes >= INCREASE_EVERY and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                **self.metrics,
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "ewma_latency": round(self.ewma_latency, 3),
+            }
+
+
+class HostLimiter:
+    """Presupuestos de un servidor Traccar"""
+
+    def __init__(self):
+        self.general = AdaptiveLimiter("general", GENERAL_RATE, GENERAL_MAX_IN_FLIGHT)
+        self.reports = AdaptiveLimiter("reportes", REPORTS_RATE, REPORTS_MAX_IN_FLIGHT)
+
+    def for_endpoint(self, endpoint: str) -> AdaptiveLimiter:
+        return self.reports if endpoint.startswith("/reports") else self.general
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def get_host_limiter(base_url: str) -> HostLimiter:
+    """Limitador compartido por todas las peticiones hacia un mismo servidor"""
+    with _hosts_lock:
+        if base_url not in _hosts:
+            _hosts[base_url] = HostLimiter()
+        return _hosts[base_url]
+
+
+def limiter_snapshot() -> dict:
+    with _hosts_lock:
+        hosts = dict(_hosts)
+    return {
+        host: {"general": h.general.snapshot(), "reports": h.reports.snapshot()}
+        for host, h in hosts.items()
+    }
+
+
+def record_queue_time(seconds: float):
+    """Acumula el tiempo en cola en las estadísticas de la petición HTTP actual"""
+    stats = request_stats.get()
+    if stats is not None:
+        stats["queued_ms"] += seconds * 1000
+        stats["upstream_calls"] += 1
@@ -21,10 +21,28 @@ api.interceptors.request.use((config) => {
   return config
 })
 
+// Avisa a la interfaz cuando el servidor Traccar está encolando o rechazando peticiones
+function notifyUpstream(detail) {
+  window.dispatchEvent(new CustomEvent('traccar-upstream', { detail }))
+}
+
 // Interceptor para manejar errores
 api.interceptors.response.use(
-  (response) => response,
+  (response) => {
+    const queuedMs = Number(response.headers['x-upstream-queued-ms'] || 0)
+    if (queuedMs > 0) {
+      notifyUpstream({ status: 'queued', queuedMs })
+    }
+    return response
+  },
   (error) => {
+    if (error.response?.status === 503) {
+      notifyUpstream({
+        status: 'rejected',
+        retryAfter: Number(error.response.headers['retry-after'] || 0),
+        message: error.response.data?.detail
+      })
+    }
     if (error.response?.status === 401) {
       const authStore = useAuthStore()
       authStore.logout()
@@ -34,6 +52,18 @@ api.interceptors.response.use(
   }
 )
 
+// Posiciones en formato compacto ({ columns, rows }): los nombres de campo
+// viajan una sola vez y aquí se reconstruyen los objetos
+function decodePositions(data) {
+  if (!data || Array.isArray(data)) return data
+  const { columns, rows } = data
+  return rows.map(row => {
+    const position = {}
+    columns.forEach((name, i) => { position[name] = row[i] })
+    return position
+  })
+}
+
 export const authApi = {
   login: async (traccarUrl, username, password) => {
     const response = await api.post('/auth/login', {
@@ -57,11 +87,63 @@ export const devicesApi = {
   }
 }
 
+// Últimas posiciones de la flota ya recibidas: cada refresco solo pide los cambios
+const latestState = { token: null, cursor: null, positions: new Map() }
+
+function latestParams() {
+  const authStore = useAuthStore()
+  if (latestState.token !== authStore.token) {
+    latestState.token = authStore.token
+    latestState.cursor = null
+    latestState.positions = new Map()
+  }
+  return latestState.cursor ? { since: latestState.cursor } : {}
+}
+
+function mergeLatest({ positions, cursor, delta }) {
+  if (!delta) latestState.positions = new Map()
+  positions.forEach(p => latestState.positions.set(p.deviceId, p))
+  latestState.cursor = cursor || null
+  return Array.from(latestState.positions.values())
+}
+
+// Varias consultas en una sola petición: [{ id, type, params }] -> { id: resultado }.
+// Una consulta fallida llega como { status, error } sin afectar a las demás.
+export const batchApi = {
+  run: async (calls) => {
+    const response = await api.post('/batch', { calls })
+    return Object.fromEntries(response.data.results.map(r => [r.id, r]))
+  }
+}
+
+function batchData(result) {
+  if (result.status !== 200) throw new Error(result.error || 'Error en la consulta')
+  return result.data
+}
+
+export const dashboardApi = {
+  // Dispositivos y últimas posiciones en un solo viaje al servidor
+  load: async () => {
+    const results = await batchApi.run([
+      { id: 'devices', type: 'devices' },
+      { id: 'positions', type: 'positions', params: latestParams() }
+    ])
+    return {
+      devices: results.devices.status === 200 ? results.devices.data.devices : null,
+      positions: results.positions.status === 200 ? mergeLatest(results.positions.data) : null
+    }
+  }
+}
+
 export const positionsApi = {
   getLatest: async (deviceId = null) => {
-    const params = deviceId ? { device_id: deviceId } : {}
-    const response = await api.get('/positions', { params })
-    return response.data.positions
+    if (deviceId) {
+      const response = await api.get('/positions', { params: { device_id: deviceId } })
+      return response.data.positions
+    }
+
+    const response = await api.get('/positions', { params: latestParams() })
+    return mergeLatest(response.data)
   },
   
   getHistory: async (deviceId, fromTime, toTime) => {
@@ -69,10 +151,31 @@ export const positionsApi = {
       params: {
         device_id: deviceId,
         from_time: fromTime,
-        to_time: toTime
+        to_time: toTime,
+        encoding: 'compact'
       }
     })
-    return response.data.positions
+    return decodePositions(response.data.positions)
+  },
+
+  getNear: async (latitude, longitude, radius = 200, params = {}) => {
+    const response = await api.get('/positions/near', {
+      params: { latitude, longitude, radius, ...params }
+    })
+    return response.data.visits
+  },
+
+  getWithin: async (minLat, minLon, maxLat, maxLon, params = {}) => {
+    const response = await api.get('/positions/within', {
+      params: { min_lat: minLat, min_lon: minLon, max_lat: maxLat, max_lon: maxLon, ...params }
+    })
+    return response.data.devices
+  },
+
+  // bbox en formato de Leaflet (map.getBounds().toBBoxString())
+  getClusters: async (bbox, zoom) => {
+    const response = await api.get('/positions/clusters', { params: { bbox, zoom } })
+    return response.data.clusters
   }
 }
 
@@ -82,10 +185,46 @@ export const routeApi = {
       params: {
         device_id: deviceId,
         from_time: fromTime,
-        to_time: toTime
+        to_time: toTime,
+        encoding: 'compact'
       }
     })
-    return response.data.route
+    return decodePositions(response.data.route)
+  }
+}
+
+// Reproducción marcada por el servidor: onMessage recibe {type: 'status' | 'positions' | 'seeked' | 'end' | 'error'}
+// y onClose el código de cierre (4401 credenciales, 4404 dispositivo)
+export const replayApi = {
+  open: (deviceId, fromTime, toTime, speed, onMessage, onClose = () => {}) => {
+    const authStore = useAuthStore()
+    const base = new URL(API_BASE_URL, window.location.origin)
+    base.protocol = base.protocol === 'https:' ? 'wss:' : 'ws:'
+    const params = new URLSearchParams({
+      device_id: deviceId,
+      from_time: fromTime,
+      to_time: toTime,
+      speed
+    })
+    const socket = new WebSocket(`${base.href.replace(/\/$/, '')}/replay?${params}`)
+    const send = (message) => socket.send(JSON.stringify(message))
+    // Las credenciales van en el primer mensaje y no en la URL (quedaría en los logs)
+    socket.onopen = () => send({ action: 'auth', token: authStore.token })
+    socket.onmessage = (event) => onMessage(JSON.parse(event.data))
+    socket.onclose = (event) => onClose(event.code)
+
+    // Órdenes enviadas antes de abrir el socket se descartan (la reproducción arranca sola)
+    const sendOpen = (message) => {
+      if (socket.readyState === WebSocket.OPEN) send(message)
+    }
+    return {
+      socket,
+      play: () => sendOpen({ action: 'play' }),
+      pause: () => sendOpen({ action: 'pause' }),
+      seek: (time) => sendOpen({ action: 'seek', time }),
+      setSpeed: (value) => sendOpen({ action: 'speed', value }),
+      close: () => socket.close()
+    }
   }
 }
 
@@ -98,6 +237,36 @@ export const eventsApi = {
     
     const response = await api.get('/events', { params })
     return response.data.events
+  },
+
+  // Registro local: { events, next_cursor, counts: { tipo: cantidad }, total }.
+  // Con cursor (el next_cursor anterior) trae la página siguiente sin ir a Traccar
+  log: async ({ deviceId = null, fromTime = null, toTime = null, types = [], limit = 100, cursor = null } = {}) => {
+    const params = { limit }
+    if (deviceId) params.device_id = deviceId
+    if (fromTime) params.from_time = fromTime
+    if (toTime) params.to_time = toTime
+    if (types.length) params.types = types.join(',')
+    if (cursor) params.cursor = cursor
+
+    const response = await api.get('/events/log', { params })
+    return response.data
+  }
+}
+
+export const historyApi = {
+  // Historial de posiciones y viajes en una sola petición; si fallan los viajes
+  // se devuelve el historial igual
+  load: async (deviceId, fromTime, toTime) => {
+    const params = { device_id: deviceId, from_time: fromTime, to_time: toTime }
+    const results = await batchApi.run([
+      { id: 'history', type: 'history', params: { ...params, encoding: 'compact' } },
+      { id: 'trips', type: 'trips', params }
+    ])
+    return {
+      positions: decodePositions(batchData(results.history).positions),
+      trips: results.trips.status === 200 ? results.trips.data.trips : []
+    }
   }
 }
 
@@ -114,17 +283,61 @@ export const tripsApi = {
   }
 }
 
+export const geofencesApi = {
+  getAll: async () => {
+    const response = await api.get('/geofences')
+    return response.data.geofences
+  },
+
+  // Visitas, entradas/salidas y permanencia calculadas sobre el historial
+  report: async (deviceId, fromTime, toTime, geofenceIds = null) => {
+    const params = { device_id: deviceId, from_time: fromTime, to_time: toTime }
+    if (geofenceIds && geofenceIds.length) params.geofence_ids = geofenceIds.join(',')
+
+    const response = await api.get('/reports/geofences', { params })
+    return response.data
+  }
+}
+
+export const telemetryApi = {
+  // Series reducidas para gráficos: { series: { campo: { t: [...], v: [...] } } }
+  // (con method 'minmax': t, min, max y avg por tramo)
+  get: async (deviceId, fields = ['speed'], fromTime = null, toTime = null, points = 500, method = 'lttb') => {
+    const params = { device_id: deviceId, fields: fields.join(','), points, method }
+    if (fromTime) params.from_time = fromTime
+    if (toTime) params.to_time = toTime
+
+    const response = await api.get('/telemetry', { params })
+    return response.data
+  }
+}
+
 export const chatApi = {
-  send: async (deviceId, message, hoursOfData = 24, conversationHistory = []) => {
+  // El historial vive en el servidor: basta con el conversation_id de la respuesta anterior
+  send: async (deviceId, message, hoursOfData = 24, conversationId = null, mode = 'full') => {
     const response = await api.post('/chat', {
       device_id: deviceId,
       message,
       hours_of_data: hoursOfData,
-      conversation_history: conversationHistory
+      conversation_id: conversationId,
+      mode
     }, {
       timeout: 60000 // 60 segundos para el chat ya que OpenAI puede tardar
     })
     return response.data
+  },
+
+  // Preguntas sobre toda la flota (o sobre los deviceIds indicados)
+  sendFleet: async (message, hoursOfData = 24, conversationId = null, deviceIds = null) => {
+    const response = await api.post('/chat/fleet', {
+      message,
+      hours_of_data: hoursOfData,
+      conversation_id: conversationId,
+      device_ids: deviceIds
+    }, {
+      timeout: 120000 // Descarga y resume el historial de cada vehículo antes de consultar a OpenAI
+    })
+    return response.data
   }
 }
 
@@ -1,70 +1,354 @@
+"""
+Cliente de línea de comandos para Traccar.
+
+Usa una sola sesión HTTP con conexiones keep-alive reutilizables y descarga
+muchos dispositivos en paralelo. La salida se escribe a medida que llegan los
+datos, en NDJSON (una línea JSON por registro) o CSV, para usarla desde cron.
+
+Ejemplos:
+    python traccar_client.py devices
+    python traccar_client.py positions --format csv
+    python traccar_client.py history --device 12 --device 15 --hours 24
+    python traccar_client.py export --group 3 --from 2024-05-01 --to 2024-05-08 \\
+        --concurrency 8 --format csv --attributes ignition,io36 -o mayo.csv
+
+Las credenciales se toman de --url/--user/--password o de las variables de
+entorno TRACCAR_URL, TRACCAR_USER y TRACCAR_PASSWORD.
+"""
+import os
+import sys
+import csv
+import json
+import argparse
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 import requests
-from requests.auth import HTTPBasicAuth
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ==============================
 # CONFIG
 # ==============================
-TRACCAR_BASE_URL = "https://TU_TRACCAR_URL"  # ej: https://demo.traccar.org
-TRACCAR_USER = "TU_USUARIO"
-TRACCAR_PASSWORD = "TU_PASSWORD"
+TRACCAR_BASE_URL = os.getenv("TRACCAR_URL", "https://TU_TRACCAR_URL")  # ej: https://demo.traccar.org
+TRACCAR_USER = os.getenv("TRACCAR_USER", "TU_USUARIO")
+TRACCAR_PASSWORD = os.getenv("TRACCAR_PASSWORD", "TU_PASSWORD")
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_SLICE_HOURS = 24
+REQUEST_TIMEOUT = 60
+
 
 # ==============================
 # CLIENT
 # ==============================
-def get_devices():
-    url = f"{TRACCAR_BASE_URL}/api/devices"
-    r = requests.get(url, auth=HTTPBasicAuth(TRACCAR_USER, TRACCAR_PASSWORD))
-    r.raise_for_status()
-    return r.json()
+class TraccarClient:
+    """Cliente HTTP con sesión compartida entre hilos y pool de conexiones"""
+
+    def __init__(self, base_url: str, username: str, password: str, pool_size: int = DEFAULT_CONCURRENCY):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.headers["Accept"] = "application/json"
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1), max_retries=retries)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._username = username
+        self._password = password
 
+    def login(self):
+        """
+        Abre una sesión de Traccar (cookie JSESSIONID) para que el servidor no
+        vuelva a verificar la contraseña en cada petición. Si falla se sigue con Basic Auth.
+        """
+        try:
+            r = self.session.post(
+                f"{self.base_url}/api/session",
+                data={"email": self._username, "password": self._password},
+                timeout=REQUEST_TIMEOUT,
+            )
+            r.raise_for_status()
+        except requests.RequestException as e:
+            print(f"⚠️ No se pudo abrir sesión ({e}); se usará Basic Auth", file=sys.stderr)
+            return
+        if "JSESSIONID" not in self.session.cookies:
+            print("⚠️ Traccar no devolvió cookie de sesión; se usará Basic Auth", file=sys.stderr)
+            return
+        # Con la cookie alcanza: sin Basic Auth el servidor no vuelve a verificar la contraseña
+        self.session.auth = None
 
-def get_last_positions(device_id=None):
-    url = f"{TRACCAR_BASE_URL}/api/positions"
-    params = {}
-    if device_id:
-        params["deviceId"] = device_id
+    def _get(self, endpoint: str, params=None):
+        r = self.session.get(f"{self.base_url}/api{endpoint}", params=params, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        return r.json()
 
-    r = requests.get(
-        url,
-        params=params,
-        auth=HTTPBasicAuth(TRACCAR_USER, TRACCAR_PASSWORD)
-    )
-    r.raise_for_status()
-    return r.json()
+    def get_devices(self) -> list:
+        return self._get("/devices")
+
+    def get_last_positions(self, device_id=None) -> list:
+        params = {"deviceId": device_id} if device_id else {}
+        return self._get("/positions", params)
+
+    def get_position_history(self, device_id: int, from_time: datetime, to_time: datetime) -> list:
+        return self._get("/positions", {
+            "deviceId": device_id,
+            "from": from_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "to": to_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+
+    def close(self):
+        self.session.close()
 
 
 # ==============================
-# MAIN
+# SALIDA
 # ==============================
-if __name__ == "__main__":
-    print("📡 Conectando a Traccar...\n")
+POSITION_COLUMNS = [
+    "deviceId", "id", "fixTime", "serverTime", "latitude", "longitude",
+    "altitude", "speed", "course", "valid",
+]
+DEVICE_COLUMNS = ["id", "name", "uniqueId", "status", "groupId", "lastUpdate", "category"]
+
+
+class NdjsonWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, records: list):
+        for record in records:
+            self.out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            self.out.write("\n")
+        self.out.flush()
+
+
+class CsvWriter:
+    """
+    CSV con columnas fijas. Los atributos pedidos con --attributes van en
+    columnas propias (attr_<nombre>); el resto queda como JSON en "attributes".
+    """
+
+    def __init__(self, out, columns: list, attributes: list):
+        self.out = out
+        self.columns = columns
+        self.attributes = attributes
+        self.writer = csv.writer(out)
+        self.writer.writerow(columns + [f"attr_{a}" for a in attributes] + ["attributes"])
+
+    def write(self, records: list):
+        for record in records:
+            attrs = record.get("attributes") or {}
+            rest = {k: v for k, v in attrs.items() if k not in self.attributes}
+            self.writer.writerow(
+                [record.get(c) for c in self.columns]
+                + [attrs.get(a) for a in self.attributes]
+                + [json.dumps(rest, ensure_ascii=False, separators=(",", ":")) if rest else ""]
+            )
+        self.out.flush()
+
+
+def make_writer(args, columns: list):
+    if args.format == "csv":
+        return CsvWriter(args.out, columns, args.attributes)
+    return NdjsonWriter(args.out)
+
+
+# ==============================
+# DESCARGAS EN PARALELO
+# ==============================
+def parse_date(value: str) -> datetime:
+    """Fecha ISO ('2024-05-01' o '2024-05-01T10:00:00Z'); sin zona se asume UTC"""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def time_range(args) -> tuple:
+    to_time = parse_date(args.to_time) if args.to_time else datetime.now(timezone.utc)
+    if args.from_time:
+        from_time = parse_date(args.from_time)
+    else:
+        from_time = to_time - timedelta(hours=args.hours)
+    if from_time >= to_time:
+        raise SystemExit("❌ --from debe ser anterior a --to")
+    return from_time, to_time
 
-    devices = get_devices()
-    print("🚗 Dispositivos encontrados:")
-    for d in devices:
-        print(f"- ID={d['id']} | Nombre={d['name']} | IMEI={d['uniqueId']}")
 
+def slices(from_time: datetime, to_time: datetime, hours: int) -> list:
+    step = timedelta(hours=max(1, hours))
+    result = []
+    start = from_time
+    while start < to_time:
+        end = min(start + step, to_time)
+        result.append((start, end))
+        start = end
+    return result
+
+
+def run_concurrently(tasks, fn, concurrency: int, on_result):
+    """
+    Ejecuta fn(*task) con `concurrency` hilos como máximo, sin encolar más de
+    2 * concurrency tareas a la vez (memoria acotada). on_result(task, result)
+    se llama en el hilo principal, en orden de llegada.
+    """
+    tasks = iter(tasks)
+    errors = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+
+        def submit_next():
+            task = next(tasks, None)
+            if task is not None:
+                pending[executor.submit(fn, *task)] = task
+            return task is not None
+
+        for _ in range(concurrency * 2):
+            if not submit_next():
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    on_result(task, future.result())
+                except requests.RequestException as e:
+                    errors += 1
+                    print(f"❌ Error en {task}: {e}", file=sys.stderr)
+                submit_next()
+    return errors
+
+
+def fetch_history(client: TraccarClient, args, device_ids: list) -> int:
+    from_time, to_time = time_range(args)
+    writer = make_writer(args, POSITION_COLUMNS)
+    tasks = [
+        (device_id, start, end)
+        for device_id in device_ids
+        for start, end in slices(from_time, to_time, args.slice_hours)
+    ]
+    total = 0
+
+    def on_result(task, positions):
+        nonlocal total
+        positions.sort(key=lambda p: p.get("fixTime", ""))
+        writer.write(positions)
+        total += len(positions)
+
+    print(f"📡 {len(device_ids)} dispositivos, {len(tasks)} tramos, concurrencia {args.concurrency}",
+          file=sys.stderr)
+    errors = run_concurrently(tasks, client.get_position_history, args.concurrency, on_result)
+    print(f"✅ {total} posiciones" + (f", {errors} tramos con error" if errors else ""), file=sys.stderr)
+    return 1 if errors else 0
+
+
+# ==============================
+# SUBCOMANDOS
+# ==============================
+def cmd_devices(client: TraccarClient, args) -> int:
+    writer = make_writer(args, DEVICE_COLUMNS)
+    writer.write(client.get_devices())
+    return 0
+
+
+def cmd_positions(client: TraccarClient, args) -> int:
+    writer = make_writer(args, POSITION_COLUMNS)
+    if not args.device:
+        # Una sola petición trae la última posición de toda la flota
+        writer.write(client.get_last_positions())
+        return 0
+    tasks = [(device_id,) for device_id in args.device]
+    return 1 if run_concurrently(
+        tasks, client.get_last_positions, args.concurrency,
+        lambda task, positions: writer.write(positions)
+    ) else 0
+
+
+def cmd_history(client: TraccarClient, args) -> int:
+    return fetch_history(client, args, args.device)
+
+
+def cmd_export(client: TraccarClient, args) -> int:
+    devices = client.get_devices()
+    if args.group:
+        devices = [d for d in devices if d.get("groupId") in set(args.group)]
     if not devices:
-        print("❌ No hay dispositivos asociados a este usuario")
-        exit(1)
+        print("❌ No hay dispositivos para exportar", file=sys.stderr)
+        return 1
+    return fetch_history(client, args, sorted(d["id"] for d in devices))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    # Opciones comunes: se aceptan después del subcomando (ej: `history --device 1 --format csv`)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--url", default=TRACCAR_BASE_URL, help="URL del servidor Traccar")
+    common.add_argument("--user", default=TRACCAR_USER)
+    common.add_argument("--password", default=TRACCAR_PASSWORD)
+    common.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    common.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Peticiones simultáneas (y conexiones en el pool)")
+    common.add_argument("--attributes", type=lambda v: [a for a in v.split(",") if a], default=[],
+                        help="Atributos con columna propia en CSV, separados por comas (ej: ignition,io36)")
+    common.add_argument("-o", "--output", help="Archivo de salida (por defecto stdout)")
+
+    parser = argparse.ArgumentParser(description="Cliente de línea de comandos para Traccar")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("devices", parents=[common], help="Lista los dispositivos")
 
-    device_id = devices[0]["id"]
-    print(f"\n📍 Obteniendo última posición del dispositivo {device_id}...\n")
+    positions = sub.add_parser("positions", parents=[common], help="Últimas posiciones")
+    positions.add_argument("--device", type=int, action="append", help="ID de dispositivo (repetible)")
 
-    positions = get_last_positions(device_id)
+    def add_range(p):
+        p.add_argument("--from", dest="from_time", help="Inicio (ISO, UTC si no tiene zona)")
+        p.add_argument("--to", dest="to_time", help="Fin (ISO, por defecto ahora)")
+        p.add_argument("--hours", type=int, default=24, help="Horas hacia atrás si no se indica --from")
+        p.add_argument("--slice-hours", type=int, default=DEFAULT_SLICE_HOURS,
+                       help="Tamaño de cada tramo descargado")
 
-    if not positions:
-        print("⚠️ No hay posiciones todavía")
-        exit(0)
+    history = sub.add_parser("history", parents=[common], help="Historial de uno o más dispositivos")
+    history.add_argument("--device", type=int, action="append", required=True,
+                         help="ID de dispositivo (repetible)")
+    add_range(history)
 
-    p = positions[0]
+    export = sub.add_parser("export", parents=[common], help="Historial de toda la flota o de algunos grupos")
+    export.add_argument("--group", type=int, action="append", help="ID de grupo (repetible)")
+    add_range(export)
+    return parser
 
-    print("✅ Última posición:")
-    print(f"  Fecha UTC : {p['fixTime']}")
-    print(f"  Lat/Lon   : {p['latitude']}, {p['longitude']}")
-    print(f"  Velocidad : {p['speed']} km/h")
-    print(f"  Atributos :")
 
-    for k, v in p.get("attributes", {}).items():
-        print(f"    - {k}: {v}")
+# ==============================
+# MAIN
+# ==============================
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    args.concurrency = max(1, args.concurrency)
+    args.out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    client = TraccarClient(args.url, args.user, args.password, pool_size=args.concurrency)
+    commands = {
+        "devices": cmd_devices,
+        "positions": cmd_positions,
+        "history": cmd_history,
+        "export": cmd_export,
+    }
+    try:
+        client.login()
+        return commands[args.command](client, args)
+    except requests.RequestException as e:
+        print(f"❌ Error al conectar con Traccar: {e}", file=sys.stderr)
+        return 1
+    except BrokenPipeError:
+        # La salida se cortó (ej: `| head`)
+        return 0
+    finally:
+        client.close()
+        if args.out is not sys.stdout:
+            args.out.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())